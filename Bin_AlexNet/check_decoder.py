@@ -2,7 +2,6 @@ from __future__ import print_function
 import sys
 import os
 pjoin = os.path.join
-os.environ["CUDA_VISIBLE_DEVICES"] = sys.argv[sys.argv.index("--gpu") + 1] # The args MUST has an option "--gpu".
 import shutil
 import time
 import argparse
@@ -15,33 +14,35 @@ import glob
 # torch
 import torch
 import torch.nn as nn
-from torch.utils.serialization import load_lua
 import torch.utils.data as Data
 import torchvision
 import torchvision.utils as vutils
 import torchvision.transforms as transforms
 import torchvision.models as models
 # my libs
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # the repo root, for the shared modules in common/
 from model import AlexNet_Encoder, AlexNet_Decoder
+from common.device import add_device_args, set_up_device, to_device
 
 # Passed-in params
 parser = argparse.ArgumentParser(description="")
 parser.add_argument('--img', type=str, default="./cat.jpg")
 parser.add_argument('--img_size', type=int, default=224)
-parser.add_argument('--gpu', type=int)
 parser.add_argument('--e1', type=str, default="models/my_alexnet.pth")
 parser.add_argument('--d', type=str, default="../Experiments/only_closs1/weights/*E0S2000*.pth")
 parser.add_argument('--e2', type=str)
 parser.add_argument('--closs_weight', type=float, default=10)
 parser.add_argument('--use_pseudo_code', action="store_true")
 parser.add_argument('--code_generator', type=str, default="alexnet")
+add_device_args(parser)
 opt = parser.parse_args()
+device = set_up_device(opt)
 opt.d = glob.glob(opt.d)[0]
 
 # Prepare model
-code_generator = eval("models.%s(pretrained=True).cuda().eval()" % opt.code_generator)
-encoder = AlexNet_Encoder(opt.e1).cuda().eval()
-decoder = AlexNet_Decoder(opt.d).cuda()
+code_generator = to_device(eval("models.%s(pretrained=True)" % opt.code_generator), opt).eval()
+encoder = to_device(AlexNet_Encoder(opt.e1), opt).eval()
+decoder = to_device(AlexNet_Decoder(opt.d), opt)
 
 # Get the code
 if opt.use_pseudo_code:
@@ -49,16 +50,16 @@ if opt.use_pseudo_code:
     print("==> pseudo_code does not exist: Generate one and save.")
     randperm = torch.randperm(1000)[:1] # to get one_hot
     code_gt = torch.randn([1, 1000]) + torch.eye(1000)[randperm] * 10  # logits
-    code_gt = code_gt.cuda()
+    code_gt = code_gt.to(device)
     np.save(".pseudo_code.npy", code_gt.data.cpu().numpy())
   else:
     print("==> pseudo_code has already existed: Use it.")
-    code_gt = torch.from_numpy(np.load(".pseudo_code.npy")).cuda()
+    code_gt = torch.from_numpy(np.load(".pseudo_code.npy")).to(device)
 else:
   # Prepare input image
   img = Image.open(opt.img).convert("RGB")
   img = img.resize([opt.img_size, opt.img_size])
-  img = transforms.ToTensor()(img).cuda().unsqueeze(0)
+  img = to_device(transforms.ToTensor()(img).unsqueeze(0), opt)
   print(img)
   code_gt = code_generator(img) # code GT
   print("==> The predict class: {}".format(code_gt.argmax()))
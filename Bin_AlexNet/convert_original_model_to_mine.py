@@ -1,5 +1,8 @@
+import sys
+import os
 import torchvision.models as models
 import torch
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # the repo root, for the shared modules in common/
 from model import AlexNet_Encoder
 
 alex = models.alexnet(pretrained=True)
@@ -2,7 +2,6 @@ from __future__ import print_function
 import sys
 import os
 pjoin = os.path.join
-os.environ["CUDA_VISIBLE_DEVICES"] = sys.argv[sys.argv.index("--gpu") + 1] # The args MUST has an option "--gpu".
 import shutil
 import time
 import argparse
@@ -15,14 +14,19 @@ import glob
 # torch
 import torch
 import torch.nn as nn
-from torch.utils.serialization import load_lua
 import torch.utils.data as Data
 import torchvision
 import torchvision.utils as vutils
 import torchvision.transforms as transforms
 from torch.distributions.one_hot_categorical import OneHotCategorical
 # my libs
-from model import AutoEncoders
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # the repo root, for the shared modules in common/
+from model import AutoEncoders, CHECKPOINT_MODES
+from common.loss import DistillLoss
+from common.device import add_device_args, set_up_device, to_device, autocast
+from common.checkpoint import CheckpointWriter
+from common.samples import SampleWriter
+from common.sampler import CodeSampler
 
 
 def logprint(some_str, f=sys.stdout):
@@ -39,7 +43,6 @@ if __name__ == "__main__":
   parser.add_argument('--e1', type=str, help='path of pretrained encoder1', default=None)
   parser.add_argument('--e2', type=str, help='path of pretrained encoder2', default=None)
   parser.add_argument('--d',  type=str, help='path of pretrained decoder',  default=None)
-  parser.add_argument('--gpu', type=int, help="which gpu to run on. default is 0", default=0)
   parser.add_argument('--batch_size', type=int, help='batch size', default=8)
   parser.add_argument('--lr', type=float, help='learning rate', default=1e-5)
   parser.add_argument('--floss_weight', type=float, help='loss weight to balance multi-losses', default=1.0)
@@ -56,7 +59,10 @@ if __name__ == "__main__":
   parser.add_argument('--debug', action="store_true")
   parser.add_argument('--clip', type=float, default=0.4)
   parser.add_argument('--num_class', type=int, default=1000)
+  parser.add_argument('--act_checkpoint', type=str, default="none", choices=CHECKPOINT_MODES, help="activation checkpointing of the decoder and the encoder passes over the reconstructions, to fit larger batches")
+  add_device_args(parser)
   args = parser.parse_args()
+  device = set_up_device(args)
   
   # Get path
   args.e1 = glob.glob(args.e1)[0] if args.e1 != None else None
@@ -89,8 +95,8 @@ if __name__ == "__main__":
   
   # Set up model
   AE = AutoEncoders[args.mode]
-  ae = AE(args.e1, args.d, args.e2)
-  ae.cuda()
+  ae = AE(args.e1, args.d, args.e2, checkpoint=args.act_checkpoint)
+  ae = to_device(ae, args)
 
   # Prepare code
   randperm = torch.randperm(1000)[:5] # to get one_hot
@@ -105,6 +111,10 @@ if __name__ == "__main__":
   ploss_lw = [float(x) for x in args.ploss_lw.split("-")]
   closs_lw = [float(x) for x in args.closs_lw.split("-")]
   
+  # Losses. Terms with weight 0 are not computed.
+  loss_rec1_fn = DistillLoss({"soft": args.closs_weight * closs_lw[0], "feat": args.floss_weight * (args.mode == "SE")}, feat_lw=floss_lw)
+  loss_rec2_fn = DistillLoss({"soft": args.closs_weight * closs_lw[1], "perc": args.ploss_weight}, perc_lw=ploss_lw)
+  
   # Optimize
   ## set lr
   fc8_params = list(map(id, ae.dec.fc8.parameters()))
@@ -125,66 +135,32 @@ if __name__ == "__main__":
             ], lr=args.lr)  
   
   optimizer = torch.optim.Adam(ae.parameters(), lr=args.lr)
-  loss_func = nn.MSELoss()
+  ckpt_writer = CheckpointWriter() # write the checkpoints and sample images in the background
+  sample_writer = SampleWriter(pjoin(rec_img_path, "%s_samples.npz" % TIME_ID))
+  code_sampler = CodeSampler(args.batch_size, args.num_class, device) # randn + onehot
   t1 = time.time()
-  ploss1 = ploss2 = ploss3 = ploss4 = ploss5 = torch.FloatTensor(0).cuda()
   for epoch in range(args.epoch):
     for step in range(args.num_step_per_epoch):
       # Generate codes randomly
-      one_hot = OneHotCategorical([1./args.num_class] * args.num_class)
-      x = torch.randn([args.batch_size, args.num_class]) + one_hot.sample_n(args.batch_size) # logits
-      x = x.cuda()
+      x, _ = code_sampler.next() # logits
       prob_gt = nn.functional.softmax(x, dim=1) # prob, ground truth
       
-      # forward
-      if args.mode == "BD":
-        feats1, feats2 = ae(x)
-      elif args.mode == "SE":
-        feats1, small_feats1, feats2 = ae(x) # feats1: feats from encoder. small_feats1: feats from small encoder. feats2: feats from encoder.
-      
-      # code loss: cross entropy
-      if args.mode == "BD":
-        logits1 = feats1[-1]; logprob_1 = nn.functional.log_softmax(logits1, dim=1) 
-        logits2 = feats2[-1]; logprob_2 = nn.functional.log_softmax(logits2, dim=1)
-        closs1 = nn.KLDivLoss()(logprob_1, prob_gt.data) * args.closs_weight * closs_lw[0]
-        closs2 = nn.KLDivLoss()(logprob_2, prob_gt.data) * args.closs_weight * closs_lw[1]
-        # perceptual loss
-        ploss1 = loss_func(feats2[0], feats1[0].data) * args.ploss_weight * ploss_lw[0]
-        ploss2 = loss_func(feats2[1], feats1[1].data) * args.ploss_weight * ploss_lw[1]
-        ploss3 = loss_func(feats2[2], feats1[2].data) * args.ploss_weight * ploss_lw[2]
-        ploss4 = loss_func(feats2[3], feats1[3].data) * args.ploss_weight * ploss_lw[3]
-        ploss5 = loss_func(feats2[4], feats1[4].data) * args.ploss_weight * ploss_lw[4]
-        ploss6 = loss_func(feats2[5], feats1[5].data) * args.ploss_weight * ploss_lw[5]
-        ploss7 = loss_func(feats2[6], feats1[6].data) * args.ploss_weight * ploss_lw[6]
-        # total loss
-        loss = closs1 + closs2 + ploss1 + ploss2 + ploss3 + ploss4 + ploss5 + ploss6 + ploss7
-      
-      elif args.mode == "SE":
-        logits1 = small_feats1[-1]; logprob_1 = nn.functional.log_softmax(logits1, dim=1)
-        logits2 =       feats2[-1]; logprob_2 = nn.functional.log_softmax(logits2, dim=1)
-        closs1 = nn.KLDivLoss()(logprob_1, prob_gt.data) * args.closs_weight * closs_lw[0]
-        closs2 = nn.KLDivLoss()(logprob_2, prob_gt.data) * args.closs_weight * closs_lw[1]
-        # feature reconstruction loss
-        floss1 = loss_func(small_feats1[0], feats1[0].data) * args.floss_weight * floss_lw[0]
-        floss2 = loss_func(small_feats1[1], feats1[1].data) * args.floss_weight * floss_lw[1]
-        floss3 = loss_func(small_feats1[2], feats1[2].data) * args.floss_weight * floss_lw[2]
-        floss4 = loss_func(small_feats1[3], feats1[3].data) * args.floss_weight * floss_lw[3]
-        floss5 = loss_func(small_feats1[4], feats1[4].data) * args.floss_weight * floss_lw[4]
-        floss6 = loss_func(small_feats1[5], feats1[5].data) * args.floss_weight * floss_lw[5]
-        floss7 = loss_func(small_feats1[6], feats1[6].data) * args.floss_weight * floss_lw[6]
-        # perceptual loss
-        ploss1 = loss_func(feats2[0], feats1[0].data) * args.ploss_weight * ploss_lw[0]
-        ploss2 = loss_func(feats2[1], feats1[1].data) * args.ploss_weight * ploss_lw[1]
-        ploss3 = loss_func(feats2[2], feats1[2].data) * args.ploss_weight * ploss_lw[2]
-        ploss4 = loss_func(feats2[3], feats1[3].data) * args.ploss_weight * ploss_lw[3]
-        ploss5 = loss_func(feats2[4], feats1[4].data) * args.ploss_weight * ploss_lw[4]
-        ploss6 = loss_func(feats2[5], feats1[5].data) * args.ploss_weight * ploss_lw[5]
-        ploss7 = loss_func(feats2[6], feats1[6].data) * args.ploss_weight * ploss_lw[6]
-        # total loss
-        loss = closs1 + closs2 + \
-               ploss1 + ploss2 + ploss3 + ploss4 + ploss5 + ploss6 + ploss7 + \
-               floss1 + floss2 + floss3 + floss4 + floss5 + floss6 + floss7
-      
+      with autocast(args): # the forwards and losses in bfloat16 with --amp. The backward runs outside.
+        # forward
+        if args.mode == "BD":
+          feats1, feats2 = ae(x)
+        elif args.mode == "SE":
+          feats1, small_feats1, feats2 = ae(x) # feats1: feats from encoder. small_feats1: feats from small encoder. feats2: feats from encoder.
+        
+        # code loss: KL, perceptual loss (rec2 vs rec1) and, for SE, feature reconstruction loss (small encoder vs encoder)
+        show = step % SHOW_INTERVAL == 0
+        if args.mode == "BD":
+          losses1 = loss_rec1_fn(logits=feats1[-1], prob_target=prob_gt, extra_terms=["soft"] * show)
+        elif args.mode == "SE":
+          losses1 = loss_rec1_fn(logits=small_feats1[-1], prob_target=prob_gt, feats_se=small_feats1, feats_ref=feats1, extra_terms=["soft", "feat"] * show)
+        losses2 = loss_rec2_fn(logits=feats2[-1], prob_target=prob_gt, feats_rec=feats2, feats_ref=feats1, extra_terms=["soft", "perc"] * show)
+        loss = losses1["total"] + losses2["total"]
+        
       optimizer.zero_grad()
       loss.backward()
       
@@ -203,34 +179,33 @@ if __name__ == "__main__":
       optimizer.step()
 
       if step % SHOW_INTERVAL == 0:
+        closs = [losses1["soft"] * args.closs_weight * closs_lw[0], losses2["soft"] * args.closs_weight * closs_lw[1]]
+        ploss = [losses2["perc%s" % k] * args.ploss_weight * ploss_lw[k-1] for k in range(1, 8)]
         if args.mode == "BD":
           format_str = "E{}S{} loss={:.3f} | closs: {:.5f} {:.5f} | ploss: {:.5f} {:.5f} {:.5f} {:.5f} {:.5f} {:.5f} {:.5f} ({:.3f}s/step)"
-          logprint(format_str.format(epoch, step, loss.data.cpu().numpy(), closs1.data.cpu().numpy(), closs2.data.cpu().numpy(),
-              ploss1.data.cpu().numpy(), ploss2.data.cpu().numpy(), ploss3.data.cpu().numpy(), ploss4.data.cpu().numpy(), ploss5.data.cpu().numpy(),
-              ploss6.data.cpu().numpy(), ploss7.data.cpu().numpy(),
+          logprint(format_str.format(epoch, step, loss.item(), *[l.item() for l in closs + ploss],
               (time.time()-t1)/SHOW_INTERVAL), log)
         elif args.mode == "SE":
+          floss = [losses1["feat%s" % k] * args.floss_weight * floss_lw[k-1] for k in range(1, 8)]
           format_str = "E{}S{} loss={:.3f} | closs: {:.5f} {:.5f} | floss: {:.5f} {:.5f} {:.5f} {:.5f} {:.5f} {:.5f} {:.5f} | ploss: {:.5f} {:.5f} {:.5f} {:.5f} {:.5f} {:.5f} {:.5f} ({:.3f}s/step)"
-          logprint(format_str.format(epoch, step, loss.data.cpu().numpy(), closs1.data.cpu().numpy(), closs2.data.cpu().numpy(),
-              floss1.data.cpu().numpy(), floss2.data.cpu().numpy(), floss3.data.cpu().numpy(), floss4.data.cpu().numpy(), floss5.data.cpu().numpy(), floss6.data.cpu().numpy(), floss7.data.cpu().numpy(),
-              ploss1.data.cpu().numpy(), ploss2.data.cpu().numpy(), ploss3.data.cpu().numpy(), ploss4.data.cpu().numpy(), ploss5.data.cpu().numpy(), ploss6.data.cpu().numpy(), ploss7.data.cpu().numpy(),
+          logprint(format_str.format(epoch, step, loss.item(), *[l.item() for l in closs + floss + ploss],
               (time.time()-t1)/SHOW_INTERVAL), log)
         
         t1 = time.time()
       
       if step % SAVE_INTERVAL == 0:
-        for i in range(len(test_codes)):
-          x = test_codes[i].cuda()
-          img1 = ae.dec(x)
+        # save some samples to check: all the test codes in one pass, written as one grid (row 1: rec1, row 2: rec2)
+        with torch.no_grad():
+          img1 = ae.dec(test_codes.to(device))
           img2 = ae.dec(ae.enc(img1))
-          out_img1_path = pjoin(rec_img_path, "%s_E%sS%s_img%s-rec1.jpg" % (TIME_ID, epoch, step, i))
-          out_img2_path = pjoin(rec_img_path, "%s_E%sS%s_img%s-rec2.jpg" % (TIME_ID, epoch, step, i))
-          vutils.save_image(img1.data.cpu().float(), out_img1_path) # save some samples to check
-          vutils.save_image(img2.data.cpu().float(), out_img2_path) # save some samples to check
+        out_img_path = pjoin(rec_img_path, "%s_E%sS%s_rec1_rec2.jpg" % (TIME_ID, epoch, step))
+        sample_writer.save(torch.cat([img1, img2]), out_img_path, nrow=len(test_codes), key="E%sS%s" % (epoch, step), labels=randperm)
         
         # save model
         if args.mode == "BD":
-          torch.save(ae.dec.state_dict(), pjoin(weights_path, "%s_%s_E%sS%s.pth" % (TIME_ID, args.mode, epoch, step)))
+          ckpt_writer.save(ae.dec.state_dict(), pjoin(weights_path, "%s_%s_E%sS%s.pth" % (TIME_ID, args.mode, epoch, step)))
         elif args.mode == "SE":
-          torch.save(ae.small_enc.state_dict(), pjoin(weights_path, "%s_%s_E%sS%s.pth" % (TIME_ID, args.mode, epoch, step)))
+          ckpt_writer.save(ae.small_enc.state_dict(), pjoin(weights_path, "%s_%s_E%sS%s.pth" % (TIME_ID, args.mode, epoch, step)))
+  ckpt_writer.close()
+  sample_writer.close()
   log.close()
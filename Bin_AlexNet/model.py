@@ -3,7 +3,7 @@ import numpy as np
 import os
 import torch.nn as nn
 import torch
-from torch.utils.serialization import load_lua
+from common.act_checkpoint import CHECKPOINT_MODES, run_stages # CHECKPOINT_MODES for the --act_checkpoint choices
 pjoin = os.path.join
 
 class AlexNet_Encoder(nn.Module):
@@ -25,7 +25,7 @@ class AlexNet_Encoder(nn.Module):
     self.pool = nn.MaxPool2d(kernel_size=3, stride=2, padding=0, dilation=1, ceil_mode=False)
     
     if model:
-      self.load_state_dict(torch.load(model))
+      self.load_state_dict(torch.load(model, map_location="cpu"))
     if fixed:
       for param in self.parameters():
           param.requires_grad = False
@@ -39,7 +39,7 @@ class AlexNet_Encoder(nn.Module):
     y = self.relu(self.conv4(y)); #print(y.shape)
     y = self.relu(self.conv5(y)); #print(y.shape)
     y = self.pool(y); #print(y.shape)
-    y = y.view(y.size(0), -1); #print(y.shape)
+    y = y.reshape(y.size(0), -1); #print(y.shape)
     y = self.relu(self.fc6(self.drop6(y))); #print(y.shape)
     y = self.relu(self.fc7(self.drop7(y))); #print(y.shape)
     y = self.fc8(y); #print(y.shape)
@@ -52,7 +52,7 @@ class AlexNet_Encoder(nn.Module):
     y = self.relu(self.conv3(y)); out3 = y
     y = self.relu(self.conv4(y)); out4 = y
     y = self.pool(self.relu(self.conv5(y))); out5 = y
-    y = y.view(y.size(0), -1)
+    y = y.reshape(y.size(0), -1)
     y = self.relu(self.fc6(self.drop6(y))); out6 = y
     y = self.relu(self.fc7(self.drop7(y))); out7 = y
     y = self.fc8(y)
@@ -77,7 +77,7 @@ class AlexNet_SmallEncoder(nn.Module):
     self.pool = nn.MaxPool2d(kernel_size=3, stride=2, padding=0, dilation=1, ceil_mode=False)
     
     if model:
-      self.load_state_dict(torch.load(model))
+      self.load_state_dict(torch.load(model, map_location="cpu"))
     if fixed:
       for param in self.parameters():
           param.requires_grad = False
@@ -91,7 +91,7 @@ class AlexNet_SmallEncoder(nn.Module):
     y = self.relu(self.conv4(y))
     y = self.relu(self.conv5(y))
     y = self.pool(y)
-    y = y.view(y.size(0), -1)
+    y = y.reshape(y.size(0), -1)
     y = self.relu(self.fc6(self.drop6(y)))
     y = self.relu(self.fc7(self.drop7(y)))
     y = self.fc8(y)
@@ -104,7 +104,7 @@ class AlexNet_SmallEncoder(nn.Module):
     y = self.relu(self.conv3(y)); out3 = y
     y = self.relu(self.conv4(y)); out4 = y
     y = self.pool(self.relu(self.conv5(y))); out5 = y
-    y = y.view(y.size(0), -1)
+    y = y.reshape(y.size(0), -1)
     y = self.relu(self.fc6(self.drop6(y))); out6 = y
     y = self.relu(self.fc7(self.drop7(y))); out7 = y
     y = self.fc8(y)
@@ -112,9 +112,10 @@ class AlexNet_SmallEncoder(nn.Module):
     
     
 class AlexNet_Decoder(nn.Module):
-  def __init__(self, model=None, fixed=False):
+  def __init__(self, model=None, fixed=False, checkpoint="none"):
     super(AlexNet_Decoder, self).__init__()
     self.fixed = fixed
+    self.checkpoint = checkpoint # see run_stages
     self.fc8 = nn.Linear(1000, 4096)
     self.fc7 = nn.Linear(4096, 4096)
     self.fc6 = nn.Linear(4096, 9216)
@@ -133,52 +134,72 @@ class AlexNet_Decoder(nn.Module):
     self.pad5 = nn.ReflectionPad2d((5,5,5,5))
     
     if model:
-      self.load_state_dict(torch.load(model))
+      self.load_state_dict(torch.load(model, map_location="cpu"))
     if fixed:
       for param in self.parameters():
           param.requires_grad = False
       
   def forward(self, y):
+    return run_stages([self.forward_fc, self.forward_conv5, self.forward_conv4, self.forward_conv3,
+                       self.forward_conv2, self.forward_conv1], y, self.checkpoint)
+  
+  # the stages of forward, each up to a full-resolution activation
+  def forward_fc(self, y):
     y = self.relu(self.fc8(y))
     y = self.relu(self.fc7(y))
     y = self.relu(self.fc6(y))
-    y = y.view(-1, 256, 6, 6)
+    return y.view(-1, 256, 6, 6)
+    
+  def forward_conv5(self, y):
     y = self.unpool(y)                      # (1, 256, 12, 12)
     y = self.pad1(y)                        # (1, 256, 14, 14)
-    y = self.relu(self.conv5(self.pad1(y))) # (1, 256, 14, 14)
+    return self.relu(self.conv5(self.pad1(y))) # (1, 256, 14, 14)
+  
+  def forward_conv4(self, y):
     y = self.unpool(y)                      # (1, 256, 28, 28)
-    y = self.relu(self.conv4(self.pad1(y))) # (1, 384, 28, 28)
+    return self.relu(self.conv4(self.pad1(y))) # (1, 384, 28, 28)
+  
+  def forward_conv3(self, y):
     y = self.unpool(y)                      # (1, 256, 56, 56)
-    y = self.relu(self.conv3(self.pad1(y))) # (1, 192, 56, 56)
+    return self.relu(self.conv3(self.pad1(y))) # (1, 192, 56, 56)
+  
+  def forward_conv2(self, y):
     y = self.unpool(y)                      # (1, 192,112,112)
-    y = self.relu(self.conv2(self.pad2(y))) # (1,  64,112,112)
+    return self.relu(self.conv2(self.pad2(y))) # (1,  64,112,112)
+  
+  def forward_conv1(self, y):
     y = self.unpool(y)                      # (1,  64,224,224)
-    y = self.relu(self.conv1(self.pad5(y))) # (1,   3,224,224)
-    return y
+    return self.relu(self.conv1(self.pad5(y))) # (1,   3,224,224)
 
     
 class AutoEncoder_BD(nn.Module):
-  def __init__(self, e1=None, d=None, e2=None):
+  def __init__(self, e1=None, d=None, e2=None, checkpoint="none"):
     super(AutoEncoder_BD, self).__init__()
+    self.checkpoint = checkpoint
     self.enc = AlexNet_Encoder(e1, fixed=True).eval() # note to use the 'eval' mode to keep dropout fixed
-    self.dec = AlexNet_Decoder(d, fixed=False)
+    self.dec = AlexNet_Decoder(d, fixed=False, checkpoint=checkpoint)
   def forward(self, code):
-    feats1 = self.enc.forward_branch(self.dec(code))
-    feats2 = self.enc.forward_branch(self.dec(feats1[-1]))
+    feats1 = self.encode(self.dec(code))
+    feats2 = self.encode(self.dec(feats1[-1]))
     return feats1, feats2
+  def encode(self, img): # the encoder taps of a reconstruction. With checkpointing, only the taps are kept.
+    return run_stages([self.enc.forward_branch], img, "none" if self.checkpoint == "none" else "all")
     
 class AutoEncoder_SE(nn.Module):
-  def __init__(self, e1=None, d=None, e2=None):
+  def __init__(self, e1=None, d=None, e2=None, checkpoint="none"):
     super(AutoEncoder_SE, self).__init__()
+    self.checkpoint = checkpoint
     self.enc = AlexNet_Encoder(e1, fixed=True).eval()
-    self.dec = AlexNet_Decoder(d,  fixed=True).eval()
+    self.dec = AlexNet_Decoder(d,  fixed=True, checkpoint=checkpoint).eval()
     self.small_enc = AlexNet_SmallEncoder(e2, fixed=False)
   def forward(self, code):
     img1 = self.dec(code)
     feats1 = self.enc.forward_branch(img1)
     small_feats1 = self.small_enc.forward_branch(img1)
-    feats2 = self.enc.forward_branch(self.dec(small_feats1[-1]))
+    feats2 = self.encode(self.dec(small_feats1[-1]))
     return feats1, small_feats1, feats2
+  def encode(self, img):
+    return run_stages([self.enc.forward_branch], img, "none" if self.checkpoint == "none" else "all")
     
 AutoEncoders = {
 "BD": AutoEncoder_BD,
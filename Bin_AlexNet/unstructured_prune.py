@@ -16,7 +16,6 @@ import math
 # torch
 import torch
 import torch.nn as nn
-from torch.utils.serialization import load_lua
 import torch.utils.data as Data
 from torch.utils.data import DataLoader
 import torchvision
@@ -25,6 +24,7 @@ import torchvision.transforms as transforms
 import torch.optim as optim
 from torch.autograd import Variable
 # my libs
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # the repo root, for the shared modules in common/
 from model import AlexNet_Encoder
 
 # Passed-in params
@@ -0,0 +1,74 @@
+from __future__ import print_function
+import sys
+import os
+import copy
+import time
+import argparse
+# torch
+import torch
+# my libs
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # the repo root, for the shared modules in common/
+from model import AutoEncoders
+from train_step import add_step_args, GANStep
+from common.device import add_device_args, set_up_device, to_device
+from common.jit import add_compile_args, set_up_compile, compile_model
+from common.timing import add_timing_args, StepTimer
+from common.sampler import CodeSampler
+
+# Step time of the GAN4 training step of main.py (GANStep of train_step.py: codemap + decoder update, then SE update),
+# eager vs. compiled, for the CIFAR10 or the MNIST config. The step args are the ones of main.py, with the same
+# defaults. The models have random weights, so no pretrained file is needed. e.g.,
+#   python benchmark_compile.py --dataset CIFAR10 --compile inductor --num_step 20
+
+# Passed-in params
+parser = argparse.ArgumentParser(description="Eager vs. compiled step time")
+parser.add_argument('--dataset', type=str, default="CIFAR10")
+parser.add_argument('--num_class', type=int, default=10)
+parser.add_argument('--num_z', type=int, default=100, help="the dimension of hidden z")
+parser.add_argument('-b', '--batch_size', type=int, default=128)
+parser.add_argument('--deep_lenet5', type=str, default="00")
+parser.add_argument('--num_step', type=int, default=20, help="the number of timed steps")
+parser.add_argument('--num_warmup', type=int, default=5, help="the number of untimed steps before timing. The compilation happens in them")
+add_step_args(parser)
+add_device_args(parser)
+add_compile_args(parser)
+add_timing_args(parser)
+args = parser.parse_args()
+assert(args.dataset in ["MNIST", "CIFAR10"])
+if args.compile == "none":
+  args.compile = "inductor"
+# the GAN4 set-up of main.py
+args.mode = "GAN4"; args.num_divbranch = 1; args.world_size = 1; args.rank = 0
+args.e1 = None; args.e2 = None; args.pretrained_dir = None; args.use_condition = False; args.gray = False; args.act_checkpoint = "none"
+device = set_up_device(args)
+
+def sync():
+  if device.type == "cuda":
+    torch.cuda.synchronize()
+
+def benchmark(ae, name):
+  gan_step = GANStep(ae, args, StepTimer(args, device))
+  x, label = CodeSampler(args.batch_size, args.num_class, device, num_z=args.num_z, paired=bool(args.lw_msgan)).next()
+  ae.train()
+  t0 = time.time()
+  for _ in range(args.num_warmup):
+    gan_step(x, label)
+  sync(); t1 = time.time()
+  for _ in range(args.num_step):
+    gan_step(x, label)
+  sync(); t2 = time.time()
+  step_time = (t2 - t1) / args.num_step
+  print("%-10s warm-up: %.2fs  step: %.2fms" % (name, t1 - t0, step_time * 1000))
+  return step_time
+
+if __name__ == "__main__":
+  torch.manual_seed(0)
+  eager = to_device(AutoEncoders[args.mode](args), args)
+  compiled = copy.deepcopy(eager)
+  print("%s GAN4 step, batch size %s, on %s" % (args.dataset, args.batch_size, device))
+  t_eager = benchmark(eager, "eager")
+  set_up_compile(args)
+  for m in [compiled.codemap, compiled.be] + list(compiled.decs) + list(compiled.ses): # the models main.py compiles
+    compile_model(m, args)
+  t_compiled = benchmark(compiled, args.compile)
+  print("speedup: %.2fx" % (t_eager / t_compiled))
@@ -2,7 +2,7 @@ import torch
 import torchvision.transforms as transforms
 import torchvision.datasets as datasets
 
-def set_up_data(dataset, train_batch_size):
+def set_up_data(dataset, train_batch_size, pin_memory=True, use_train_loader=True):
   # ref: https://github.com/chengyangfu/pytorch-vgg-cifar10/blob/master/main.py
   if dataset == "CIFAR10":
     normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
@@ -31,7 +31,23 @@ def set_up_data(dataset, train_batch_size):
                                   transforms.ToTensor(),
                                   transforms.Normalize((0.1307,), (0.3081,))]))
                             
-  kwargs = {'num_workers': 4, 'pin_memory': True}
-  train_loader = torch.utils.data.DataLoader(data_train, batch_size=train_batch_size, shuffle=True, **kwargs)
+  kwargs = {'num_workers': 4, 'pin_memory': pin_memory} # pinned memory only helps the copy to GPU
+  train_loader = torch.utils.data.DataLoader(data_train, batch_size=train_batch_size, shuffle=True, **kwargs) if use_train_loader else None
   test_loader = torch.utils.data.DataLoader(data_test, batch_size=100, shuffle=False, **kwargs)
-  return train_loader, len(data_train), test_loader, len(data_test)
\ No newline at end of file
+  return train_loader, len(data_train), test_loader, len(data_test)
+
+def get_batches(loader, num_step):
+  '''
+    Yield 'num_step' batches from 'loader', restarting it when it runs out.
+    Without a loader (data-free training), yield (None, None), so no worker processes are started.
+  '''
+  data_iter = iter(loader) if loader else None
+  for _ in range(num_step):
+    if data_iter is None:
+      yield None, None
+      continue
+    try:
+      yield next(data_iter)
+    except StopIteration:
+      data_iter = iter(loader)
+      yield next(data_iter)
@@ -0,0 +1,86 @@
+from __future__ import print_function
+import sys
+import os
+import time
+import argparse
+# torch
+import torch
+import torch.nn as nn
+# my libs
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # the repo root, for the shared modules in common/
+from model import AutoEncoders
+from common.device import add_device_args, set_up_device, to_device, autocast
+from common.sampler import CodeSampler
+from common.shards import ShardWriter
+from util import check_path, find_weights, pretrained_be_path
+pjoin = os.path.join
+
+# Export a synthetic dataset from an experiment of main.py: the images of the trained d1 (fed through the trained
+# codemap), with the logits of the teacher (BE), as memory-mapped .npy shards (see common/shards.py). The shards feed
+# train_student.py, so the decoder and the teacher are run once for any number of student runs. e.g.,
+#   python export_data.py --dataset CIFAR10 --weights_dir ../Experiments/<ExpID>_<project_name>/weights --num_sample 1000000
+# The model args (--dataset, --num_z, --use_condition, --num_divbranch, etc.) must be those of the experiment.
+
+# Passed-in params
+parser = argparse.ArgumentParser(description="Export a synthetic dataset")
+parser.add_argument('--weights_dir', type=str, required=True, help="the weights directory of the experiment")
+parser.add_argument('--key', type=str, default=None, help="the checkpoint to load, e.g., E10S0. Default: the latest")
+parser.add_argument('--e1', type=str, default=None, help="the teacher. Default: the one of main.py")
+parser.add_argument('--out_dir', type=str, default=None, help="Default: synthetic_data_<checkpoint> beside the weights directory")
+parser.add_argument('--num_sample', type=int, default=100000)
+parser.add_argument('--shard_size', type=int, default=50000, help="the number of samples in a shard")
+parser.add_argument('--img_dtype', type=str, default="float16", choices=["float16", "float32"])
+parser.add_argument('-b', '--batch_size', type=int, default=1000)
+parser.add_argument('--num_class', type=int, default=10)
+parser.add_argument('--num_z', type=int, default=100, help="the dimension of hidden z")
+parser.add_argument('--num_divbranch', type=int, default=1)
+parser.add_argument('--dataset', type=str, default="MNIST")
+parser.add_argument('--use_condition', action="store_true")
+parser.add_argument('--gray', action="store_true")
+parser.add_argument('--deep_lenet5', type=str, default="00")
+add_device_args(parser)
+args = parser.parse_args()
+assert(args.dataset in ["MNIST", "CIFAR10"])
+if args.e1 == None:
+  key = args.dataset if args.dataset == "CIFAR10" else "MNIST" + "_deep" * int(args.deep_lenet5[0])
+  args.e1 = pretrained_be_path[key]
+args.e1 = check_path(args.e1)
+# the GAN4 set-up of main.py, with one decoder
+args.mode = "GAN4"; args.num_dec = 1; args.num_se = 1
+args.e2 = None; args.pretrained_dir = None; args.act_checkpoint = "none"
+num_channel = 1 if args.dataset == "MNIST" else 3
+device = set_up_device(args)
+
+if __name__ == "__main__":
+  # Set up model
+  ae = AutoEncoders[args.mode](args)
+  d1_path = find_weights(args.weights_dir, "d1", args.key)
+  codemap_path = find_weights(args.weights_dir, "codemap", args.key)
+  assert(d1_path != None)
+  ae.decs[0].load_state_dict(torch.load(d1_path, map_location="cpu"))
+  if codemap_path:
+    ae.codemap.load_state_dict(torch.load(codemap_path, map_location="cpu"))
+  else: # the experiments before the codemap was saved
+    ae.codemap = nn.Identity()
+  ae = to_device(ae, args).eval()
+  print("decoder: %s\ncodemap: %s\nteacher: %s" % (d1_path, codemap_path, args.e1))
+
+  # Generate and write
+  if args.out_dir == None:
+    name = os.path.splitext(os.path.basename(d1_path))[0].split("_")[2]
+    args.out_dir = pjoin(os.path.dirname(os.path.abspath(args.weights_dir)), "synthetic_data_" + name)
+  writer = ShardWriter(args.out_dir, args.num_sample, (num_channel, 32, 32), args.num_class, args.shard_size, args.img_dtype)
+  code_sampler = CodeSampler(args.batch_size, args.num_class, device, num_z=args.num_z, condition=args.use_condition)
+  t1 = time.time(); step = 0
+  with torch.no_grad(), autocast(args):
+    while writer.num_written < args.num_sample:
+      x, code_label = code_sampler.next()
+      for imgrec in torch.split(ae.decs[0](ae.codemap(x)), num_channel, dim=1): # branches
+        logits = ae.be(imgrec)
+        label = code_label if args.use_condition else logits.argmax(dim=1)
+        writer.write(imgrec, logits, label)
+      step += 1
+      if step % 10 == 0:
+        print("%s / %s samples (%.1f samples/s)" % (writer.num_written, args.num_sample, writer.num_written / (time.time() - t1)))
+  writer.close(d1=d1_path, codemap=codemap_path, e1=args.e1, dataset=args.dataset)
+  print("%s samples written to %s (%.1fs)" % (writer.num_written, args.out_dir, time.time() - t1))
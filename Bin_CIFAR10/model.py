@@ -4,27 +4,14 @@ import os
 import copy
 import torch.nn as nn
 import torch
-from torch.utils.serialization import load_lua
 from torch.distributions.one_hot_categorical import OneHotCategorical
 from torchvision import transforms
 import torch.nn.functional as F
 from torch.autograd import Variable
 import math
+from common.act_checkpoint import CHECKPOINT_MODES, run_stages # CHECKPOINT_MODES for the --act_checkpoint choices
 pjoin = os.path.join
 
-# Exponential Moving Average
-class EMA():
-  def __init__(self, mu):
-    self.mu = mu
-    self.shadow = {}
-  def register(self, name, val):
-    self.shadow[name] = val.clone()
-  def __call__(self, name, x):
-    assert name in self.shadow
-    new_average = (1.0 - self.mu) * x + self.mu * self.shadow[name]
-    self.shadow[name] = new_average.clone()
-    return new_average
-
 ################# CIFAR10 #################
 def preprocess_image(pil_im, resize_im=True):
     """
@@ -107,6 +94,14 @@ def make_layers(cfg, batch_norm=False):
       in_channels = v
   return nn.Sequential(*layers)
   
+def split_stages(seq): # split a Sequential before each upsampling layer
+  stages = []
+  for m in seq:
+    if isinstance(m, nn.Upsample) or not stages:
+      stages.append([])
+    stages[-1].append(m)
+  return [nn.Sequential(*stage) for stage in stages]
+
 def make_layers_dec(cfg, batch_norm=False):
   layers = []
   in_channels = 512
@@ -187,7 +182,7 @@ class VGG19(nn.Module):
         self.branch_layer.append("f" + str(i))
     
     if model:
-     checkpoint = torch.load(model)
+     checkpoint = torch.load(model, map_location="cpu")
      self.load_state_dict(checkpoint["state_dict"])
     else:
       for m in self.modules():
@@ -201,7 +196,7 @@ class VGG19(nn.Module):
     
   def forward(self, x):
     x = self.features(x)
-    x = x.view(x.size(0), -1)
+    x = x.reshape(x.size(0), -1)
     x = self.classifier(x)
     return x
   
@@ -212,7 +207,7 @@ class VGG19(nn.Module):
       x = m(x)
       if "f" + str(i) in self.branch_layer:
         y.append(x)
-    x = x.view(x.size(0), -1)
+    x = x.reshape(x.size(0), -1)
     x = self.classifier(x)
     y.append(x)
     return y
@@ -231,7 +226,7 @@ class SmallVGG19(nn.Module):
       nn.Linear(512, 10),
     )
     if model:
-     checkpoint = torch.load(model)
+     checkpoint = torch.load(model, map_location="cpu")
      self.load_state_dict(checkpoint)
     else:
       for m in self.modules():
@@ -245,7 +240,7 @@ class SmallVGG19(nn.Module):
           
   def forward(self, x):
     x = self.features(x)
-    x = x.view(x.size(0), -1)
+    x = x.reshape(x.size(0), -1)
     x = self.classifier(x)
     return x
 
@@ -264,8 +259,9 @@ class Normalize_CIFAR10(nn.Module):
     return self.normalize(x)
     
 class DVGG19(nn.Module):
-  def __init__(self, input_dim, model=None, fixed=None, gray=False, num_divbranch=1):
+  def __init__(self, input_dim, model=None, fixed=None, gray=False, num_divbranch=1, checkpoint="none"):
     super(DVGG19, self).__init__()
+    self.checkpoint = checkpoint # see run_stages
     self.classifier = nn.Sequential(
       nn.Linear(input_dim, 512),
       nn.ReLU(True),
@@ -276,9 +272,10 @@ class DVGG19(nn.Module):
     )
     self.gray = gray
     self.features = make_layers_dec(cfg["Dec_gray"]) if gray else make_layers_dec(cfg["Dec_s"], batch_norm=True)
+    self.feature_stages = split_stages(self.features)
 
     if model:
-     checkpoint = torch.load(model)
+     checkpoint = torch.load(model, map_location="cpu")
      self.load_state_dict(checkpoint)
     else:
       for m in self.modules():
@@ -292,16 +289,19 @@ class DVGG19(nn.Module):
           param.requires_grad = False
           
   def forward(self, x):
-    x = self.classifier(x)
-    x = x.view(x.size(0), 512, 1, 1)
-    x = self.features(x)
+    x = run_stages([self.forward_code] + self.feature_stages, x, self.checkpoint, self)
     x = torch.stack([x]*3, dim=1).squeeze(2) if self.gray else x
     return x
+  
+  def forward_code(self, x):
+    x = self.classifier(x)
+    return x.view(x.size(0), 512, 1, 1)
 
 # mimic the net architecture of MNIST deconv
 class DVGG19_deconv(nn.Module):
-  def __init__(self, input_dim, model=None, fixed=False, gray=False, num_divbranch=1):
+  def __init__(self, input_dim, model=None, fixed=False, gray=False, num_divbranch=1, checkpoint="none"):
     super(DVGG19_deconv, self).__init__()
+    self.checkpoint = checkpoint # see run_stages
     img_size = 32
     num_channel = 3
     self.init_size = img_size // 4
@@ -320,15 +320,17 @@ class DVGG19_deconv(nn.Module):
         nn.BatchNorm2d(num_channel, 0.8), # Ref: Huawei's paper. They add a BN layer at the end of the generator.
         nn.Tanh(),
     )
+    self.conv_stages = split_stages(self.conv_blocks)
   def forward(self, z):
+      return run_stages([self.forward_code] + self.conv_stages, z, self.checkpoint, self)
+  def forward_code(self, z):
       out = self.l1(z)
-      out = out.view(out.shape[0], 128, self.init_size, self.init_size)
-      img = self.conv_blocks(out)
-      return img
+      return out.view(out.shape[0], 128, self.init_size, self.init_size)
     
 class DVGG19_aug(nn.Module): # augmented DVGG19
-  def __init__(self, input_dim, model=None, fixed=None, gray=False, num_divbranch=1):
+  def __init__(self, input_dim, model=None, fixed=None, gray=False, num_divbranch=1, checkpoint="none"):
     super(DVGG19_aug, self).__init__()
+    self.checkpoint = checkpoint # see run_stages
     self.classifier = nn.Sequential(
       nn.Linear(input_dim, 512),
       nn.ReLU(True),
@@ -339,12 +341,13 @@ class DVGG19_aug(nn.Module): # augmented DVGG19
     )
     self.gray = gray
     self.features = make_layers_augdec(cfg["Dec_s_aug"], True, num_divbranch)
+    self.feature_stages = split_stages(self.features)
     self.classifier_num_module = len(self.classifier)
     self.features_num_module = len(self.features)
     self.branch_layer = ["c5", "f3", "f10", "f17", "f24", "f31"]
     
     if model:
-     checkpoint = torch.load(model)
+     checkpoint = torch.load(model, map_location="cpu")
      self.load_state_dict(checkpoint)
     else:
       for m in self.modules():
@@ -358,11 +361,13 @@ class DVGG19_aug(nn.Module): # augmented DVGG19
           param.requires_grad = False
           
   def forward(self, x):
-    x = self.classifier(x)
-    x = x.view(x.size(0), 512, 1, 1)
-    x = self.features(x)
+    x = run_stages([self.forward_code] + self.feature_stages, x, self.checkpoint, self)
     x = torch.stack([x] * 3, dim=1).squeeze(2) if self.gray else x
     return x
+  
+  def forward_code(self, x):
+    x = self.classifier(x)
+    return x.view(x.size(0), 512, 1, 1)
     
   def forward_branch(self, x):
     y = []
@@ -395,7 +400,7 @@ class DVGG19_meta(nn.Module):
     self.features = make_layers_dec(cfg["Dec_meta"], batch_norm=True)
     
     if model:
-      checkpoint = torch.load(model)
+      checkpoint = torch.load(model, map_location="cpu")
       self.load_state_dict(checkpoint)
     else:
       for m in self.modules():
@@ -427,7 +432,7 @@ class MaskNet(nn.Module):
     self.features = make_layers_dec(cfg["Mask"])
     
     if model:
-     checkpoint = torch.load(model)
+     checkpoint = torch.load(model, map_location="cpu")
      self.load_state_dict(checkpoint)
     else:
       for m in self.modules():
@@ -465,7 +470,7 @@ class MetaNet(nn.Module):
     self.tanh = nn.Tanh()
     
     if model:
-     checkpoint = torch.load(model)
+     checkpoint = torch.load(model, map_location="cpu")
      self.load_state_dict(checkpoint)
     else:
       for m in self.modules():
@@ -507,7 +512,7 @@ class MetaNet(nn.Module):
     # self.conv4 = nn.Conv2d(d, 3, 3, 1, 1)
     
     # if model:
-     # checkpoint = torch.load(model)
+     # checkpoint = torch.load(model, map_location="cpu")
      # self.load_state_dict(checkpoint)
     # else:
       # for m in self.modules():
@@ -545,8 +550,9 @@ class CodeMapping(nn.Module):
 
 # ref: https://github.com/eriklindernoren/PyTorch-GAN/blob/master/implementations/dcgan/dcgan.py
 class DLeNet5_deconv(nn.Module):
-  def __init__(self, input_dim, model=None, fixed=False, gray=False, num_divbranch=1):
+  def __init__(self, input_dim, model=None, fixed=False, gray=False, num_divbranch=1, checkpoint="none"):
     super(DLeNet5_deconv, self).__init__()
+    self.checkpoint = checkpoint # see run_stages
     img_size = 32
     num_channel = 1
     self.init_size = img_size // 4
@@ -565,11 +571,12 @@ class DLeNet5_deconv(nn.Module):
         nn.BatchNorm2d(num_channel, 0.8), # Ref: Huawei's paper. They add a BN layer at the end of the generator.
         nn.Tanh(),
     )
+    self.conv_stages = split_stages(self.conv_blocks)
   def forward(self, z):
+      return run_stages([self.forward_code] + self.conv_stages, z, self.checkpoint, self)
+  def forward_code(self, z):
       out = self.l1(z)
-      out = out.view(out.shape[0], 128, self.init_size, self.init_size)
-      img = self.conv_blocks(out)
-      return img
+      return out.view(out.shape[0], 128, self.init_size, self.init_size)
         
 class DLeNet5_upsample(nn.Module):
   def __init__(self, input_dim, model=None, fixed=False, gray=False, num_divbranch=1):
@@ -596,7 +603,7 @@ class DLeNet5_upsample(nn.Module):
     self.pad = nn.ReflectionPad2d((2,2,2,2))
 
     if model:
-      self.load_state_dict(torch.load(model))
+      self.load_state_dict(torch.load(model, map_location="cpu"))
     if fixed:
       for param in self.parameters():
           param.requires_grad = False
@@ -628,7 +635,7 @@ class LeNet5(nn.Module):
     self.relu = nn.ReLU(inplace=True)
     
     if model:
-      self.load_state_dict(torch.load(model))
+      self.load_state_dict(torch.load(model, map_location="cpu"))
     if fixed:
       for param in self.parameters():
         param.requires_grad = False
@@ -638,7 +645,7 @@ class LeNet5(nn.Module):
     y = self.pool1(y)            # 6x14x14
     y = self.relu(self.conv2(y)) # 16x10x10
     y = self.pool2(y)            # 16x5x5
-    y = y.view(y.size(0), -1)    # 400
+    y = y.reshape(y.size(0), -1)    # 400
     y = self.relu(self.fc3(y))   # 120
     y = self.relu(self.fc4(y))   # 84
     y = self.fc5(y)              # 10
@@ -649,7 +656,7 @@ class LeNet5(nn.Module):
     y = self.pool1(y)
     y = self.relu(self.conv2(y)); out2 = y
     y = self.pool2(y)
-    y = y.view(y.size(0), -1)
+    y = y.reshape(y.size(0), -1)
     y = self.relu(self.fc3(y)); out3 = y
     y = self.relu(self.fc4(y)); out4 = y
     y = self.fc5(y)
@@ -674,7 +681,7 @@ class LeNet5(nn.Module):
     # self.relu = nn.ReLU(inplace=True)
     
     # if model:
-      # self.load_state_dict(torch.load(model))
+      # self.load_state_dict(torch.load(model, map_location="cpu"))
     # if fixed:
       # for param in self.parameters():
         # param.requires_grad = False
@@ -688,7 +695,7 @@ class LeNet5(nn.Module):
     # y = self.relu(self.conv14(y))
     # y = self.relu(self.conv2(y)) # 16x10x10
     # y = self.pool2(y)            # 16x5x5
-    # y = y.view(y.size(0), -1)    # 400
+    # y = y.reshape(y.size(0), -1)    # 400
     # y = self.relu(self.fc3(y))   # 120
     # y = self.relu(self.fc4(y))   # 84
     # y = self.fc5(y)              # 10
@@ -703,7 +710,7 @@ class LeNet5(nn.Module):
     # y = self.relu(self.conv14(y))
     # y = self.relu(self.conv2(y)); out2 = y
     # y = self.pool2(y)
-    # y = y.view(y.size(0), -1)
+    # y = y.reshape(y.size(0), -1)
     # y = self.relu(self.fc3(y)); out3 = y
     # y = self.relu(self.fc4(y)); out4 = y
     # y = self.fc5(y)
@@ -737,7 +744,7 @@ class LeNet5_deep(nn.Module):
     self.relu = nn.ReLU(inplace=True)
     
     if model:
-      self.load_state_dict(torch.load(model))
+      self.load_state_dict(torch.load(model, map_location="cpu"))
     if fixed:
       for param in self.parameters():
         param.requires_grad = False
@@ -760,7 +767,7 @@ class LeNet5_deep(nn.Module):
     # y = self.relu(self.conv113(y))
     y = self.relu(self.conv2(y)) # 16x10x10
     y = self.pool2(y)            # 16x5x5
-    y = y.view(y.size(0), -1)    # 400
+    y = y.reshape(y.size(0), -1)    # 400
     y = self.relu(self.fc3(y))   # 120
     y = self.relu(self.fc4(y))   # 84
     y = self.fc5(y)              # 10
@@ -784,7 +791,7 @@ class LeNet5_deep(nn.Module):
     # y = self.relu(self.conv113(y))
     y = self.relu(self.conv2(y)); out2 = y
     y = self.pool2(y)
-    y = y.view(y.size(0), -1)
+    y = y.reshape(y.size(0), -1)
     y = self.relu(self.fc3(y)); out3 = y
     y = self.relu(self.fc4(y)); out4 = y
     y = self.fc5(y)
@@ -805,7 +812,7 @@ class SmallLeNet5(nn.Module):
     self.relu = nn.ReLU(inplace=True)
     
     if model:
-      self.load_state_dict(torch.load(model))
+      self.load_state_dict(torch.load(model, map_location="cpu"))
     if fixed:
       for param in self.parameters():
           param.requires_grad = False
@@ -815,7 +822,7 @@ class SmallLeNet5(nn.Module):
     y = self.pool1(y)
     y = self.relu(self.conv2(y))
     y = self.pool2(y)
-    y = y.view(y.size(0), -1)
+    y = y.reshape(y.size(0), -1)
     y = self.relu(self.fc3(y))
     y = self.relu(self.fc4(y))
     y = self.fc5(y)
@@ -826,7 +833,7 @@ class SmallLeNet5(nn.Module):
     y = self.pool1(y)
     y = self.relu(self.conv2(y)); out2 = y
     y = self.pool2(y)
-    y = y.view(y.size(0), -1)
+    y = y.reshape(y.size(0), -1)
     y = self.relu(self.fc3(y)); out3 = y
     y = self.relu(self.fc4(y)); out4 = y
     y = self.fc5(y)
@@ -858,7 +865,7 @@ class SmallLeNet5(nn.Module):
     # y = self.relu(self.conv14(y))
     # y = self.relu(self.conv2(y))
     # y = self.pool2(y)
-    # y = y.view(y.size(0), -1)
+    # y = y.reshape(y.size(0), -1)
     # y = self.relu(self.fc3(y))
     # y = self.relu(self.fc4(y))
     # y = self.fc5(y)
@@ -908,7 +915,7 @@ class SmallLeNet5_deep(nn.Module):
     # y = self.relu(self.conv113(y))
     y = self.relu(self.conv2(y))
     y = self.pool2(y)
-    y = y.view(y.size(0), -1)
+    y = y.reshape(y.size(0), -1)
     y = self.relu(self.fc3(y))
     y = self.relu(self.fc4(y))
     y = self.fc5(y)
@@ -925,6 +932,27 @@ class Normalize_MNIST(nn.Module):
     return self.normalize(x)
     
 ################# Transform #################
+def random_shift(n, device, max_shift=2):
+  # Per-sample random whole-pixel shifts (dy, dx) in [-max_shift, max_shift]^2 other than (0, 0), uniformly, i.e.,
+  # the offsets of the one-hot (2*max_shift+1)^2 kernels of Transform4. Drawn on 'device'.
+  k = 2 * max_shift + 1
+  idx = torch.randint(k * k - 1, (n,), device=device)
+  idx = idx + (idx >= k * k // 2).long() # skip the center, i.e., no shift
+  return idx // k - max_shift, idx % k - max_shift
+
+def shift(x, dy, dx, max_shift=2):
+  '''
+    Per-sample whole-pixel translation of the batch 'x' with one gather: y[k, :, i, j] = x[k, :, i + dy[k], j + dx[k]],
+    0 out of the image. It is the same as the conv (padding 'max_shift') with the one-hot kernel at (dy + max_shift,
+    dx + max_shift). dy, dx: LongTensors of the batch size, in [-max_shift, max_shift].
+  '''
+  n, c, h, w = x.shape
+  xp = F.pad(x, (max_shift,) * 4)
+  rows = (torch.arange(h, device=x.device) + max_shift).view(1, h) + dy.view(n, 1) # n x h
+  cols = (torch.arange(w, device=x.device) + max_shift).view(1, w) + dx.view(n, 1) # n x w
+  xp = xp.gather(2, rows.view(n, 1, h, 1).expand(n, c, h, w + 2 * max_shift))
+  return xp.gather(3, cols.view(n, 1, 1, w).expand(n, c, h, w))
+
 class Transform2(nn.Module): # drop out
   def __init__(self):
     super(Transform2, self).__init__()
@@ -935,48 +963,60 @@ class Transform2(nn.Module): # drop out
 class Transform4(nn.Module): # rand translation
   def __init__(self):
     super(Transform4, self).__init__()
-    self.conv_trans = nn.Conv2d(3, 3, kernel_size=(5, 5), stride=(1, 1), padding=(2, 2), bias=False, groups=3)
-    self.one_hot2 = OneHotCategorical(torch.Tensor([1/24., 1/24., 1/24., 1/24., 1/24.,
-                                                    1/24., 1/24., 1/24., 1/24., 1/24.,
-                                                    1/24., 1/24., 0.000, 1/24., 1/24.,
-                                                    1/24., 1/24., 1/24., 1/24., 1/24.,
-                                                    1/24., 1/24., 1/24., 1/24., 1/24.]))
+  def forward(self, x): # one of the 24 shifts in [-2, 2]^2 per sample
+    return shift(x, *random_shift(x.size(0), x.device))
+    
+class GeometricTransform(nn.Module): # per-sample translation, scale-crop and rotation, fused
+  '''
+    Every image gets its own random translation (a whole-pixel shift in [-max_shift, max_shift]^2 other than (0, 0), as
+    the one-hot kernels of Transform4), scale-crop (zoom in by a scale in 'scale' and crop at a random position, as
+    Transform6) and rotation (by whole degrees in [-max_angle, max_angle], as Transform7), each with probability 'p'.
+    The three are composed into one affine matrix per image, mapping the output coordinates to the input ones in the
+    normalized coordinates of affine_grid:
+      x_in = R(angle) x_out / scale + crop offset + shift
+    and applied with one affine_grid/grid_sample. The random numbers are drawn on the device of the images.
+  '''
+  def __init__(self, p=0.5, translate=True, scale_crop=True, rotate=True, max_shift=2, scale=(1.03125, 1.08125), max_angle=5):
+    super(GeometricTransform, self).__init__()
+    self.p = p
+    self.translate = translate; self.scale_crop = scale_crop; self.rotate = rotate
+    self.max_shift = max_shift; self.scale = scale; self.max_angle = max_angle
+  
+  def switch(self, n, device): # 1 for the images to transform
+    return (torch.rand(n, device=device) < self.p).float()
+  
+  def random_theta(self, n, h, w, device):
+    zeros = torch.zeros(n, device=device)
+    shift_x = shift_y = crop_x = crop_y = angle = zeros; scale = zeros + 1
+    if self.translate:
+      dy, dx = random_shift(n, device, self.max_shift)
+      on = self.switch(n, device)
+      shift_x = dx.float() * (2. / w) * on # a pixel is 2/w wide in the normalized coordinates
+      shift_y = dy.float() * (2. / h) * on
+    if self.scale_crop:
+      on = self.switch(n, device)
+      scale = 1 + (torch.rand(n, device=device) * (self.scale[1] - self.scale[0]) + self.scale[0] - 1) * on
+      margin = 1 - 1 / scale # the crop stays in the image
+      crop_x = (torch.rand(n, device=device) * 2 - 1) * margin
+      crop_y = (torch.rand(n, device=device) * 2 - 1) * margin
+    if self.rotate:
+      angle = torch.randint(-self.max_angle, self.max_angle + 1, (n,), device=device).float() * (math.pi / 180) * self.switch(n, device)
+    cos = torch.cos(angle) / scale; sin = torch.sin(angle) / scale
+    return torch.stack([torch.stack([cos, -sin, crop_x + shift_x], dim=1),
+                        torch.stack([sin,  cos, crop_y + shift_y], dim=1)], dim=1) # n x 2 x 3
+  
   def forward(self, x):
-    kernel = self.one_hot2.sample().view(1,5,5) # 1x5x5
-    kernel = torch.stack([kernel] * 3).cuda() # 3x1x5x5
-    self.conv_trans.weight = nn.Parameter(kernel)
-    y = self.conv_trans(x)
-    self.conv_trans.requires_grad = False
-    return y
+    theta = self.random_theta(x.size(0), x.size(2), x.size(3), x.device)
+    grid = F.affine_grid(theta, x.size(), align_corners=False).to(x.dtype)
+    return F.grid_sample(x, grid, align_corners=False)
     
-class Transform6(nn.Module): # resize or scale
+class Transform6(GeometricTransform): # resize or scale
   def __init__(self):
-    super(Transform6, self).__init__()
-  def forward(self, x):
-    rand_scale = np.random.rand() * 0.05 + 1.03125
-    y = F.interpolate(x, scale_factor=rand_scale)
-    new_width = int(rand_scale*32)
-    w = np.random.randint(new_width-32); h = np.random.randint(new_width-32)
-    rand_crop = y[:, :, w:w+32, h:h+32]
-    return rand_crop
+    super(Transform6, self).__init__(p=1, translate=False, rotate=False)
      
-class Transform7(nn.Module): # rotate
+class Transform7(GeometricTransform): # rotate
   def __init__(self):
-    super(Transform7, self).__init__()
-    
-  def forward(self, x):
-    theta = []
-    for _ in range(x.shape[0]):
-      angle = np.random.randint(-5, 6) / 180.0 * math.pi
-      # trans = np.arange(-2, 3) / 32. # 32: the width/height of the MNIST/CIFAR10 image is 32x32
-      # trans1 = trans[np.random.randint(len(trans))]
-      # trans2 = trans[np.random.randint(len(trans))]
-      theta.append([[math.cos(angle), -math.sin(angle), 0],
-                    [math.sin(angle),  math.cos(angle), 0]])
-    theta = torch.from_numpy(np.array(theta)).float().cuda()
-    grid = F.affine_grid(theta, x.size())
-    x = F.grid_sample(x, grid)
-    return x
+    super(Transform7, self).__init__(p=1, translate=False, scale_crop=False)
     
 class Transform9(nn.Module): # sharpen
   def __init__(self):
@@ -986,7 +1026,7 @@ class Transform9(nn.Module): # sharpen
               [-1,  9, -1], 
               [-1, -1, -1]]
     kernel = torch.from_numpy(np.array(kernel)).float().view(1,3,3)
-    kernel = torch.stack([kernel] * 3).cuda()
+    kernel = torch.stack([kernel] * 3)
     self.conv1.weight = nn.Parameter(kernel)
     self.conv1.requires_grad = False
   
@@ -1000,7 +1040,7 @@ class Transform10(nn.Module): # smooth
               [2, 4, 1],
               [1, 2, 1]] # Gaussian smoothing
     kernel = torch.from_numpy(np.array(kernel)).float().view(1,3,3) * 0.0625
-    kernel = torch.stack([kernel] * 3).cuda()
+    kernel = torch.stack([kernel] * 3)
     self.conv1 = nn.Conv2d(3, 3, kernel_size=(3, 3), stride=(1, 1), padding=(1, 1), bias=False, groups=3)
     self.conv1.weight = nn.Parameter(kernel)
     self.conv1.requires_grad = False
@@ -1008,28 +1048,52 @@ class Transform10(nn.Module): # smooth
   def forward(self, x):
     return self.conv1(x)
     
+class PhotometricTransform(nn.Module): # per-sample dropout, sharpen and smooth, fused
+  '''
+    Every image is sharpened (Transform9), smoothed (Transform10) and dropped out (Transform2, in training), each with
+    probability 'p', in one pass per filter: all the images go through one grouped 3x3 conv for sharpen and one for
+    smooth, with the identity kernel for the images without the filter, and the dropout mask is applied to the output.
+    Each conv zero-pads its own input, so the borders are the same as Transform9 and Transform10 in sequence.
+    The random numbers are drawn on the device of the images.
+  '''
+  def __init__(self, p=0.5, drop=0.08):
+    super(PhotometricTransform, self).__init__()
+    self.p = p; self.drop = drop
+    sharpen = torch.FloatTensor([[-1, -1, -1], [-1, 9, -1], [-1, -1, -1]])
+    smooth  = torch.FloatTensor([[1, 2, 1], [2, 4, 1], [1, 2, 1]]) * 0.0625 # Gaussian smoothing
+    identity = torch.zeros(3, 3); identity[1, 1] = 1
+    self.register_buffer("sharpen_kernels", torch.stack([identity, sharpen]), persistent=False) # by the switch
+    self.register_buffer("smooth_kernels", torch.stack([identity, smooth]), persistent=False)
+  
+  def switch(self, n, device): # 1 for the images to transform
+    return (torch.rand(n, device=device) < self.p).long()
+  
+  def forward(self, x):
+    n, c, h, w = x.shape
+    y = x.reshape(1, n * c, h, w)
+    for kernels in [self.sharpen_kernels, self.smooth_kernels]:
+      weight = kernels.to(x.device, x.dtype)[self.switch(n, x.device)].repeat_interleave(c, dim=0).view(n * c, 1, 3, 3)
+      y = F.conv2d(y, weight, padding=1, groups=n * c)
+    y = y.view(n, c, h, w)
+    if self.training and self.drop:
+      drop = self.drop * self.switch(n, x.device).to(y.dtype).view(n, 1, 1, 1) # 0 for the images without dropout
+      y = y * (torch.rand_like(y) >= drop).to(y.dtype) / (1 - drop)
+    return y
+    
 class Transform(nn.Module): # random transform combination
   def __init__(self):
     super(Transform, self).__init__()
-    self.T2  = Transform2()
-    self.T4  = Transform4()
-    self.T6  = Transform6()
-    self.T7  = Transform7()
-    self.T9  = Transform9()
-    self.T10 = Transform10()
-    self.transforms = []
-    for name in dir(self):
-      if name[0] == "T" and name[1:].isdigit():
-        self.transforms.append(eval("self.%s" % name))
+    self.geo = GeometricTransform()     # T4, T6 and T7, each with probability 0.5 per sample, in one pass
+    self.photo = PhotometricTransform() # T2, T9 and T10, each with probability 0.5 per sample, in one pass
+    self.transforms = [self.geo, self.photo]
     self.transforms = np.array(self.transforms)
     print(self.transforms)
     
   def forward(self, y):
     rand = np.random.permutation(len(self.transforms))
     Ts = self.transforms[rand]
-    for T in Ts:
-      if np.random.rand() >= 0.5:
-        y = T(y)
+    for T in Ts: # each draws its own per-sample switches
+      y = T(y)
     return y    
 
 ################# Transform #################
@@ -1058,6 +1122,7 @@ class AutoEncoder_GAN4(nn.Module):
     input_dim = args.num_z + args.num_class if args.use_condition else args.num_z
     self.codemap = CodeMapping(input_dim)
     
+    decs = []
     for di in range(1, args.num_dec + 1):
       pretrained_model = None
       if args.pretrained_dir:
@@ -1065,12 +1130,11 @@ class AutoEncoder_GAN4(nn.Module):
         pretrained_model = [x for x in os.listdir(args.pretrained_dir) if "_d%s_" % di in x and args.pretrained_timeid in x] # the number of pretrained decoder should be like "SERVER218-20190313-1233_d3_E0S0.pth"
         assert(len(pretrained_model) == 1)
         pretrained_model = pretrained_model[0]
-      self.__setattr__("d" + str(di), Dec(input_dim, pretrained_model, fixed=False, gray=args.gray, num_divbranch=args.num_divbranch))
+      decs.append(Dec(input_dim, pretrained_model, fixed=False, gray=args.gray, num_divbranch=args.num_divbranch, checkpoint=args.act_checkpoint))
       self.mask = MaskNet(input_dim)
       self.meta = MetaNet(input_dim)
-    
-    for sei in range(1, args.num_se + 1):
-      self.__setattr__("se" + str(sei), SE(args.e2, fixed=False))
+    self.decs = nn.ModuleList(decs) # decoder di (1-based) is decs[di-1]
+    self.ses = nn.ModuleList([SE(args.e2, fixed=False) for _ in range(args.num_se)])
       
 AutoEncoders = {
 "GAN4": AutoEncoder_GAN4,
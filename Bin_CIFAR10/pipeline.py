@@ -0,0 +1,101 @@
+import os
+import multiprocessing as mp
+import torch
+
+# Pipelined training on CPU: the decoders (generator) and the student (SE) are trained in two processes at the same time.
+# The generator hands each generated batch (images and teacher logits, etc.) to the student through a BatchRing, a bounded
+# ring of batch slots in shared memory: the student reads a slot in place, with no copy. The student publishes its weights
+# to a WeightBoard every few steps, from which the generator updates its copy of the student for the adversarial loss.
+# Both are created before forking the student process, which inherits them.
+
+CTX = mp.get_context("fork")
+
+class BatchRing():
+  '''
+    specs: dict, name -> (shape, dtype) of one batch. put() blocks when all the 'num_slots' slots are full,
+    get() when all are empty. One producer process and one consumer process.
+  '''
+  def __init__(self, specs, num_slots=4):
+    self.slots = [{name: torch.empty(shape, dtype=dtype).share_memory_() for name, (shape, dtype) in specs.items()}
+                  for _ in range(num_slots)]
+    self.num_slots = num_slots
+    self.free = CTX.Semaphore(num_slots)
+    self.filled = CTX.Semaphore(0)
+    self.closed = CTX.Event()
+    self.index = 0 # the next slot to write (producer) or read (consumer). Each process keeps its own.
+    self.peer_alive = lambda: True # set by each process: whether the other process still runs
+
+  def acquire(self, sem):
+    while not sem.acquire(timeout=1.):
+      if not self.peer_alive():
+        raise RuntimeError("The other process of the pipeline exited")
+
+  def put(self, **batch): # copy a batch into the next free slot
+    self.acquire(self.free)
+    slot = self.slots[self.index]
+    for name, x in batch.items():
+      slot[name].copy_(x.detach())
+    self.index = (self.index + 1) % self.num_slots
+    self.filled.release()
+
+  def get(self):
+    '''
+      Return the next filled slot (a dict of shared tensors), or None if the producer has closed the ring and
+      all the batches are read. The slot is valid until release(), which must be called before the next get().
+    '''
+    while not self.filled.acquire(timeout=1.):
+      if self.closed.is_set(): # all the batches are put before close(), so one that is not counted yet is still there
+        if self.filled.acquire(block=False):
+          break
+        return None
+      if not self.peer_alive():
+        raise RuntimeError("The other process of the pipeline exited")
+    return self.slots[self.index]
+
+  def release(self): # give the slot got by get() back to the producer
+    self.index = (self.index + 1) % self.num_slots
+    self.free.release()
+
+  def close(self): # no more put(); the consumer reads the remaining batches, then get() returns None
+    self.closed.set()
+
+class WeightBoard():
+  '''
+    A copy of the params and buffers of 'module' in shared memory, with a version number. 'stats' is a shared
+    vector for the publisher to report its numbers (e.g., losses) to the other side.
+  '''
+  def __init__(self, module, num_stats=0):
+    self.tensors = {k: v.detach().to("cpu", copy=True).share_memory_() for k, v in module.state_dict().items()}
+    self.stats = torch.zeros(num_stats, dtype=torch.float64).share_memory_()
+    self.version = CTX.Value("l", 0, lock=False)
+    self.lock = CTX.Lock()
+    self.seen = 0 # the version last fetched by this process
+
+  def publish(self, module, stats=None):
+    with self.lock:
+      for k, v in module.state_dict().items():
+        self.tensors[k].copy_(v.detach())
+      if stats is not None:
+        self.stats.copy_(torch.as_tensor(stats, dtype=torch.float64))
+      self.version.value += 1
+
+  def fetch(self, module): # load the published weights into 'module' if they are new. Return whether they were.
+    if self.version.value == self.seen:
+      return False
+    with self.lock:
+      with torch.no_grad():
+        for k, v in module.state_dict().items():
+          v.copy_(self.tensors[k])
+      self.seen = self.version.value
+    return True
+
+def start_process(target, *args):
+  '''
+    Fork a process running target(*args). Call it before any thread (e.g., of a SampleWriter) is started.
+  '''
+  p = CTX.Process(target=target, args=args, daemon=True)
+  p.start()
+  return p
+
+def parent_alive(parent_pid=os.getpid()): # for the forked process: the default is the pid of the process that imported this module
+  return os.getppid() == parent_pid
@@ -0,0 +1,264 @@
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from common.loss import DistillLoss, backward_split
+from common.ema import EMA
+from common.device import to_device, autocast, optimizer_kwargs
+from common.dist import allreduce_grads
+from common.replay import ReplayBuffer
+from common.metrics import accuracy
+
+# One GAN4 training step of main.py: the codemap + decoder update (update_dec), then the SE updates on its images
+# (update_ses, by update_se), with the losses, optimizers, EMAs and the replay buffer they use. With --pipeline, main.py
+# hands the images of update_dec to the student process, which runs update_se. The benchmarks (benchmarks/cases.py
+# and benchmark_compile.py) run the same step on random models.
+
+def add_step_args(parser):
+  parser.add_argument('--num_dec', type=int, default=1)
+  parser.add_argument('--num_se', type=int, default=1)
+  parser.add_argument('--lr',  type=float, default=2e-2)
+  parser.add_argument('--b1',  type=float, default=5e-4, help='adam: decay of first order momentum of gradient')
+  parser.add_argument('--b2',  type=float, default=0.999, help='adam: decay of second order momentum of gradient')
+  # ----------------------------------------------------------------
+  # various losses
+  parser.add_argument('--lw_perc', type=float, default=1, help="perceptual loss")
+  parser.add_argument('--lw_soft', type=float, default=10) # According to the paper KD, the soft target loss weight should be considarably larger than that of hard target loss.
+  parser.add_argument('--lw_hard_dec', type=float, default=1)
+  parser.add_argument('--lw_hard_se', type=float, default=1)
+  parser.add_argument('--lw_tv',   type=float, default=1e-6)
+  parser.add_argument('--lw_norm', type=float, default=1e-4)
+  parser.add_argument('--lw_masknorm', type=float, default=0) # 1e-5)
+  parser.add_argument('--lw_DT',   type=float, default=0) # 10)
+  parser.add_argument('--lw_adv',  type=float, default=0)
+  parser.add_argument('--lw_actimax',  type=float, default=0)
+  parser.add_argument('--lw_msgan',  type=float, default=1e-30) # 100)
+  parser.add_argument('--lw_maskdiversity',  type=float, default=0) # 100)
+  parser.add_argument('--lw_feat_L1_norm', type=float, default=-0.1)
+  parser.add_argument('--lw_class_balance', type=float, default=5)
+  parser.add_argument('--lw_my_diversity', type=float, default=5)
+  # ----------------------------------------------------------------
+  parser.add_argument('--temp',  type=float, default=1, help="the tempature in KD")
+  parser.add_argument('--ema_factor', type=float, default=0.9, help="exponential moving average")
+  parser.add_argument('--ema_bf16', action="store_true", help="keep the EMA shadow weights in bfloat16")
+  parser.add_argument('--msgan_option', type=str, default="pixel")
+  parser.add_argument('--noise_magnitude', type=float, default=0)
+  parser.add_argument('--clip_actimax', action="store_true")
+  parser.add_argument('--replay_capacity', type=int, default=0, help="the number of generated images kept for SE. 0: no replay, each batch is used by one SE step")
+  parser.add_argument('--replay_steps', type=int, default=1, help="the number of SE steps (on replayed batches) per decoder step")
+  parser.add_argument('--replay_policy', type=str, default="fifo", choices=["fifo", "reservoir"])
+  parser.add_argument('--replay_uniform', action="store_true", help="sample the replay buffer uniformly, not class-balanced")
+
+def make_ema(module, args):
+  ema = EMA(args.ema_factor, torch.bfloat16 if args.ema_bf16 else None)
+  for name, param in module.named_parameters():
+    if param.requires_grad:
+      ema.register(name, param.data)
+  return ema
+
+class GANStep():
+  '''
+    ae: a GAN4 model on args.device. log: the log print, for the gradient check. timer: a StepTimer (see common/timing.py),
+    which can also be set later by set_timer(), e.g., after the student process of --pipeline is forked.
+    The optimizers and EMAs are one per model (optimizer_codemap and ema_codemap one per decoder), except optimizer_dec,
+    which steps all the decoders, with a param group per decoder (optimizer_dec.param_groups[di-1]), so their
+    hyperparameters can still be set apart.
+  '''
+  show_terms = ["tv", "norm", "alpha", "ie"] # the decoder losses of the log print
+
+  def __init__(self, ae, args, timer=None, log=None):
+    self.ae = ae
+    self.args = args
+    self.log = log
+    self.num_channel = 1 if args.dataset == "MNIST" else 3
+
+    # Exponential moving average
+    self.ema_dec = [make_ema(dec, args) for dec in ae.decs]
+    self.ema_codemap = [make_ema(ae.codemap, args) for _ in ae.decs]
+    self.ema_se = [make_ema(se, args) for se in ae.ses]
+
+    # Optimizer
+    opt_kwargs = optimizer_kwargs(args) # fused or foreach
+    self.optimizer_dec = torch.optim.Adam([{"params": dec.parameters()} for dec in ae.decs], lr=args.lr, betas=(args.b1, args.b2), **opt_kwargs)
+    self.optimizer_codemap = [torch.optim.Adam(ae.codemap.parameters(), lr=args.lr, betas=(args.b1, args.b2), **opt_kwargs) for _ in ae.decs]
+    self.optimizer_se = [torch.optim.Adam(se.parameters(), lr=args.lr, betas=(args.b1, args.b2), **opt_kwargs) for se in ae.ses]
+
+    # Losses. Terms with weight 0 are not computed, except the ones needed for the log print.
+    self.loss_dec_fn = DistillLoss({"tv": args.lw_tv, "norm": args.lw_norm, "hard": args.lw_hard_dec, "DT": args.lw_DT,
+                                    "actimax": args.lw_actimax, "alpha": args.lw_feat_L1_norm, "ie": args.lw_class_balance},
+                                    num_class=args.num_class, noise_magnitude=args.noise_magnitude, world_size=args.world_size)
+    self.loss_se_fn  = DistillLoss({"hard": args.lw_hard_se, "soft": args.lw_soft, "DT": args.lw_DT}, temp=args.temp, world_size=args.world_size)
+    self.set_timer(timer)
+
+    # Replay buffer of the generated images and their teacher logits
+    self.replay = None
+    if args.replay_capacity:
+      self.replay = ReplayBuffer(args.replay_capacity, (self.num_channel, 32, 32), args.num_class, args.device,
+                                 policy=args.replay_policy, balanced=not args.replay_uniform)
+
+  def set_timer(self, timer):
+    self.timer = timer
+    self.loss_dec_fn.timer = self.loss_se_fn.timer = timer
+
+  def __call__(self, x, label=None, epoch=0, show=False):
+    '''
+      One step on the codes 'x' (z + onehot condition, see common/sampler.py), with their 'label' for --use_condition.
+      Return the (name, value) pairs of the metrics, as tensors on the device.
+    '''
+    batch, stats = self.update_dec(x, label, epoch=epoch, show=show)
+    return stats + self.update_ses(*batch)
+
+  def update_dec(self, x, label=None, epoch=0, show=False, log_grad=None):
+    '''
+      Update the codemap and the decoders. log_grad: the prefix of the gradient check print, or None for no check.
+      Return the batch for SE (the images of all the decoder branches, their DT images, their teacher logits and the
+      labels of the last branch) and the (name, value) pairs of the metrics.
+    '''
+    ae, args, timer = self.ae, self.args, self.timer
+    imgrec_all = []; logits_all = []; imgrec_DT_all = []; hardloss_dec_all = []; trainacc_dec_all = []; stats = []
+    if args.lw_msgan:
+      half_bs = int(x.size(0) / 2)
+      random_z1, random_z2 = torch.split(x[:, :args.num_z], half_bs, dim=0)
+
+    for di, dec in enumerate(ae.decs, 1):
+      # Set up model and ema
+      codemap = ae.codemap; optimizer_c = self.optimizer_codemap[di - 1]; ema_c = self.ema_codemap[di - 1]
+      total_loss_dec = 0
+
+      with autocast(args): # the forwards and losses in bfloat16 with --amp. The backward runs outside.
+        # Forward
+        with timer.phase("dec_forward"):
+          x = codemap(x)
+          code = x.detach().requires_grad_() # the cut between the codemap and the decoder, see backward_split
+          imgrecs = dec(code)
+
+        ## Diversity encouraging loss: MSGAN
+        # ref: 2019 CVPR Mode Seeking Generative Adversarial Networks for Diverse Image Synthesis
+        if args.lw_msgan:
+          if args.msgan_option == "pixel":
+            imgrecs_1, imgrecs_2 = torch.split(imgrecs, half_bs, dim=0)
+            lz_pixel = torch.mean(torch.abs(imgrecs_1 - imgrecs_2)) / torch.mean(torch.abs(random_z1 - random_z2))
+          elif args.msgan_option == "pixelgray": # deprecated
+            imgrecs_1, imgrecs_2 = torch.split(imgrecs, half_bs, dim=0)
+            imgrecs_1 = imgrecs_1[:,0,:,:] * 0.299 + imgrecs_1[:,1,:,:] * 0.587 + imgrecs_1[:,2,:,:] * 0.114 # the Y channel (Luminance) of an image
+            imgrecs_2 = imgrecs_2[:,0,:,:] * 0.299 + imgrecs_2[:,1,:,:] * 0.587 + imgrecs_2[:,2,:,:] * 0.114
+            lz_pixel = torch.mean(torch.abs(imgrecs_1 - imgrecs_2)) / torch.mean(torch.abs(random_z1 - random_z2))
+          total_loss_dec += -args.lw_msgan * lz_pixel
+
+        imgrecs_split = torch.split(imgrecs, self.num_channel, dim=1)
+        for imgrec in imgrecs_split:
+          # forward
+          imgrec_all.append(imgrec.detach()) # for SE
+          with timer.phase("teacher_forward"):
+            feats = ae.be.forward_branch(imgrec)
+          logits = feats[-1]; last_feature = feats[-2]
+          logits_all.append(logits.detach())
+          if not args.use_condition:
+            label = logits.argmax(dim=1).detach()
+
+          ## Image prior (tv + norm), hard-target loss, DT loss, activation maximization loss and DFL losses. See common/loss.py.
+          if args.clip_actimax and epoch >= 7:
+            self.loss_dec_fn.weights["actimax"] = 0
+          logits_DT = None
+          if args.lw_DT:
+            with timer.phase("DT"):
+              imgrec_DT = ae.defined_trans(imgrec) # DT: defined transform
+              imgrec_DT_all.append(imgrec_DT) # for SE
+              logits_DT = ae.be(imgrec_DT)
+          extra_terms = ["hard"] + (self.show_terms if show else [])
+          losses_dec = self.loss_dec_fn(img=imgrec, logits=logits, label=label, logits_DT=logits_DT, last_feature=last_feature, extra_terms=extra_terms)
+          total_loss_dec += losses_dec["total"]
+          hardloss = losses_dec["hard"]
+          hardloss_dec_all.append(hardloss.detach())
+          if "actimax" in losses_dec: stats.append(("actimax", losses_dec["actimax"]))
+          for k in extra_terms[1:]: stats.append((k, losses_dec[k]))
+          trainacc_dec_all.append(accuracy(logits, label)) # for accuracy print
+
+          ## Adversarial loss, combat with SE
+          if args.lw_adv:
+            for se in ae.ses:
+              with timer.phase("adv_forward"):
+                logits_dse = se(imgrec)
+              total_loss_dec += args.lw_adv / nn.CrossEntropyLoss()(logits_dse.float(), label)
+
+      # The decoder is updated by the total loss, the codemap by the hard loss only, in one backward pass through the
+      # decoder and the teacher. Both grads are computed before the steps.
+      with timer.phase("dec_backward"):
+        dec.zero_grad(); codemap.zero_grad()
+        x.backward(backward_split(total_loss_dec, dec.parameters(), hardloss * 100, code))
+        allreduce_grads(list(dec.parameters()) + list(codemap.parameters()), args)
+      # Gradient checking
+      if log_grad is not None:
+        ave_grad = []
+        for p in dec.named_parameters():
+          layer_name = p[0]
+          if "bias" in layer_name: continue
+          if p[1].grad is not None:
+            ave_grad.append([layer_name, np.average(p[1].grad.abs()) * args.lr, np.average(p[1].data.abs())])
+        ave_grad = ["{:<30} {:.6f}  /  {:.6f}  ({:.10f})\n".format(x[0], x[1], x[2], x[1]/x[2]) for x in ave_grad]
+        ave_grad = "".join(ave_grad)
+        self.log("{} (grad x lr) / weight:\n{}".format(log_grad, ave_grad))
+
+      with timer.phase("optimizer"):
+        optimizer_c.step()
+      with timer.phase("ema"):
+        ema_c.update()
+
+    # One step for all the decoders. Each one's grads are from its own loss, so they do not depend on the
+    # order of the steps.
+    with timer.phase("optimizer"):
+      self.optimizer_dec.step()
+    with timer.phase("ema"):
+      for ema_d in self.ema_dec:
+        ema_d.update()
+    stats += [("dec_hard", torch.stack(hardloss_dec_all)), ("dec_acc", torch.stack(trainacc_dec_all))]
+    return (imgrec_all, imgrec_DT_all, logits_all, label), stats
+
+  def update_ses(self, imgrec_all, imgrec_DT_all, logits_all, label):
+    # The SE steps on the batch of update_dec. With --replay_capacity, SE takes --replay_steps steps on batches
+    # drawn from the replay buffer. Return the (name, value) pairs of the metrics of SE1.
+    args = self.args
+    se_batches = [(imgrec_all, imgrec_DT_all, logits_all, [label] * len(imgrec_all))]
+    if args.replay_capacity:
+      with self.timer.phase("replay"):
+        self.replay.add(torch.cat(imgrec_all), torch.cat(logits_all), label.repeat(len(imgrec_all)))
+        se_batches = []
+        for _ in range(args.replay_steps):
+          imgs, logits, labels = self.replay.sample(len(imgrec_all) * label.size(0))
+          imgs = list(to_device(imgs, args).split(label.size(0)))
+          imgs_DT = [self.ae.defined_trans(x) for x in imgs] if args.lw_DT else None
+          se_batches.append((imgs, imgs_DT, list(logits.split(label.size(0))), list(labels.split(label.size(0)))))
+    stats = []
+    for batch in se_batches:
+      for sei, se in enumerate(self.ae.ses, 1):
+        with self.timer.phase("se_update"):
+          hardloss, trainacc, softloss = self.update_se(se, self.optimizer_se[sei - 1], self.ema_se[sei - 1], *batch)
+        if sei == 1: # the log print shows SE1
+          stats += [("se_hard", hardloss), ("se_acc", trainacc), ("se_soft", softloss)]
+    return stats
+
+  def update_se(self, se, optimizer, ema, imgrec_all, imgrec_DT_all, logits_all, label_all):
+    # One SE step on the images of all the decoder branches. Return the per-branch hard loss, accuracy and soft loss,
+    # as tensors on the device.
+    args = self.args
+    hardloss_se = []; trainacc_se = []; softloss_se = []
+    loss_se = 0
+    with autocast(args):
+      for i in range(len(imgrec_all)):
+        label = label_all[i]
+        logits = se(imgrec_all[i])
+        logits_DT = se(imgrec_DT_all[i].detach()) if args.lw_DT else None
+        # knowledge distillation loss. Huawei's paper does not mention using the hard loss for SE.
+        # ref: https://github.com/peterliht/knowledge-distillation-pytorch/blob/master/model/net.py
+        losses = self.loss_se_fn(logits=logits, label=label, prob_target=F.softmax(logits_all[i].float()/args.temp, dim=1), logits_DT=logits_DT, extra_terms=["hard", "soft"])
+        loss_se += losses["total"]
+        hardloss_se.append(losses["hard"].detach())
+        softloss_se.append(losses["soft"].detach())
+        trainacc_se.append(accuracy(logits, label)) # for accuracy print
+
+    se.zero_grad()
+    loss_se.backward()
+    allreduce_grads(se.parameters(), args)
+    optimizer.step()
+    ema.update()
+    return torch.stack(hardloss_se), torch.stack(trainacc_se), torch.stack(softloss_se)
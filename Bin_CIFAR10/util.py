@@ -1,51 +1,69 @@
-import glob
-import os
-import shutil
-import time
-import sys
-pjoin = os.path.join
-
-class LogPrint():
-  def __init__(self, file):
-    self.file = file
-  def __call__(self, some_str):
-    print("[%s-" % os.getpid() + time.strftime("%Y/%m/%d-%H:%M:%S] ") + str(some_str), file=self.file, flush=True)
-  
-def check_path(x):
-  if x:
-    complete_path = glob.glob(x)
-    assert(len(complete_path) == 1)
-    x = complete_path[0]
-  return x
-
-def get_previous_step(e2, resume):
-  previous_epoch = previous_step = 0
-  if e2 and resume:
-    for clip in os.path.basename(e2).split("_"):
-      if clip[0] == "E" and "S" in clip:
-        num1 = clip.split("E")[1].split("S")[0]
-        num2 = clip.split("S")[1]
-        if num1.isdigit() and num2.isdigit():
-          previous_epoch = int(num1)
-          previous_step  = int(num2)
-  return previous_epoch, previous_step
-  
-def set_up_dir(project_name, resume, CodeID):
-  TimeID = time.strftime("%Y%m%d-%H%M%S")
-  ExpID = "SERVER" + os.environ["SERVER"] + "-" + TimeID
-  project_path = pjoin("../Experiments", ExpID + "_" + project_name)
-  rec_img_path = pjoin(project_path, "reconstructed_images")
-  weights_path = pjoin(project_path, "weights") # to save torch model
-  if not os.path.exists(project_path):
-    os.makedirs(project_path)
-  else:
-    if not resume:
-      shutil.rmtree(project_path)
-      os.makedirs(project_path)
-  if not os.path.exists(rec_img_path):
-    os.makedirs(rec_img_path)
-  if not os.path.exists(weights_path):
-    os.makedirs(weights_path)
-  log_path = pjoin(weights_path, "log_" + ExpID + ".txt")
-  log = open(log_path, "w+") if CodeID else sys.stdout # Given CodeID, it means this is a formal experiment, i.e., not debugging
+import glob
+import os
+import shutil
+import time
+import sys
+pjoin = os.path.join
+
+pretrained_be_path = {
+"MNIST": "train_baseline_lenet5/trained_weights2/w*/*E17S0*.pth",
+"MNIST_deep": "train_baseline_lenet5/trained_weights_verydeep/weights/*E16S0*.pth", #"train_baseline_lenet5/trained_weights_deep/w*/*E19S0*.pth",
+"CIFAR10": "models/model_best.pth.tar",
+}
+
+class LogPrint():
+  def __init__(self, file):
+    self.file = file
+  def __call__(self, some_str):
+    print("[%s-" % os.getpid() + time.strftime("%Y/%m/%d-%H:%M:%S] ") + str(some_str), file=self.file, flush=True)
+  
+def check_path(x):
+  if x:
+    complete_path = glob.glob(x)
+    assert(len(complete_path) == 1)
+    x = complete_path[0]
+  return x
+
+def get_previous_step(e2, resume):
+  previous_epoch = previous_step = 0
+  if e2 and resume:
+    for clip in os.path.basename(e2).split("_"):
+      if clip[0] == "E" and "S" in clip:
+        num1 = clip.split("E")[1].split("S")[0]
+        num2 = clip.split("S")[1]
+        if num1.isdigit() and num2.isdigit():
+          previous_epoch = int(num1)
+          previous_step  = int(num2)
+  return previous_epoch, previous_step
+
+def find_weights(weights_dir, name, key=None):
+  '''
+    The checkpoint "<ExpID>_<name>_E<epoch>S<step>[_...].pth" in 'weights_dir', as saved by main.py: the one of 'key'
+    (e.g., "E10S0"), or else the latest one. None if there is no such checkpoint.
+  '''
+  found = []
+  for f in os.listdir(weights_dir):
+    clips = os.path.splitext(f)[0].split("_")
+    if f.endswith(".pth") and len(clips) > 2 and clips[1] == name and (key is None or clips[2] == key):
+      found.append((get_previous_step(f, True), f))
+  return pjoin(weights_dir, max(found)[1]) if found else None
+  
+def set_up_dir(project_name, resume, CodeID):
+  TimeID = time.strftime("%Y%m%d-%H%M%S")
+  ExpID = "SERVER" + os.environ["SERVER"] + "-" + TimeID
+  project_path = pjoin("../Experiments", ExpID + "_" + project_name)
+  rec_img_path = pjoin(project_path, "reconstructed_images")
+  weights_path = pjoin(project_path, "weights") # to save torch model
+  if not os.path.exists(project_path):
+    os.makedirs(project_path)
+  else:
+    if not resume:
+      shutil.rmtree(project_path)
+      os.makedirs(project_path)
+  if not os.path.exists(rec_img_path):
+    os.makedirs(rec_img_path)
+  if not os.path.exists(weights_path):
+    os.makedirs(weights_path)
+  log_path = pjoin(weights_path, "log_" + ExpID + ".txt")
+  log = open(log_path, "w+") if CodeID else sys.stdout # Given CodeID, it means this is a formal experiment, i.e., not debugging
   return TimeID, ExpID, rec_img_path, weights_path, log
\ No newline at end of file
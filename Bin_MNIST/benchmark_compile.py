@@ -0,0 +1,75 @@
+from __future__ import print_function
+import sys
+import os
+import copy
+import time
+import argparse
+# torch
+import torch
+import torch.nn.functional as F
+# my libs
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # the repo root, for the shared modules in common/
+from model import AutoEncoders
+from train_step import add_step_args, GANStep
+from common.device import add_device_args, set_up_device, to_device
+from common.jit import add_compile_args, set_up_compile, compile_model
+from common.timing import add_timing_args, StepTimer
+from common.sampler import CodeSampler
+
+# Step time of the MNIST GAN4 training step of main.py (GANStep of train_step.py: decoder update, then SE update),
+# eager vs. compiled. The step args are the ones of main.py, with the same defaults (e.g., 9 decoders).
+# The models have random weights, so no pretrained file is needed. e.g.,
+#   python benchmark_compile.py --compile inductor --num_step 20
+
+# Passed-in params
+parser = argparse.ArgumentParser(description="Eager vs. compiled step time")
+parser.add_argument('--num_class', type=int, default=10)
+parser.add_argument('-b', '--batch_size', type=int, default=100)
+parser.add_argument('--num_step', type=int, default=20, help="the number of timed steps")
+parser.add_argument('--num_warmup', type=int, default=5, help="the number of untimed steps before timing. The compilation happens in them")
+add_step_args(parser)
+add_device_args(parser)
+add_compile_args(parser)
+add_timing_args(parser)
+args = parser.parse_args()
+if args.compile == "none":
+  args.compile = "inductor"
+# the GAN4 set-up of main.py
+args.mode = "BDSE_GAN4"; args.adv_train = 4; args.world_size = 1; args.rank = 0
+args.e1 = None; args.pretrained_dir = None; args.pretrained_timeid = None
+device = set_up_device(args)
+
+def get_decoder_params(ae):
+  return [ae.dec_ensemble] if args.ensemble_dec else list(ae.decs)
+
+def sync():
+  if device.type == "cuda":
+    torch.cuda.synchronize()
+
+def benchmark(ae, name):
+  gan_step = GANStep(ae, args, StepTimer(args, device))
+  x, label = CodeSampler(args.batch_size, args.num_class, device, noise_range=(2., 7.), peak_range=(20, 25)).next()
+  prob_gt = F.softmax(x, dim=1)
+  ae.train()
+  t0 = time.time()
+  for _ in range(args.num_warmup):
+    gan_step(x, prob_gt, label)
+  sync(); t1 = time.time()
+  for _ in range(args.num_step):
+    gan_step(x, prob_gt, label)
+  sync(); t2 = time.time()
+  step_time = (t2 - t1) / args.num_step
+  print("%-10s warm-up: %.2fs  step: %.2fms" % (name, t1 - t0, step_time * 1000))
+  return step_time
+
+if __name__ == "__main__":
+  torch.manual_seed(0)
+  eager = to_device(AutoEncoders[args.mode](args), args)
+  compiled = copy.deepcopy(eager)
+  print("MNIST GAN4 step, batch size %s, %s decoder(s), on %s" % (args.batch_size, args.num_dec, device))
+  t_eager = benchmark(eager, "eager")
+  set_up_compile(args)
+  for m in get_decoder_params(compiled) + [compiled.be] + list(compiled.ses): # the models main.py compiles
+    compile_model(m, args)
+  t_compiled = benchmark(compiled, args.compile)
+  print("speedup: %.2fx" % (t_eager / t_compiled))
@@ -1,4 +1,6 @@
 from PIL import Image
+import sys
+import os
 import glob
 import numpy as np
 import time
@@ -10,22 +12,29 @@ import torchvision.transforms as transforms
 import torchvision.utils as vutils
 import torch
 
+# my libs
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # the repo root, for the shared modules in common/
 from model import LeNet5, SmallLeNet5
 from PhotoWCT_Model import PhotoWCT
+from common.device import add_device_args, set_up_device, to_device
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--floss_weight', type=float, default=1)
+add_device_args(parser)
+args = parser.parse_args()
+device = set_up_device(args)
 
 
 
 # Set up autoencoders
-AE = PhotoWCT().cuda()
-AE.load_state_dict(torch.load("photo_wct.pth"))
+AE = PhotoWCT()
+AE.load_state_dict(torch.load("photo_wct.pth", map_location="cpu"))
+AE = to_device(AE, args)
 def deep_transform(img_path, level=4):
   enc = eval("AE.e" + str(level))
   dec = eval("AE.d" + str(level))
   img = Image.open(img_path).convert("RGB")
-  img = transforms.ToTensor()(img).unsqueeze(0).cuda()
+  img = to_device(transforms.ToTensor()(img).unsqueeze(0), args)
   img_rec = dec(*enc(img))[0]
   img_out_path = img_path.replace(".jpg", "_rec.jpg")
   vutils.save_image(img_rec.data.cpu().float(), img_out_path)
@@ -81,20 +90,20 @@ real_img = Image.open(real_img_path).convert("L")
 # Set up models
 BE_path = "train_baseline_lenet5/trained_weights2/weights/SERVER12-20190222-1834_E17S0_acc=0.9919.pth"
 SE_path = "../Experiments/20190311-1249_improve_LT_BD-no-dropout-no-leak-info_add-DA-img-lossx0.1/weights/SERVER12-20190311-1249_SE_E5S0_testacc=0.4003.pth"
-BE = LeNet5(BE_path).cuda()
-SE = SmallLeNet5(SE_path).cuda()
+BE = to_device(LeNet5(BE_path), args)
+SE = to_device(SmallLeNet5(SE_path), args)
 # BE = SE
 
 num_test = 100
 fake_pred = []
 for i in range(num_test):
-  fake_pred.append(BE(transforms.ToTensor()(randomaffine(fake_img)).unsqueeze(0).cuda()).argmax().data.cpu().item())
+  fake_pred.append(BE(transforms.ToTensor()(randomaffine(fake_img)).unsqueeze(0).to(device)).argmax().data.cpu().item())
 fake_pred = np.array(fake_pred)
 print("\nfake label = %s\n" % fake_img_label, fake_pred, np.sum(fake_pred==fake_img_label))
 
 real_pred = []
 for i in range(num_test):
-  real_pred.append(BE(transforms.ToTensor()(randomaffine(real_img)).unsqueeze(0).cuda()).argmax().data.cpu().item())
+  real_pred.append(BE(transforms.ToTensor()(randomaffine(real_img)).unsqueeze(0).to(device)).argmax().data.cpu().item())
 real_pred = np.array(real_pred)
 print("\nreal label = %s\n" % real_img_label, real_pred, np.sum(real_pred==real_img_label))
 
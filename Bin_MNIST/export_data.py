@@ -0,0 +1,87 @@
+from __future__ import print_function
+import sys
+import os
+import glob
+import time
+import argparse
+# torch
+import torch
+# my libs
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # the repo root, for the shared modules in common/
+from model import Encoder, Decoder
+from common.device import add_device_args, set_up_device, to_device, autocast
+from common.sampler import CodeSampler
+from common.shards import ShardWriter
+pjoin = os.path.join
+
+# Export a synthetic dataset from an experiment of main.py: the images of the trained d1, with the logits of the
+# teacher (BE), as memory-mapped .npy shards (see common/shards.py). The shards feed train_student.py, so the decoder and
+# the teacher are run once for any number of student runs. e.g.,
+#   python export_data.py --weights_dir ../Experiments/<TIME_ID>_<project_name>/weights --num_sample 1000000
+# The codes are drawn as in main.py, so --begin, --end and --Temp must be those of the experiment.
+
+# Passed-in params
+parser = argparse.ArgumentParser(description="Export a synthetic dataset")
+parser.add_argument('--weights_dir', type=str, required=True, help="the weights directory of the experiment")
+parser.add_argument('--key', type=str, default=None, help="the checkpoint to load, e.g., E10S0. Default: the latest")
+parser.add_argument('--e1', type=str, default="train*/*2/w*/*E17S0*.pth", help="the teacher")
+parser.add_argument('--out_dir', type=str, default=None, help="Default: synthetic_data_<checkpoint> beside the weights directory")
+parser.add_argument('--num_sample', type=int, default=100000)
+parser.add_argument('--shard_size', type=int, default=50000, help="the number of samples in a shard")
+parser.add_argument('--img_dtype', type=str, default="float16", choices=["float16", "float32"])
+parser.add_argument('-b', '--batch_size', type=int, default=1000)
+parser.add_argument('--num_class', type=int, default=10)
+parser.add_argument('--begin', type=float, default=25)
+parser.add_argument('--end',   type=float, default=20)
+parser.add_argument('--Temp',  type=float, default=1, help="the Tempature in KD")
+add_device_args(parser)
+args = parser.parse_args()
+
+def path_check(x):
+  if x:
+    complete_path = glob.glob(x)
+    assert(len(complete_path) == 1)
+    x = complete_path[0]
+  return x
+
+def find_weights(weights_dir, name, key=None):
+  '''
+    The checkpoint "<TIME_ID>_<name>_E<epoch>S<step>[_...].pth" in 'weights_dir', as saved by main.py: the one of 'key'
+    (e.g., "E10S0"), or else the latest one. None if there is no such checkpoint.
+  '''
+  found = []
+  for f in os.listdir(weights_dir):
+    clips = os.path.splitext(f)[0].split("_")
+    if f.endswith(".pth") and len(clips) > 2 and clips[1] == name and (key is None or clips[2] == key):
+      epoch, step = clips[2][1:].split("S")
+      found.append(((int(epoch), int(step)), f))
+  return pjoin(weights_dir, max(found)[1]) if found else None
+
+args.e1 = path_check(args.e1)
+device = set_up_device(args)
+
+if __name__ == "__main__":
+  # Set up model
+  d1_path = find_weights(args.weights_dir, "d1", args.key)
+  assert(d1_path != None)
+  be = to_device(Encoder(args.e1, fixed=True), args).eval()
+  dec = to_device(Decoder(d1_path, fixed=True), args).eval()
+  print("decoder: %s\nteacher: %s" % (d1_path, args.e1))
+
+  # Generate and write
+  if args.out_dir == None:
+    name = os.path.splitext(os.path.basename(d1_path))[0].split("_")[2]
+    args.out_dir = pjoin(os.path.dirname(os.path.abspath(args.weights_dir)), "synthetic_data_" + name)
+  writer = ShardWriter(args.out_dir, args.num_sample, (1, 32, 32), args.num_class, args.shard_size, args.img_dtype)
+  code_sampler = CodeSampler(args.batch_size, args.num_class, device, noise_range=(2., 7.), peak_range=(args.end, args.begin), temp=args.Temp)
+  t1 = time.time(); step = 0
+  with torch.no_grad(), autocast(args):
+    while writer.num_written < args.num_sample:
+      x, label = code_sampler.next() # logits / Temp
+      imgrec = dec(x)
+      writer.write(imgrec, be(imgrec), label)
+      step += 1
+      if step % 10 == 0:
+        print("%s / %s samples (%.1f samples/s)" % (writer.num_written, args.num_sample, writer.num_written / (time.time() - t1)))
+  writer.close(d1=d1_path, e1=args.e1)
+  print("%s samples written to %s (%.1fs)" % (writer.num_written, args.out_dir, time.time() - t1))
@@ -2,7 +2,6 @@ from __future__ import print_function
 import sys
 import os
 pjoin = os.path.join
-os.environ["CUDA_VISIBLE_DEVICES"] = sys.argv[sys.argv.index("--gpu") + 1] # The args MUST has an option "--gpu".
 import shutil
 import time
 import argparse
@@ -12,11 +11,11 @@ import matplotlib
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 import glob
+import math
 # torch
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.utils.serialization import load_lua
 import torch.utils.data as Data
 import torchvision
 import torchvision.utils as vutils
@@ -24,7 +23,17 @@ import torchvision.transforms as transforms
 from torch.distributions.one_hot_categorical import OneHotCategorical
 import torchvision.datasets as datasets
 # my libs
-from model import AutoEncoders, EMA
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # the repo root, for the shared modules in common/
+from model import AutoEncoders
+from train_step import add_step_args, GANStep
+from common.device import add_device_args, set_up_device, to_device, loader_kwargs
+from common.jit import add_compile_args, set_up_compile, compile_model
+from common.dist import add_dist_args, set_up_dist, is_main, local_batch_size, broadcast_module, clean_up_dist
+from common.checkpoint import CheckpointWriter, save_state, load_state, rng_state, set_rng_state
+from common.timing import add_timing_args, StepTimer
+from common.metrics import add_metrics_args, Metrics
+from common.samples import SampleWriter
+from common.sampler import CodeSampler
 
 
 def logprint(some_str):
@@ -37,52 +46,57 @@ def path_check(x):
     x = complete_path[0]
   return x
 
+def get_decoder(di): # get the di-th (1-based) decoder as a standalone module
+  return ae.dec_ensemble.decoder(di-1) if args.ensemble_dec else ae.decs[di-1]
+
+def get_decoder_params():
+  return [ae.dec_ensemble] if args.ensemble_dec else list(ae.decs)
+
+def get_batches(loader, num_step):
+  # Yield 'num_step' batches from 'loader', restarting it when it runs out.
+  # Without a loader (data-free training), yield (None, None), so no worker processes are started.
+  data_iter = iter(loader) if loader else None
+  for _ in range(num_step):
+    if data_iter is None:
+      yield None, None
+      continue
+    try:
+      yield next(data_iter)
+    except StopIteration:
+      data_iter = iter(loader)
+      yield next(data_iter)
+
 # Passed-in params
 parser = argparse.ArgumentParser(description="Knowledge Transfer")
 parser.add_argument('--e1',  type=str,   default="train*/*2/w*/*E17S0*.pth")
 parser.add_argument('--e2',  type=str,   default=None)
 parser.add_argument('--pretrained_dir',   type=str, default=None, help="the directory of pretrained decoder models")
 parser.add_argument('--pretrained_timeid',type=str, default=None, help="the timeid of the pretrained models.")
-parser.add_argument('--num_dec', type=int, default=9)
-parser.add_argument('--num_se', type=int, default=1)
 parser.add_argument('--t',   type=str,   default=None)
-parser.add_argument('--gpu', type=int,   default=0)
-parser.add_argument('--lr',  type=float, default=1e-3)
-parser.add_argument('--b1',  type=float, default=5e-4, help='adam: decay of first order momentum of gradient')
-parser.add_argument('--b2',  type=float, default=5e-4, help='adam: decay of second order momentum of gradient')
-# ----------------------------------------------------------------
-# various losses
-parser.add_argument('--floss_weight',    type=float, default=1)
-parser.add_argument('--ploss_weight',    type=float, default=2)
-parser.add_argument('--softloss_weight', type=float, default=10) # According to the paper KD, the soft target loss weight should be considarably larger than that of hard target loss.
-parser.add_argument('--hardloss_weight', type=float, default=1)
-parser.add_argument('--tvloss_weight',   type=float, default=1e-6)
-parser.add_argument('--normloss_weight', type=float, default=1e-4)
-parser.add_argument('--daloss_weight',   type=float, default=10)
-parser.add_argument('--advloss_weight',  type=float, default=20)
-parser.add_argument('--lw_adv',  type=float, default=0.5)
-parser.add_argument('--lw_class',  type=float, default=10)
-parser.add_argument('--floss_lw', type=str, default="1-1-1-1-1-1-1")
-parser.add_argument('--ploss_lw', type=str, default="1-1-1-1-1-1-1")
-# ----------------------------------------------------------------
 parser.add_argument('-b', '--batch_size', type=int, default=100)
 parser.add_argument('-p', '--project_name', type=str, default="test")
 parser.add_argument('-r', '--resume', action='store_true')
+parser.add_argument('--resume_state', type=str, default=None, help="the state file (<TIME_ID>_state_E<epoch>S<step>.ckpt) to resume the training from, with -m GAN3 or GAN4")
 parser.add_argument('-m', '--mode', type=str, help='the training mode name.')
 parser.add_argument('--num_epoch', type=int, default=96)
+parser.add_argument('--num_step_per_epoch', type=int, default=0, help="the number of steps in an epoch. 0: the number of batches in the training set")
 parser.add_argument('--debug', action="store_true")
 parser.add_argument('--num_class', type=int, default=10)
 parser.add_argument('--use_pseudo_code', action="store_false")
 parser.add_argument('--begin', type=float, default=25)
 parser.add_argument('--end',   type=float, default=20)
-parser.add_argument('--Temp',  type=float, default=1, help="the Tempature in KD")
 parser.add_argument('--adv_train', type=int, default=0)
 parser.add_argument('--alpha', type=float, default=1, help="a factor to balance the GAN-style loss")
 parser.add_argument('--beta', type=float, default=1e-6, help="a factor to balance the GAN-style loss")
 parser.add_argument('--G_update_interval', type=int, default=1)
-parser.add_argument('--ema_factor', type=float, default=0.9, help="Exponential Moving Average") 
 parser.add_argument('--show_interval', type=int, default=50, help="the interval to print logs")
 parser.add_argument('--save_interval', type=int, default=1000, help="the interval to save models")
+add_step_args(parser)
+add_device_args(parser)
+add_compile_args(parser)
+add_dist_args(parser)
+add_timing_args(parser)
+add_metrics_args(parser)
 args = parser.parse_args()
 
 # Update and check args
@@ -90,29 +104,33 @@ assert(args.num_dec >= 1)
 assert(args.mode in AutoEncoders.keys())
 args.e1 = path_check(args.e1)
 args.e2 = path_check(args.e2)
+args.resume_state = path_check(args.resume_state)
 args.pretrained_dir = path_check(args.pretrained_dir)
 args.adv_train = int(args.mode[-1])
 assert(args.adv_train in [3,4])
 args.pid = os.getpid()
+device = set_up_device(args)
+set_up_dist(args)
 
-# Set up directories and logs, etc.
+# Set up directories and logs, etc. Only rank 0 writes them.
 TIME_ID = time.strftime("%Y%m%d-%H%M")
 project_path = pjoin("../Experiments", TIME_ID + "_" + args.project_name)
 rec_img_path = pjoin(project_path, "reconstructed_images")
 weights_path = pjoin(project_path, "weights") # to save torch model
-if not os.path.exists(project_path):
-  os.makedirs(project_path)
-else:
-  if not args.resume:
-    shutil.rmtree(project_path)
+if is_main(args):
+  if not os.path.exists(project_path):
     os.makedirs(project_path)
-if not os.path.exists(rec_img_path):
-  os.makedirs(rec_img_path)
-if not os.path.exists(weights_path):
-  os.makedirs(weights_path)
+  else:
+    if not args.resume:
+      shutil.rmtree(project_path)
+      os.makedirs(project_path)
+  if not os.path.exists(rec_img_path):
+    os.makedirs(rec_img_path)
+  if not os.path.exists(weights_path):
+    os.makedirs(weights_path)
 TIME_ID = "SERVER" + os.environ["SERVER"] + "-" + TIME_ID
 log_path = pjoin(weights_path, "log_" + TIME_ID + ".txt")
-args.log = sys.stdout if args.debug else open(log_path, "w+")
+args.log = open(os.devnull, "w") if not is_main(args) else sys.stdout if args.debug else open(log_path, "w+")
   
 if __name__ == "__main__":
   # Set up model
@@ -123,37 +141,17 @@ if __name__ == "__main__":
     ae = AE(args.e1, args.d, args.e2, args.t)
   elif args.adv_train in [3, 4]:
     ae = AE(args)
-  ae.cuda()
+  ae = to_device(ae, args)
+  broadcast_module(ae, args) # all the ranks start from the same weights
+  
+  # Compile the models run in update_dec and update_se (--compile). It is off by default: on one CPU core,
+  # benchmark_compile.py times the compiled step of this script at 0.73-1.08x of the eager one.
+  if args.adv_train in [3, 4]:
+    set_up_compile(args)
+    ses = [ae.se] if args.adv_train == 3 else list(ae.ses)
+    for m in get_decoder_params() + [ae.be] + ses:
+      compile_model(m, args)
   
-  # Set up exponential moving average
-  if args.adv_train == 3:
-    ema_dec = []
-    for di in range(1, args.num_dec+1):
-      ema_dec.append(EMA(args.ema_factor))
-      dec = eval("ae.d%s"  % di)
-      for name, param in dec.named_parameters():
-        if param.requires_grad:
-          ema_dec[-1].register(name, param.data)
-    ema_se = EMA(args.ema_factor)
-    for name, param in ae.se.named_parameters():
-      if param.requires_grad:
-        ema_se.register(name, param.data)
-        
-  elif args.adv_train == 4:
-    ema_dec = []; ema_se = []
-    for di in range(1, args.num_dec+1):
-      ema_dec.append(EMA(args.ema_factor))
-      dec = eval("ae.d%s"  % di)
-      for name, param in dec.named_parameters():
-        if param.requires_grad:
-          ema_dec[-1].register(name, param.data)
-    for sei in range(1, args.num_se+1):
-      ema_se.append(EMA(args.ema_factor))
-      se = eval("ae.se%s" % sei)
-      for name, param in se.named_parameters():
-        if param.requires_grad:
-          ema_se[-1].register(name, param.data)
-        
   # Prepare data
   data_train = datasets.MNIST('./MNIST_data', train=True, download=True,
                               transform=transforms.Compose([
@@ -165,216 +163,95 @@ if __name__ == "__main__":
                                 transforms.Resize((32, 32)),
                                 transforms.ToTensor(),
                                 transforms.Normalize((0.1307,), (0.3081,))]))
-  kwargs = {'num_workers': 4, 'pin_memory': True}
-  train_loader = torch.utils.data.DataLoader(data_train, batch_size=args.batch_size, shuffle=True, **kwargs)
+  kwargs = loader_kwargs(args)
+  # The real training images are only used without pseudo codes. Otherwise the training is data-free, with no train loader.
+  # With several ranks, each one loads its own part of the training set.
+  train_sampler = torch.utils.data.distributed.DistributedSampler(data_train) if args.world_size > 1 else None
+  train_loader = None if args.use_pseudo_code else torch.utils.data.DataLoader(data_train, batch_size=local_batch_size(args),
+                                                                               shuffle=train_sampler is None, sampler=train_sampler, **kwargs)
+  num_step_per_epoch = args.num_step_per_epoch if args.num_step_per_epoch else int(math.ceil(len(data_train) / float(args.batch_size)))
   
-  # Prepare transform and one hot generator
-  one_hot = OneHotCategorical(torch.Tensor([1./args.num_class] * args.num_class))
+  # Prepare the pseudo code sampler: logits of random classes
+  code_sampler = CodeSampler(local_batch_size(args), args.num_class, device, noise_range=(2., 7.), peak_range=(args.end, args.begin), temp=args.Temp)
   
   # Prepare test code
   onehot_label = torch.eye(args.num_class)
   test_codes = torch.randn([args.num_class, args.num_class]) * 5.0 + onehot_label * args.begin
   test_labels = onehot_label.data.numpy().argmax(axis=1)
-  np.save(pjoin(rec_img_path, "test_codes.npy"), test_codes.data.cpu().numpy())
+  if is_main(args):
+    np.save(pjoin(rec_img_path, "test_codes.npy"), test_codes.data.cpu().numpy())
   
   # Print setting for later check
   logprint(args._get_kwargs())
   
-  # Parse to get stage loss weight
-  floss_lw = [float(x) for x in args.floss_lw.split("-")]
-  ploss_lw = [float(x) for x in args.ploss_lw.split("-")]
+  # Per-phase time and memory (--time_phases) and the profiler trace (--profile_steps)
+  if args.profile_dir == None:
+    args.profile_dir = weights_path if is_main(args) else "."
+  timer = StepTimer(args, device, log=logprint, name="%s_trace_rank%s" % (TIME_ID, args.rank))
   
-  # Optimization
-  if args.adv_train == 3:
-    optimizer_se  = torch.optim.Adam(ae.se.parameters(),  lr=args.lr, betas=(args.b1, args.b2))
-    optimizer_dec = []
-    for di in range(1, args.num_dec+1):
-      dec = eval("ae.d"+str(di))
-      optimizer_dec.append(torch.optim.Adam(dec.parameters(),  lr=args.lr, betas=(args.b1, args.b2)))
-  elif args.adv_train == 4:
-    optimizer_se  = [] 
-    optimizer_dec = []
-    for di in range(1, args.num_dec+1):
-      dec = eval("ae.d"+str(di))
-      optimizer_dec.append(torch.optim.Adam(dec.parameters(),  lr=args.lr, betas=(args.b1, args.b2)))
-    for sei in range(1, args.num_se+1):
-      se = eval("ae.se" + str(sei))
-      optimizer_se.append(torch.optim.Adam(se.parameters(),  lr=args.lr, betas=(args.b1, args.b2)))
-      
-  # Resume previous step
+  # The decoder and SE updates, with their losses, optimizers, EMAs and replay buffer (see train_step.py)
+  gan_step = GANStep(ae, args, timer)
+  optimizer_dec, ema_dec = gan_step.optimizer_dec, gan_step.ema_dec
+  se_list, optimizer_se_list, ema_se_list = gan_step.ses, gan_step.optimizer_se, gan_step.ema_se
+  
+  # Checkpoints and sample images are written in the background
+  if is_main(args):
+    ckpt_writer = CheckpointWriter()
+    sample_writer = SampleWriter(pjoin(rec_img_path, "%s_samples.npz" % TIME_ID))
+  
+  # Resume from a state file of this script (--resume_state): the weights, the optimizers, the EMA shadows, the codes
+  # and the RNG are restored, so the training goes on from the step after the saved one as if it had not stopped.
+  # The tensors are read from the mapped file as load_state_dict copies them in.
   previous_epoch = previous_step = 0
-  if args.e2 and args.resume:
-    for clip in os.path.basename(args.e2).split("_"):
-      if clip[0] == "E" and "S" in clip:
-        num1 = clip.split("E")[1].split("S")[0]
-        num2 = clip.split("S")[1]
-        if num1.isdigit() and num2.isdigit():
-          previous_epoch = int(num1)
-          previous_step  = int(num2)
+  if args.resume_state:
+    assert(args.adv_train in [3, 4])
+    state = load_state(args.resume_state)
+    for m, s in zip(get_decoder_params() + se_list, state["decs"] + state["ses"]):
+      m.load_state_dict(s)
+    optimizer_dec.load_state_dict(state["optimizer_dec"])
+    for opt, s in zip(optimizer_se_list, state["optimizer_se"]):
+      opt.load_state_dict(s)
+    for ema, s in zip(ema_dec + ema_se_list, state["ema_dec"] + state["ema_se"]):
+      ema.load_state_dict(s)
+    if args.world_size == 1: # with several ranks, every rank keeps its own seed
+      code_sampler.load_state_dict(state["code_sampler"])
+      set_rng_state(state["rng"])
+    previous_epoch, previous_step = state["epoch"], state["step"] + 1
+    if previous_step == num_step_per_epoch:
+      previous_epoch += 1; previous_step = 0
+    logprint("Resume from '%s': E%sS%s" % (args.resume_state, previous_epoch, previous_step))
+    del state
+  
+  # The losses and accuracies are summed up on the device and only copied to the host at show_interval
+  if args.metrics_file == None:
+    args.metrics_file = pjoin(weights_path, "metrics_%s.jsonl" % TIME_ID)
+  metrics = Metrics(device, args.metrics_file if is_main(args) and args.metrics_file != "none" else None)
+  show_names = ["tv", "norm", "p1", "p2", "p3", "p4"] # of show_losses, the means over the decoders
   
   # Optimization
   t1 = time.time()
   for epoch in range(previous_epoch, args.num_epoch):
-    for step, (img, label) in enumerate(train_loader):
+    if train_loader is not None and train_sampler is not None:
+      train_sampler.set_epoch(epoch)
+    first_step = previous_step if epoch == previous_epoch else 0
+    for step, (img, label) in enumerate(get_batches(train_loader, num_step_per_epoch - first_step), first_step):
       ae.train()
       # Generate codes randomly
       if args.use_pseudo_code:
-        onehot_label = one_hot.sample_n(args.batch_size)
-        x = torch.randn([args.batch_size, args.num_class]) * (np.random.rand() * 5.0 + 2.0) + onehot_label * np.random.randint(args.end, args.begin) # logits
-        x = x.cuda() / args.Temp
-        label = onehot_label.data.numpy().argmax(axis=1)
-        label = torch.from_numpy(label).long()
+        with timer.phase("sample_codes"):
+          x, label = code_sampler.next() # logits / Temp
       else:
-        x = ae.be(img.cuda()) / args.Temp
+        x = ae.be(to_device(img, args)) / args.Temp
       prob_gt = F.softmax(x, dim=1) # prob, ground truth
-      label = label.cuda()
+      label = label.to(device)
+      
+      # update the decoders, then SE
+      hardloss_dec, trainacc_dec, show_losses, se_stats = gan_step(x, prob_gt, label, show=step % args.show_interval == 0)
+      metrics.add("dec_hard", hardloss_dec); metrics.add("dec_acc", trainacc_dec)
+      for name, l in zip(show_names, show_losses or []): metrics.add(name, l)
+      for hardloss_se, trainacc_se in se_stats:
+        metrics.add("se_hard", hardloss_se); metrics.add("se_acc", trainacc_se)
       
-      if args.adv_train == 3:
-        # update decoder
-        imgrec = []; imgrec_DT = []; hardloss_dec = []; trainacc_dec = []; ave_imgrec = 0
-        for di in range(1, args.num_dec+1):
-          dec = eval("ae.d" + str(di)); optimizer = optimizer_dec[di-1]; ema = ema_dec[di-1]
-          dec.zero_grad()
-          imgrec1 = dec(x);       feats1 = ae.be.forward_branch(imgrec1); logits1 = feats1[-1]
-          imgrec2 = dec(logits1); feats2 = ae.be.forward_branch(imgrec2); logits2 = feats2[-1]
-          imgrec1_DT = ae.defined_trans(imgrec1); logits1_DT = ae.be(imgrec1_DT) # DT: defined transform
-          imgrec.append(imgrec1); imgrec_DT.append(imgrec1_DT) # for SE
-          ave_imgrec += imgrec1 # to get average img
-          
-          tvloss1 = args.tvloss_weight * (torch.sum(torch.abs(imgrec1[:, :, :, :-1] - imgrec1[:, :, :, 1:])) + 
-                                          torch.sum(torch.abs(imgrec1[:, :, :-1, :] - imgrec1[:, :, 1:, :])))
-          tvloss2 = args.tvloss_weight * (torch.sum(torch.abs(imgrec2[:, :, :, :-1] - imgrec2[:, :, :, 1:])) + 
-                                          torch.sum(torch.abs(imgrec2[:, :, :-1, :] - imgrec2[:, :, 1:, :])))
-          imgnorm1 = torch.pow(torch.norm(imgrec1, p=6), 6) * args.normloss_weight
-          imgnorm2 = torch.pow(torch.norm(imgrec2, p=6), 6) * args.normloss_weight
-
-          ploss1 = nn.MSELoss()(feats2[0], feats1[0].data) * args.ploss_weight * ploss_lw[0]
-          ploss2 = nn.MSELoss()(feats2[1], feats1[1].data) * args.ploss_weight * ploss_lw[1]
-          ploss3 = nn.MSELoss()(feats2[2], feats1[2].data) * args.ploss_weight * ploss_lw[2]
-          ploss4 = nn.MSELoss()(feats2[3], feats1[3].data) * args.ploss_weight * ploss_lw[3]
-          
-          logprob1 = F.log_softmax(logits1/args.Temp, dim=1)
-          logprob2 = F.log_softmax(logits2/args.Temp, dim=1)
-          softloss1 = nn.KLDivLoss()(logprob1, prob_gt.data) * (args.Temp*args.Temp) * args.softloss_weight
-          softloss2 = nn.KLDivLoss()(logprob2, prob_gt.data) * (args.Temp*args.Temp) * args.softloss_weight
-          hardloss1 = nn.CrossEntropyLoss()(logits1, label.data) * args.hardloss_weight
-          hardloss2 = nn.CrossEntropyLoss()(logits2, label.data) * args.hardloss_weight
-          hardloss1_DT = nn.CrossEntropyLoss()(logits1_DT, label.data) * args.daloss_weight
-          pred = logits1.detach().max(1)[1]; trainacc = pred.eq(label.view_as(pred)).sum().cpu().data.numpy() / float(args.batch_size)
-          hardloss_dec.append(hardloss1.data.cpu().numpy()); trainacc_dec.append(trainacc)
-          
-          logits_dse = ae.se(imgrec1)
-          hardloss_dse = nn.CrossEntropyLoss()(logits_dse, label.data) * args.hardloss_weight
-          
-          # total loss
-          loss = tvloss1 + imgnorm1 + tvloss2 + imgnorm2 + \
-                  ploss1 + ploss2 + ploss3 + ploss4 + \
-                  softloss1 + softloss2 + hardloss1 + hardloss1_DT + hardloss2 \
-                  + args.lw_adv / hardloss_dse
-          loss.backward()
-          optimizer.step()
-          for name, param in dec.named_parameters():
-            if param.requires_grad:
-              param.data = ema(name, param.data)
-        ave_imgrec /= args.num_dec
-        
-        ## update SE
-        ae.se.zero_grad()
-        loss_se = 0
-        hardloss_se = []; trainacc_se = []
-        for di in range(args.num_dec):
-          logits = ae.se(imgrec[di].detach())
-          logits_DT = ae.se(imgrec_DT[di].detach())
-          hardloss = nn.CrossEntropyLoss()(logits, label.data) * args.hardloss_weight
-          hardloss_DT = nn.CrossEntropyLoss()(logits_DT, label.data) * args.daloss_weight
-          loss_se += hardloss + hardloss_DT
-          pred = logits.detach().max(1)[1]; trainacc = pred.eq(label.view_as(pred)).sum().cpu().data.numpy() / float(args.batch_size)
-          hardloss_se.append(hardloss.data.cpu().numpy()); trainacc_se.append(trainacc)
-        
-        # loss_se += nn.CrossEntropyLoss()(ae.se(ave_imgrec), label.data) * args.hardloss_weight # average img loss
-        loss_se.backward()
-        optimizer_se.step()
-        for name, param in ae.se.named_parameters():
-          if param.requires_grad:
-            param.data = ema_se(name, param.data)
-        
-      if args.adv_train == 4:
-        # update decoder
-        imgrec = []; imgrec_DT = []; hardloss_dec = []; trainacc_dec = []; ave_imgrec = 0
-        for di in range(1, args.num_dec+1):
-          dec = eval("ae.d" + str(di)); optimizer = optimizer_dec[di-1]; ema = ema_dec[di-1]
-          dec.zero_grad()
-          imgrec1 = dec(x);       feats1 = ae.be.forward_branch(imgrec1); logits1 = feats1[-1]
-          imgrec2 = dec(logits1); feats2 = ae.be.forward_branch(imgrec2); logits2 = feats2[-1]
-          imgrec1_DT = ae.defined_trans(imgrec1); logits1_DT = ae.be(imgrec1_DT) # DT: defined transform
-          imgrec.append(imgrec1); imgrec_DT.append(imgrec1_DT) # for SE
-          ave_imgrec += imgrec1 # to get average img
-          
-          tvloss1 = args.tvloss_weight * (torch.sum(torch.abs(imgrec1[:, :, :, :-1] - imgrec1[:, :, :, 1:])) + 
-                                          torch.sum(torch.abs(imgrec1[:, :, :-1, :] - imgrec1[:, :, 1:, :])))
-          tvloss2 = args.tvloss_weight * (torch.sum(torch.abs(imgrec2[:, :, :, :-1] - imgrec2[:, :, :, 1:])) + 
-                                          torch.sum(torch.abs(imgrec2[:, :, :-1, :] - imgrec2[:, :, 1:, :])))
-          imgnorm1 = torch.pow(torch.norm(imgrec1, p=6), 6) * args.normloss_weight
-          imgnorm2 = torch.pow(torch.norm(imgrec2, p=6), 6) * args.normloss_weight
-
-          ploss1 = nn.MSELoss()(feats2[0], feats1[0].data) * args.ploss_weight * ploss_lw[0]
-          ploss2 = nn.MSELoss()(feats2[1], feats1[1].data) * args.ploss_weight * ploss_lw[1]
-          ploss3 = nn.MSELoss()(feats2[2], feats1[2].data) * args.ploss_weight * ploss_lw[2]
-          ploss4 = nn.MSELoss()(feats2[3], feats1[3].data) * args.ploss_weight * ploss_lw[3]
-          
-          logprob1 = F.log_softmax(logits1/args.Temp, dim=1)
-          logprob2 = F.log_softmax(logits2/args.Temp, dim=1)
-          softloss1 = nn.KLDivLoss()(logprob1, prob_gt.data) * (args.Temp*args.Temp) * args.softloss_weight
-          softloss2 = nn.KLDivLoss()(logprob2, prob_gt.data) * (args.Temp*args.Temp) * args.softloss_weight
-          hardloss1 = nn.CrossEntropyLoss()(logits1, label.data) * args.hardloss_weight
-          hardloss2 = nn.CrossEntropyLoss()(logits2, label.data) * args.hardloss_weight
-          hardloss1_DT = nn.CrossEntropyLoss()(logits1_DT, label.data) * args.daloss_weight
-          pred = logits1.detach().max(1)[1]; trainacc = pred.eq(label.view_as(pred)).sum().cpu().data.numpy() / float(args.batch_size)
-          hardloss_dec.append(hardloss1.data.cpu().numpy()); trainacc_dec.append(trainacc)
-          
-          advloss = 0
-          for sei in range(1, args.num_se+1):
-            se = eval("ae.se" + str(sei))
-            logits_dse = se(imgrec1)
-            advloss += args.lw_adv / nn.CrossEntropyLoss()(logits_dse, label.data) * args.hardloss_weight
-          
-          class_loss = 0
-          for i in range(args.batch_size):
-            class_loss += -logits1[i, label[i]] * args.lw_class
-          
-          ## total loss
-          loss = tvloss1 + imgnorm1 + tvloss2 + imgnorm2 + \
-                  ploss1 + ploss2 + ploss3 + ploss4 + \
-                  softloss1 + softloss2 + hardloss1 + hardloss1_DT + hardloss2 + \
-                  advloss + \
-                  class_loss
-          loss.backward()
-          optimizer.step()
-          for name, param in dec.named_parameters():
-            if param.requires_grad:
-              param.data = ema(name, param.data)
-        ave_imgrec /= args.num_dec
-        
-        # update SE
-        hardloss_se = []; trainacc_se = []
-        for sei in range(1, args.num_se+1):
-          se = eval("ae.se" + str(sei)); optimizer = optimizer_se[sei-1]; ema = ema_se[sei-1]
-          se.zero_grad()
-          loss_se = 0
-          for di in range(args.num_dec):
-            logits = se(imgrec[di].detach())
-            logits_DT = se(imgrec_DT[di].detach())
-            hardloss = nn.CrossEntropyLoss()(logits, label.data) * args.hardloss_weight
-            hardloss_DT = nn.CrossEntropyLoss()(logits_DT, label.data) * args.daloss_weight
-            loss_se += hardloss + hardloss_DT
-            pred = logits.detach().max(1)[1]; trainacc = pred.eq(label.view_as(pred)).sum().cpu().data.numpy() / float(args.batch_size)
-            hardloss_se.append(hardloss.data.cpu().numpy()); trainacc_se.append(trainacc)
-          loss_se.backward()
-          optimizer.step()
-          for name, param in se.named_parameters():
-            if param.requires_grad:
-              param.data = ema(name, param.data)
-        
       # Print and check the gradient
       # if step % 2000 == 0:
         # ave_grad = []
@@ -392,95 +269,121 @@ if __name__ == "__main__":
       # TODO
       
       # Test and save models
-      if step % args.save_interval == 0:
+      if is_main(args) and step % args.save_interval == 0:
         if args.adv_train in [3, 4]:
-          ae.dec = ae.d1; ae.learned_trans = ae.defined_trans
-          ae.small_enc = ae.se if args.adv_train == 3 else ae.se1
+          ae.dec = get_decoder(1); ae.learned_trans = ae.defined_trans
+          ae.small_enc = ae.se if args.adv_train == 3 else ae.ses[0]
           ae.enc = ae.be
         ae.eval()
-        # save some test images
-        for i in range(len(test_codes)):
-          x = test_codes[i].cuda()
-          if args.adv_train in [3, 4]:
-            for di in range(1, args.num_dec+1):
-              dec = eval("ae.d%s" % di)
-              img1 = dec(x)
-              out_img1_path = pjoin(rec_img_path, "%s_E%sS%s_imgrec%s_label=%s_d%s.jpg" % (TIME_ID, epoch, step, i, test_labels[i], di))
-              vutils.save_image(img1.data.cpu().float(), out_img1_path)
-          else:
-            img1 = ae.dec(x)
-            img1_DA = ae.learned_trans(img1)
-            out_img1_path = pjoin(rec_img_path, "%s_E%sS%s_img%s-rec_label=%s.jpg" % (TIME_ID, epoch, step, i, test_labels[i]))
-            out_img1_DA_path = pjoin(rec_img_path, "%s_E%sS%s_img%s-rec_DA_label=%s.jpg" % (TIME_ID, epoch, step, i, test_labels[i]))
-            vutils.save_image(img1.data.cpu().float(), out_img1_path) # save some samples to check
-            vutils.save_image(img1_DA.data.cpu().float(), out_img1_DA_path) # save some samples to check
+        with timer.phase("samples"):
+          # save some test images: all the test codes through all the decoders in one pass, written as one grid
+          with torch.no_grad():
+            x = test_codes.to(device)
+            if args.adv_train in [3, 4]:
+              if args.ensemble_dec:
+                imgs = ae.dec_ensemble(x) # num_dec x num_class x 1 x 32 x 32
+              else:
+                imgs = torch.stack([dec(x) for dec in ae.decs])
+              out_img_path = pjoin(rec_img_path, "%s_E%sS%s_imgrec_d1-%s.jpg" % (TIME_ID, epoch, step, args.num_dec)) # row: decoder, column: label
+            else:
+              img1 = ae.dec(x)
+              imgs = torch.stack([img1, ae.learned_trans(img1)])
+              out_img_path = pjoin(rec_img_path, "%s_E%sS%s_imgrec_and_DA.jpg" % (TIME_ID, epoch, step)) # row 1: rec, row 2: DA
+            sample_writer.save(imgs.reshape(-1, *imgs.shape[2:]), out_img_path, nrow=len(test_codes), key="E%sS%s" % (epoch, step),
+                               labels=test_labels)
         
         # test with the real codes generated from test set
-        test_loader = torch.utils.data.DataLoader(data_test,  batch_size=100, shuffle=False, **kwargs)
-        softloss1_test = Ssoftloss1_test = test_acc1 = Stest_acc = test_acc = test_acc_advbe = cnt = 0
-        for i, (img, label) in enumerate(test_loader):
-          x = ae.enc(img.cuda())
-          label = label.cuda()
-          prob_gt = F.softmax(x, dim=1)
+        with timer.phase("eval"):
+          test_loader = torch.utils.data.DataLoader(data_test,  batch_size=100, shuffle=False, **kwargs)
+          softloss1_test = Ssoftloss1_test = test_acc1 = Stest_acc = test_acc = test_acc_advbe = cnt = 0
+          for i, (img, label) in enumerate(test_loader):
+            x = ae.enc(to_device(img, args))
+            label = label.to(device)
+            prob_gt = F.softmax(x, dim=1)
           
-          # forward
-          img_rec1 = ae.dec(x); logits1 = ae.enc(img_rec1); Slogits = ae.small_enc(img_rec1)
-          logprob1  = F.log_softmax(logits1, dim=1)
-          Slogprob1 = F.log_softmax(Slogits, dim=1)
+            # forward
+            img_rec1 = ae.dec(x); logits1 = ae.enc(img_rec1); Slogits = ae.small_enc(img_rec1)
+            logprob1  = F.log_softmax(logits1, dim=1)
+            Slogprob1 = F.log_softmax(Slogits, dim=1)
           
-          # code reconstruction loss
-          softloss1_  = nn.KLDivLoss()(logprob1,  prob_gt.data) * args.softloss_weight
-          Ssoftloss1_ = nn.KLDivLoss()(Slogprob1, prob_gt.data) * args.softloss_weight
+            # code reconstruction loss
+            softloss1_  = nn.KLDivLoss()(logprob1,  prob_gt.data) * args.softloss_weight
+            Ssoftloss1_ = nn.KLDivLoss()(Slogprob1, prob_gt.data) * args.softloss_weight
           
-          softloss1_test  +=  softloss1_.data.cpu().numpy()
-          Ssoftloss1_test += Ssoftloss1_.data.cpu().numpy()
+            softloss1_test  +=  softloss1_.detach()
+            Ssoftloss1_test += Ssoftloss1_.detach()
           
-          # test cls accuracy
-          pred1 = logits1.detach().max(1)[1]; test_acc1 += pred1.eq(label.view_as(pred1)).sum().cpu().data.numpy()
-          Spred = Slogits.detach().max(1)[1]; Stest_acc += Spred.eq(label.view_as(Spred)).sum().cpu().data.numpy()
-          cnt += 1
+            # test cls accuracy
+            pred1 = logits1.detach().max(1)[1]; test_acc1 += pred1.eq(label.view_as(pred1)).sum()
+            Spred = Slogits.detach().max(1)[1]; Stest_acc += Spred.eq(label.view_as(Spred)).sum()
+            cnt += 1
            
-          # test acc for small enc
-          pred = ae.small_enc(img.cuda()).detach().max(1)[1]
-          test_acc += pred.eq(label.view_as(pred)).sum().cpu().data.numpy()
-          if args.adv_train == 2:
-            pred_advbe = ae.advbe(img.cuda()).detach().max(1)[1]
-            test_acc_advbe += pred_advbe.eq(label.view_as(pred_advbe)).sum().cpu().data.numpy()
+            # test acc for small enc
+            pred = ae.small_enc(to_device(img, args)).detach().max(1)[1]
+            test_acc += pred.eq(label.view_as(pred)).sum()
+            if args.adv_train == 2:
+              pred_advbe = ae.advbe(to_device(img, args)).detach().max(1)[1]
+              test_acc_advbe += pred_advbe.eq(label.view_as(pred_advbe)).sum()
         
-        softloss1_test  /= cnt; test_acc1 /= float(len(data_test))
-        Ssoftloss1_test /= cnt; Stest_acc /= float(len(data_test))
-        test_acc /= float(len(data_test))
-        test_acc_advbe /= float(len(data_test))
+          # the sums are on the device until here
+          softloss1_test, Ssoftloss1_test, test_acc1, Stest_acc, test_acc, test_acc_advbe = \
+              [float(v) for v in (softloss1_test, Ssoftloss1_test, test_acc1, Stest_acc, test_acc, test_acc_advbe)]
+          softloss1_test  /= cnt; test_acc1 /= float(len(data_test))
+          Ssoftloss1_test /= cnt; Stest_acc /= float(len(data_test))
+          test_acc /= float(len(data_test))
+          test_acc_advbe /= float(len(data_test))
         
         format_str = "E{}S{} | =======> Test softloss with real logits: test accuracy on SE: {:.4f}"
         logprint(format_str.format(epoch, step, test_acc))
+        metrics.write({"epoch": epoch, "step": step, "test_acc": test_acc})
         if args.adv_train in [3, 4]:
-          ae.se = ae.se if args.adv_train == 3 else ae.se1
-          torch.save(ae.se.state_dict(), pjoin(weights_path, "%s_se_E%sS%s_testacc=%.4f.pth" % (TIME_ID, epoch, step, test_acc)))
-          torch.save(ae.d1.state_dict(), pjoin(weights_path, "%s_d1_E%sS%s_testacc1=%.4f.pth" % (TIME_ID, epoch, step, test_acc1)))
-          for di in range(2, args.num_dec+1):
-            dec = eval("ae.d" + str(di))
-            torch.save(dec.state_dict(), pjoin(weights_path, "%s_d%s_E%sS%s.pth" % (TIME_ID, di, epoch, step)))
+          with timer.phase("io"):
+            ae.se = ae.se if args.adv_train == 3 else ae.ses[0]
+            ckpt_writer.save(ae.se.state_dict(), pjoin(weights_path, "%s_se_E%sS%s_testacc=%.4f.pth" % (TIME_ID, epoch, step, test_acc)))
+            ckpt_writer.save(ae.dec.state_dict(), pjoin(weights_path, "%s_d1_E%sS%s_testacc1=%.4f.pth" % (TIME_ID, epoch, step, test_acc1)))
+            for di in range(2, args.num_dec+1):
+              dec = get_decoder(di)
+              ckpt_writer.save(dec.state_dict(), pjoin(weights_path, "%s_d%s_E%sS%s.pth" % (TIME_ID, di, epoch, step)))
+            ckpt_writer.save({"dec": [ema.state_dict() for ema in ema_dec], "se": [ema.state_dict() for ema in ema_se_list]},
+                             pjoin(weights_path, "%s_ema_E%sS%s.pth" % (TIME_ID, epoch, step)))
+            state = {"decs": [dec.state_dict() for dec in get_decoder_params()], "ses": [se.state_dict() for se in se_list],
+                     "optimizer_dec": optimizer_dec.state_dict(), "optimizer_se": [opt.state_dict() for opt in optimizer_se_list],
+                     "ema_dec": [ema.state_dict() for ema in ema_dec], "ema_se": [ema.state_dict() for ema in ema_se_list],
+                     "code_sampler": code_sampler.state_dict(), "rng": rng_state(), "epoch": epoch, "step": step}
+            ckpt_writer.save(state, pjoin(weights_path, "%s_state_E%sS%s.ckpt" % (TIME_ID, epoch, step)), save_fn=save_state)
             
       # Print training loss
-      if step % args.show_interval == 0:
+      if is_main(args) and step % args.show_interval == 0:
         if args.adv_train in [3, 4]:
           format_str1 = "E{}S{} | dec:"
           format_str2 = " {:.4f}({:.3f})" * args.num_dec
           format_str3 = " | se:"
-          format_str4 = " | tv: {:.4f} norm: {:.4f} p: {:.4f} {:.4f} {:.4f} {:.4f} ({:.3f}s/step)"
+          format_str4 = " | mean over decs: tv: {:.4f} norm: {:.4f} p: {:.4f} {:.4f} {:.4f} {:.4f} ({:.3f}s/step)"
           format_str = "".join([format_str1, format_str2, format_str3, format_str2, format_str4])
+          means = metrics.summarize() # the means over the steps since the last print
+          time_per_step = (time.time()-t1)/args.show_interval
           tmp1 = []; tmp2 = []
           for i in range(args.num_dec):
-            tmp1.append(hardloss_dec[i])
-            tmp1.append(trainacc_dec[i])
-            tmp2.append(hardloss_se[i])
-            tmp2.append(trainacc_se[i])
+            tmp1.append(means["dec_hard"][i])
+            tmp1.append(means["dec_acc"][i])
+            tmp2.append(means["se_hard"][i])
+            tmp2.append(means["se_acc"][i])
           logprint(format_str.format(epoch, step,
               *tmp1, *tmp2,
-              tvloss1.data.cpu().numpy(), imgnorm1.data.cpu().numpy(), ploss1.data.cpu().numpy(), ploss2.data.cpu().numpy(), ploss3.data.cpu().numpy(), ploss4.data.cpu().numpy(),
-              (time.time()-t1)/args.show_interval))
+              *[means[name] for name in show_names],
+              time_per_step))
+          metrics.write(dict([("epoch", epoch), ("step", step), ("time_per_step", time_per_step)] + list(means.items())))
+        report = timer.report()
+        if report:
+          logprint("E{}S{} | ".format(epoch, step) + report)
         t1 = time.time()
+      timer.step()
       
       
-  log.close()
+  if is_main(args):
+    ckpt_writer.close()
+    sample_writer.close()
+    metrics.close()
+  clean_up_dist(args)
+  if args.log is not sys.stdout:
+    args.log.close()
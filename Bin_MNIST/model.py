@@ -3,25 +3,11 @@ import numpy as np
 import os
 import torch.nn as nn
 import torch
-from torch.utils.serialization import load_lua
 from torch.distributions.one_hot_categorical import OneHotCategorical
 import torch.nn.functional as F
 import math
 pjoin = os.path.join
 
-# Exponential Moving Average
-class EMA():
-  def __init__(self, mu):
-    self.mu = mu
-    self.shadow = {}
-  def register(self, name, val):
-    self.shadow[name] = val.clone()
-  def __call__(self, name, x):
-    assert name in self.shadow
-    new_average = (1.0 - self.mu) * x + self.mu * self.shadow[name]
-    self.shadow[name] = new_average.clone()
-    return new_average
-
 # Use the LeNet model as https://github.com/iRapha/replayed_distillation/blob/master/models/lenet.py
 class LeNet5(nn.Module):
   def __init__(self, model=None, fixed=False):
@@ -36,7 +22,7 @@ class LeNet5(nn.Module):
     self.relu = nn.ReLU(inplace=True)
     
     if model:
-      self.load_state_dict(torch.load(model))
+      self.load_state_dict(torch.load(model, map_location="cpu"))
     if fixed:
       for param in self.parameters():
           param.requires_grad = False
@@ -46,7 +32,7 @@ class LeNet5(nn.Module):
     y = self.pool1(y)            # 6x14x14
     y = self.relu(self.conv2(y)) # 16x10x10
     y = self.pool2(y)            # 16x5x5
-    y = y.view(y.size(0), -1)    # 400
+    y = y.reshape(y.size(0), -1)    # 400
     y = self.relu(self.fc3(y))   # 120
     y = self.relu(self.fc4(y))   # 84
     y = self.fc5(y)              # 10
@@ -57,7 +43,7 @@ class LeNet5(nn.Module):
     y = self.pool1(y)
     y = self.relu(self.conv2(y)); out2 = y
     y = self.pool2(y)
-    y = y.view(y.size(0), -1)
+    y = y.reshape(y.size(0), -1)
     y = self.relu(self.fc3(y)); out3 = y
     y = self.relu(self.fc4(y)); out4 = y
     y = self.fc5(y)
@@ -76,7 +62,7 @@ class LeNet5_drop(nn.Module):
     self.relu = nn.ReLU(inplace=True)
     
     if model:
-      self.load_state_dict(torch.load(model))
+      self.load_state_dict(torch.load(model, map_location="cpu"))
     if fixed:
       for param in self.parameters():
           param.requires_grad = False
@@ -86,7 +72,7 @@ class LeNet5_drop(nn.Module):
     y = self.pool1(y)            # 6x14x14
     y = self.relu(self.conv2(y)) # 16x10x10
     y = self.pool2(y)            # 16x5x5
-    y = y.view(y.size(0), -1)    # 400
+    y = y.reshape(y.size(0), -1)    # 400
     y = self.relu(self.drop3(self.fc3(y)))   # 120
     y = self.relu(self.drop4(self.fc4(y)))   # 84
     y = self.fc5(y)              # 10
@@ -109,7 +95,7 @@ class DLeNet5(nn.Module):
     self.pad = nn.ReflectionPad2d((2,2,2,2))
     
     if model:
-      self.load_state_dict(torch.load(model))
+      self.load_state_dict(torch.load(model, map_location="cpu"))
     if fixed:
       for param in self.parameters():
           param.requires_grad = False
@@ -126,7 +112,70 @@ class DLeNet5(nn.Module):
     y = self.pad(y)              # 6x32x32
     y = self.relu(self.conv1(y)) # 1x32x32
     return y
-    
+
+# Stack the weights of num_dec DLeNet5 decoders and run them as one batched forward.
+# fc layers -> batched matmul, conv layers -> grouped conv (one group per decoder).
+# Since the decoders share no params, summing their losses and calling backward once gives
+# each decoder exactly the gradient of its own loss, and Adam/EMA are elementwise, so one
+# optimizer over the stacked params behaves like num_dec separate ones.
+class DLeNet5_Ensemble(nn.Module):
+  layers = ["fc5", "fc4", "fc3", "conv2", "conv1"]
+  def __init__(self, num_dec, models=None, fixed=False):
+    super(DLeNet5_Ensemble, self).__init__()
+    self.fixed = fixed
+    self.num_dec = num_dec
+    models = models if models else [None] * num_dec
+    assert(len(models) == num_dec)
+    decs = [DLeNet5(m) for m in models] # init each member the same way as a single DLeNet5
+    for name in self.layers:
+      layer = [getattr(d, name) for d in decs]
+      self.__setattr__(name + "_weight", nn.Parameter(torch.stack([m.weight.data for m in layer]))) # num_dec x out x in (x k x k)
+      self.__setattr__(name + "_bias",   nn.Parameter(torch.stack([m.bias.data   for m in layer]))) # num_dec x out
+
+    self.relu = nn.ReLU(inplace=True)
+    self.unpool = nn.UpsamplingNearest2d(scale_factor=2)
+    self.pad = nn.ReflectionPad2d((2,2,2,2))
+
+    if fixed:
+      for param in self.parameters():
+          param.requires_grad = False
+
+  def fc(self, name, y): # y: num_dec x batch x in
+    w = getattr(self, name + "_weight"); b = getattr(self, name + "_bias")
+    return torch.baddbmm(b.unsqueeze(1), y, w.transpose(1, 2))
+
+  def conv(self, name, y): # y: batch x num_dec*in x h x w
+    w = getattr(self, name + "_weight"); b = getattr(self, name + "_bias")
+    return F.conv2d(y, w.view(-1, *w.shape[2:]), b.view(-1), padding=2, groups=self.num_dec)
+
+  def forward(self, y):               # input: batch x 10 (shared code) or num_dec x batch x 10
+    if y.dim() == 2:
+      y = y.unsqueeze(0).expand(self.num_dec, -1, -1)
+    N, B = y.size(0), y.size(1)
+    y = self.relu(self.fc("fc5", y))  # N x B x 84
+    y = self.relu(self.fc("fc4", y))  # N x B x 120
+    y = self.relu(self.fc("fc3", y))  # N x B x 400
+    y = y.view(N, B, 16, 5, 5).transpose(0, 1).contiguous().view(B, N * 16, 5, 5)
+    y = self.unpool(y)                # B x N*16x10x10
+    y = self.pad(y)                   # B x N*16x14x14
+    y = self.relu(self.conv("conv2", y)) # B x N*6x14x14
+    y = self.unpool(y)                # B x N*6x28x28
+    y = self.pad(y)                   # B x N*6x32x32
+    y = self.relu(self.conv("conv1", y)) # B x N x32x32
+    return y.transpose(0, 1).contiguous().unsqueeze(2) # N x B x 1x32x32
+
+  def state_dict_of(self, di): # the state_dict of the di-th (0-based) member, compatible with DLeNet5
+    out = {}
+    for name in self.layers:
+      out[name + ".weight"] = getattr(self, name + "_weight").data[di].clone()
+      out[name + ".bias"]   = getattr(self, name + "_bias").data[di].clone()
+    return out
+
+  def decoder(self, di): # a standalone DLeNet5 copy of the di-th member, for testing and sampling
+    dec = DLeNet5().to(self.fc5_weight.device)
+    dec.load_state_dict(self.state_dict_of(di))
+    return dec
+
 class DLeNet5_drop(nn.Module):
   def __init__(self, model=None, fixed=False):
     super(DLeNet5_drop, self).__init__()
@@ -143,7 +192,7 @@ class DLeNet5_drop(nn.Module):
     self.pad = nn.ReflectionPad2d((2,2,2,2))
     
     if model:
-      self.load_state_dict(torch.load(model))
+      self.load_state_dict(torch.load(model, map_location="cpu"))
     if fixed:
       for param in self.parameters():
           param.requires_grad = False
@@ -176,7 +225,7 @@ class SmallLeNet5(nn.Module):
     self.relu = nn.ReLU(inplace=True)
     
     if model:
-      self.load_state_dict(torch.load(model))
+      self.load_state_dict(torch.load(model, map_location="cpu"))
     if fixed:
       for param in self.parameters():
           param.requires_grad = False
@@ -186,7 +235,7 @@ class SmallLeNet5(nn.Module):
     y = self.pool1(y)
     y = self.relu(self.conv2(y))
     y = self.pool2(y)
-    y = y.view(y.size(0), -1)
+    y = y.reshape(y.size(0), -1)
     y = self.relu(self.fc3(y))
     y = self.relu(self.fc4(y))
     y = self.fc5(y)
@@ -197,7 +246,7 @@ class SmallLeNet5(nn.Module):
     y = self.pool1(y)
     y = self.relu(self.conv2(y)); out2 = y
     y = self.pool2(y)
-    y = y.view(y.size(0), -1)
+    y = y.reshape(y.size(0), -1)
     y = self.relu(self.fc3(y)); out3 = y
     y = self.relu(self.fc4(y)); out4 = y
     y = self.fc5(y)
@@ -228,7 +277,7 @@ class LearnedTransform(nn.Module):
     self.trans = Transform8()
     
     if model:
-      self.load_state_dict(torch.load(model))
+      self.load_state_dict(torch.load(model, map_location="cpu"))
     if fixed:
       for param in self.parameters():
           param.requires_grad = False
@@ -273,107 +322,42 @@ class Transform2(nn.Module): # drop out
   def forward(self, x):
     return self.drop(x)
     
+def random_shift(n, device, max_shift=2):
+  # Per-sample random whole-pixel shifts (dy, dx) in [-max_shift, max_shift]^2 other than (0, 0), uniformly, i.e.,
+  # the offsets of the one-hot (2*max_shift+1)^2 kernels of Transform4. Drawn on 'device'.
+  k = 2 * max_shift + 1
+  idx = torch.randint(k * k - 1, (n,), device=device)
+  idx = idx + (idx >= k * k // 2).long() # skip the center, i.e., no shift
+  return idx // k - max_shift, idx % k - max_shift
+
+def shift(x, dy, dx, max_shift=2):
+  '''
+    Per-sample whole-pixel translation of the batch 'x' with one gather: y[k, :, i, j] = x[k, :, i + dy[k], j + dx[k]],
+    0 out of the image. It is the same as the conv (padding 'max_shift') with the one-hot kernel at (dy + max_shift,
+    dx + max_shift). dy, dx: LongTensors of the batch size, in [-max_shift, max_shift].
+  '''
+  n, c, h, w = x.shape
+  xp = F.pad(x, (max_shift,) * 4)
+  rows = (torch.arange(h, device=x.device) + max_shift).view(1, h) + dy.view(n, 1) # n x h
+  cols = (torch.arange(w, device=x.device) + max_shift).view(1, w) + dx.view(n, 1) # n x w
+  xp = xp.gather(2, rows.view(n, 1, h, 1).expand(n, c, h, w + 2 * max_shift))
+  return xp.gather(3, cols.view(n, 1, 1, w).expand(n, c, h, w))
+
 class Transform3(nn.Module): # 8-direction translation
   def __init__(self):
     super(Transform3, self).__init__()
-    kernel_left = [[[[0, 0, 0, 0, 0], 
-                     [0, 0, 0, 0, 0], 
-                     [0, 0, 0, 0, 1],
-                     [0, 0, 0, 0, 0],
-                     [0, 0, 0, 0, 0]]]]
-    kernel_left = torch.from_numpy(np.array(kernel_left)).float()
-    self.conv_left = nn.Conv2d(1, 1, kernel_size=(5, 5), stride=(1, 1), padding=(2, 2), bias=False)
-    self.conv_left.weight = nn.Parameter(kernel_left)
-    
-    kernel_right = [[[[0, 0, 0, 0, 0], 
-                      [0, 0, 0, 0, 0], 
-                      [1, 0, 0, 0, 0],
-                      [0, 0, 0, 0, 0],
-                      [0, 0, 0, 0, 0]]]]
-    kernel_right = torch.from_numpy(np.array(kernel_right)).float()
-    self.conv_right = nn.Conv2d(1, 1, kernel_size=(5, 5), stride=(1, 1), padding=(2, 2), bias=False)
-    self.conv_right.weight = nn.Parameter(kernel_right)
-    
-    kernel_up = [[[[0, 0, 0, 0, 0], 
-                   [0, 0, 0, 0, 0], 
-                   [0, 0, 0, 0, 0],
-                   [0, 0, 0, 0, 0],
-                   [0, 0, 1, 0, 0]]]]
-    kernel_up = torch.from_numpy(np.array(kernel_up)).float()
-    self.conv_up = nn.Conv2d(1, 1, kernel_size=(5, 5), stride=(1, 1), padding=(2, 2), bias=False)
-    self.conv_up.weight = nn.Parameter(kernel_up)
-           
-    kernel_down = [[[[0, 0, 1, 0, 0], 
-                     [0, 0, 0, 0, 0], 
-                     [0, 0, 0, 0, 0],
-                     [0, 0, 0, 0, 0],
-                     [0, 0, 0, 0, 0]]]]
-    kernel_down = torch.from_numpy(np.array(kernel_down)).float()
-    self.conv_down = nn.Conv2d(1, 1, kernel_size=(5, 5), stride=(1, 1), padding=(2, 2), bias=False)
-    self.conv_down.weight = nn.Parameter(kernel_down)  
-    
-    kernel5 = [[[[1, 0, 0, 0, 0], 
-                 [0, 0, 0, 0, 0], 
-                 [0, 0, 0, 0, 0],
-                 [0, 0, 0, 0, 0],
-                 [0, 0, 0, 0, 0]]]]
-    kernel5 = torch.from_numpy(np.array(kernel5)).float()
-    self.conv5 = nn.Conv2d(1, 1, kernel_size=(5, 5), stride=(1, 1), padding=(2, 2), bias=False)
-    self.conv5.weight = nn.Parameter(kernel5)
-    
-    kernel6 = [[[[0, 0, 0, 0, 1], 
-                 [0, 0, 0, 0, 0], 
-                 [0, 0, 0, 0, 0],
-                 [0, 0, 0, 0, 0],
-                 [0, 0, 0, 0, 0]]]]
-    kernel6 = torch.from_numpy(np.array(kernel6)).float()
-    self.conv6 = nn.Conv2d(1, 1, kernel_size=(5, 5), stride=(1, 1), padding=(2, 2), bias=False)
-    self.conv6.weight = nn.Parameter(kernel6)
-    
-    kernel7 = [[[[0, 0, 0, 0, 0], 
-                 [0, 0, 0, 0, 0], 
-                 [0, 0, 0, 0, 0],
-                 [0, 0, 0, 0, 0],
-                 [1, 0, 0, 0, 0]]]]
-    kernel7 = torch.from_numpy(np.array(kernel7)).float()
-    self.conv7 = nn.Conv2d(1, 1, kernel_size=(5, 5), stride=(1, 1), padding=(2, 2), bias=False)
-    self.conv7.weight = nn.Parameter(kernel7)
-    
-    kernel8 = [[[[0, 0, 0, 0, 0], 
-                 [0, 0, 0, 0, 0], 
-                 [0, 0, 0, 0, 0],
-                 [0, 0, 0, 0, 0],
-                 [0, 0, 0, 0, 1]]]]
-    kernel8 = torch.from_numpy(np.array(kernel8)).float()
-    self.conv8 = nn.Conv2d(1, 1, kernel_size=(5, 5), stride=(1, 1), padding=(2, 2), bias=False)
-    self.conv8.weight = nn.Parameter(kernel8)
-    self.one_hot1 = OneHotCategorical(torch.Tensor([1./8] * 8))
-    
-    for param in self.parameters():
-      param.requires_grad = False
+    # the offsets (dy, dx) of the kernels left, right, up, down and the four corners
+    self.register_buffer("offsets", torch.LongTensor([[0, 2], [0, -2], [2, 0], [-2, 0], [-2, -2], [-2, 2], [2, -2], [2, 2]]), persistent=False)
   
-  def forward(self, x):
-    switch = self.one_hot1.sample().cuda()
-    y = self.conv_left(x) * switch[0] + self.conv_right(x) * switch[1] + \
-        self.conv_up(x)   * switch[2] + self.conv_down(x)  * switch[3] + \
-        self.conv5(x)     * switch[4] + self.conv6(x)      * switch[5] + \
-        self.conv7(x)     * switch[6] + self.conv8(x)      * switch[7]
-    return y
+  def forward(self, x): # one of the 8 directions per sample
+    offset = self.offsets[torch.randint(len(self.offsets), (x.size(0),), device=self.offsets.device)].to(x.device)
+    return shift(x, offset[:, 0], offset[:, 1])
     
 class Transform4(nn.Module): # rand translation
   def __init__(self):
     super(Transform4, self).__init__()
-    self.conv_trans  = nn.Conv2d(1, 1, kernel_size=(5, 5), stride=(1, 1), padding=(2, 2), bias=False)
-    self.one_hot2 = OneHotCategorical(torch.Tensor([1/24., 1/24., 1/24., 1/24., 1/24.,
-                                                    1/24., 1/24., 1/24., 1/24., 1/24.,
-                                                    1/24., 1/24., 0.000, 1/24., 1/24.,
-                                                    1/24., 1/24., 1/24., 1/24., 1/24.,
-                                                    1/24., 1/24., 1/24., 1/24., 1/24.]))
-  def forward(self, x):
-    self.conv_trans.weight = nn.Parameter(self.one_hot2.sample().cuda().view(1,1,5,5))
-    y = self.conv_trans(x)
-    self.conv_trans.requires_grad = False
-    return y
+  def forward(self, x): # one of the 24 shifts in [-2, 2]^2 per sample
+    return shift(x, *random_shift(x.size(0), x.device))
     
 class Transform5(nn.Module): # combine
   def __init__(self):
@@ -383,31 +367,17 @@ class Transform5(nn.Module): # combine
     self.conv1 = nn.Conv2d(1, 1, kernel_size=(3, 3), stride=(1, 1), padding=(1, 1), bias=False)
     self.conv1.weight = nn.Parameter(kernel)
     
-    self.conv_trans1 = nn.Conv2d(1, 1, kernel_size=(5, 5), stride=(1, 1), padding=(2, 2), bias=False)
-    self.conv_trans2 = nn.Conv2d(1, 1, kernel_size=(5, 5), stride=(1, 1), padding=(2, 2), bias=False)
-    self.conv_trans3 = nn.Conv2d(1, 1, kernel_size=(5, 5), stride=(1, 1), padding=(2, 2), bias=False)
-    self.conv_trans4 = nn.Conv2d(1, 1, kernel_size=(5, 5), stride=(1, 1), padding=(2, 2), bias=False)
-    
     self.conv_smooth = nn.Conv2d(1, 1, kernel_size=(3, 3), stride=(1, 1), padding=(1, 1), bias=False)
-    self.conv_smooth.weight = nn.Parameter(torch.ones(9).cuda().view(1,1,3,3) * 1/9.)
+    self.conv_smooth.weight = nn.Parameter(torch.ones(9).view(1,1,3,3) * 1/9.)
     self.drop = nn.Dropout(p=0.05)
     self.relu = nn.ReLU(inplace=True)
     
-    self.one_hot1 = OneHotCategorical(torch.Tensor([0.6, 0.4]))
-    self.one_hot2 = OneHotCategorical(torch.Tensor([1/24., 1/24., 1/24., 1/24., 1/24.,
-                                                    1/24., 1/24., 1/24., 1/24., 1/24.,
-                                                    1/24., 1/24., 0.000, 1/24., 1/24.,
-                                                    1/24., 1/24., 1/24., 1/24., 1/24.,
-                                                    1/24., 1/24., 1/24., 1/24., 1/24.])) 
-    
     for param in self.parameters():
       param.requires_grad = False
   
   def forward(self, x):
-    # random translation 
-    self.conv_trans1.weight = nn.Parameter(self.one_hot2.sample().cuda().view(1,1,5,5))
-    self.conv_trans2.weight = nn.Parameter(self.one_hot2.sample().cuda().view(1,1,5,5))
-    y1 = self.conv_trans2(self.conv_trans1(x)) # equivalent to random crop
+    # random translation, twice
+    y1 = shift(shift(x, *random_shift(x.size(0), x.device)), *random_shift(x.size(0), x.device)) # equivalent to random crop
     
     # smooth
     # y2 = self.conv_smooth(x)
@@ -416,44 +386,62 @@ class Transform5(nn.Module): # combine
     y3 = (self.drop(self.conv1(x)) + x) / 2.
     
     # gaussian noise
-    # y4 = self.relu(torch.randn_like(x).cuda() * torch.mean(x) * 0.01)
-    
-    switch = self.one_hot1.sample().cuda()
-    y = y1 * switch[0] + y3 * switch[1]
+    # y4 = self.relu(torch.randn_like(x) * torch.mean(x) * 0.01)
     
-    for param in self.parameters():
-      param.requires_grad = False
-    return y
+    switch = (torch.rand(x.size(0), 1, 1, 1, device=x.device) < 0.6).to(x.dtype) # per sample: y1 with probability 0.6, else y3
+    return y1 * switch + y3 * (1 - switch)
      
-class Transform6(nn.Module): # resize or scale
-  def __init__(self):
-    super(Transform6, self).__init__()
-    
+class GeometricTransform(nn.Module): # per-sample translation, scale-crop and rotation, fused
+  '''
+    Every image gets its own random translation (a whole-pixel shift in [-max_shift, max_shift]^2 other than (0, 0), as
+    the one-hot kernels of Transform4), scale-crop (zoom in by a scale in 'scale' and crop at a random position, as
+    Transform6) and rotation (by whole degrees in [-max_angle, max_angle], as Transform7), each with probability 'p'.
+    The three are composed into one affine matrix per image, mapping the output coordinates to the input ones in the
+    normalized coordinates of affine_grid:
+      x_in = R(angle) x_out / scale + crop offset + shift
+    and applied with one affine_grid/grid_sample. The random numbers are drawn on the device of the images.
+  '''
+  def __init__(self, p=0.5, translate=True, scale_crop=True, rotate=True, max_shift=2, scale=(1.03125, 1.08125), max_angle=5):
+    super(GeometricTransform, self).__init__()
+    self.p = p
+    self.translate = translate; self.scale_crop = scale_crop; self.rotate = rotate
+    self.max_shift = max_shift; self.scale = scale; self.max_angle = max_angle
+  
+  def switch(self, n, device): # 1 for the images to transform
+    return (torch.rand(n, device=device) < self.p).float()
+  
+  def random_theta(self, n, h, w, device):
+    zeros = torch.zeros(n, device=device)
+    shift_x = shift_y = crop_x = crop_y = angle = zeros; scale = zeros + 1
+    if self.translate:
+      dy, dx = random_shift(n, device, self.max_shift)
+      on = self.switch(n, device)
+      shift_x = dx.float() * (2. / w) * on # a pixel is 2/w wide in the normalized coordinates
+      shift_y = dy.float() * (2. / h) * on
+    if self.scale_crop:
+      on = self.switch(n, device)
+      scale = 1 + (torch.rand(n, device=device) * (self.scale[1] - self.scale[0]) + self.scale[0] - 1) * on
+      margin = 1 - 1 / scale # the crop stays in the image
+      crop_x = (torch.rand(n, device=device) * 2 - 1) * margin
+      crop_y = (torch.rand(n, device=device) * 2 - 1) * margin
+    if self.rotate:
+      angle = torch.randint(-self.max_angle, self.max_angle + 1, (n,), device=device).float() * (math.pi / 180) * self.switch(n, device)
+    cos = torch.cos(angle) / scale; sin = torch.sin(angle) / scale
+    return torch.stack([torch.stack([cos, -sin, crop_x + shift_x], dim=1),
+                        torch.stack([sin,  cos, crop_y + shift_y], dim=1)], dim=1) # n x 2 x 3
+  
   def forward(self, x):
-    rand_scale = np.random.rand() * 0.05 + 1.03125
-    y = F.interpolate(x, scale_factor=rand_scale)
-    new_width = int(rand_scale*32)
-    w = np.random.randint(new_width-32); h = np.random.randint(new_width-32)
-    rand_crop = y[:, :, w:w+32, h:h+32]
-    return rand_crop
+    theta = self.random_theta(x.size(0), x.size(2), x.size(3), x.device)
+    grid = F.affine_grid(theta, x.size(), align_corners=False).to(x.dtype)
+    return F.grid_sample(x, grid, align_corners=False)
+    
+class Transform6(GeometricTransform): # resize or scale
+  def __init__(self):
+    super(Transform6, self).__init__(p=1, translate=False, rotate=False)
      
-class Transform7(nn.Module): # rotate
+class Transform7(GeometricTransform): # rotate
   def __init__(self):
-    super(Transform7, self).__init__()
-    
-  def forward(self, x):
-    theta = []
-    for _ in range(x.shape[0]):
-      angle = np.random.randint(-5, 6) / 180.0 * math.pi
-      # trans = np.arange(-2, 3) / 32. # 32: the width/height of the MNIST image is 32x32
-      # trans1 = trans[np.random.randint(len(trans))]
-      # trans2 = trans[np.random.randint(len(trans))]
-      theta.append([[math.cos(angle), -math.sin(angle), 0],
-                    [math.sin(angle),  math.cos(angle), 0]])
-    theta = torch.from_numpy(np.array(theta)).float().cuda()
-    grid = F.affine_grid(theta, x.size())
-    x = F.grid_sample(x, grid)
-    return x
+    super(Transform7, self).__init__(p=1, translate=False, scale_crop=False)
     
 class Transform9(nn.Module): # sharpen
   def __init__(self):
@@ -491,16 +479,44 @@ class Transform11(nn.Module): # Gaussian smoothing
   def forward(self, x):
     return self.conv1(x)
     
+class PhotometricTransform(nn.Module): # per-sample dropout, sharpen and smooth, fused
+  '''
+    Every image is sharpened (Transform9), smoothed (Transform10) and dropped out (Transform2, in training), each with
+    probability 'p', in one pass per filter: all the images go through one grouped 3x3 conv for sharpen and one for
+    smooth, with the identity kernel for the images without the filter, and the dropout mask is applied to the output.
+    Each conv zero-pads its own input, so the borders are the same as Transform9 and Transform10 in sequence.
+    The random numbers are drawn on the device of the images.
+  '''
+  def __init__(self, p=0.5, drop=0.08):
+    super(PhotometricTransform, self).__init__()
+    self.p = p; self.drop = drop
+    sharpen = torch.FloatTensor([[-1, -1, -1], [-1, 9, -1], [-1, -1, -1]])
+    smooth  = torch.FloatTensor([[1, 2, 1], [2, 4, 1], [1, 2, 1]]) * 0.0625 # Gaussian smoothing
+    identity = torch.zeros(3, 3); identity[1, 1] = 1
+    self.register_buffer("sharpen_kernels", torch.stack([identity, sharpen]), persistent=False) # by the switch
+    self.register_buffer("smooth_kernels", torch.stack([identity, smooth]), persistent=False)
+  
+  def switch(self, n, device): # 1 for the images to transform
+    return (torch.rand(n, device=device) < self.p).long()
+  
+  def forward(self, x):
+    n, c, h, w = x.shape
+    y = x.reshape(1, n * c, h, w)
+    for kernels in [self.sharpen_kernels, self.smooth_kernels]:
+      weight = kernels.to(x.device, x.dtype)[self.switch(n, x.device)].repeat_interleave(c, dim=0).view(n * c, 1, 3, 3)
+      y = F.conv2d(y, weight, padding=1, groups=n * c)
+    y = y.view(n, c, h, w)
+    if self.training and self.drop:
+      drop = self.drop * self.switch(n, x.device).to(y.dtype).view(n, 1, 1, 1) # 0 for the images without dropout
+      y = y * (torch.rand_like(y) >= drop).to(y.dtype) / (1 - drop)
+    return y
+    
 class Transform8(nn.Module): # random transform combination
   def __init__(self):
     super(Transform8, self).__init__()
-    self.T2 = Transform2()
-    self.T4 = Transform4()
-    self.T6 = Transform6()
-    self.T7 = Transform7()
-    self.T9 = Transform9()
-    self.T10 = Transform10()
-    self.transforms = [self.T2, self.T4, self.T6, self.T7, self.T9, self.T10]
+    self.geo = GeometricTransform()     # T4, T6 and T7, each with probability 0.5 per sample, in one pass
+    self.photo = PhotometricTransform() # T2, T9 and T10, each with probability 0.5 per sample, in one pass
+    self.transforms = [self.geo, self.photo]
     # for name, value in vars(self).items():
       # print(name)
       # if name[0] == "T" and name[1:].isdigit():
@@ -511,15 +527,15 @@ class Transform8(nn.Module): # random transform combination
   def forward(self, y):
     rand = np.random.permutation(len(self.transforms))
     Ts = self.transforms[rand]
-    for T in Ts:
-      if np.random.rand() >= 0.5:
-        y = T(y)
+    for T in Ts: # each draws its own per-sample switches
+      y = T(y)
     return y    
 
 # ---------------------------------------------------
 # AutoEncoder part
 Encoder = LeNet5
 Decoder = DLeNet5
+DecoderEnsemble = DLeNet5_Ensemble
 SmallEncoder = SmallLeNet5
 AdvEncoder = LeNet5_drop # deprecated
 
@@ -591,7 +607,7 @@ class AutoEncoder_BDSE_Trans(nn.Module):
   # Spatial transformer network forward function
   def stn(self, x):
     xs = self.localization(x) # shape: batch x 10 x 4 x 4
-    xs = xs.view(-1, 10 * 4 * 4)
+    xs = xs.reshape(-1, 10 * 4 * 4)
     theta = self.fc_loc(xs) # batch x 6
     theta = theta.view(-1, 2, 3)
     grid = F.affine_grid(theta, x.size())
@@ -641,7 +657,7 @@ class STN(nn.Module):
   # Spatial transformer network forward function
   def forward(self, x):
     xs = self.localization(x) # shape: batch x 10 x 4 x 4
-    xs = xs.view(-1, 10 * 4 * 4)
+    xs = xs.reshape(-1, 10 * 4 * 4)
     theta = self.fc_loc(xs) # batch x 6
     theta = theta.view(-1, 2, 3)
     grid = F.affine_grid(theta, x.size())
@@ -658,36 +674,41 @@ class AutoEncoder_BDSE_GAN2(nn.Module):
     self.advbe  = AdvEncoder(None, fixed=False); self.learned_trans = STN() # LearnedTransform(trans_model, fixed=False)
     self.advbe2 = AdvEncoder(None, fixed=False); self.learned_trans2 = LearnedTransform(trans_model, fixed=False)
 
+def get_pretrained_decoders(args):
+  pretrained_models = []
+  for di in range(1, args.num_dec+1):
+    pretrained_model = None
+    if args.pretrained_dir:
+      assert(args.pretrained_timeid != None)
+      pretrained_model = [x for x in os.listdir(args.pretrained_dir) if "_d%s_" % di in x and args.pretrained_timeid in x] # the number of pretrained decoder should be like "SERVER218-20190313-1233_d3_E0S0.pth"
+      assert(len(pretrained_model) == 1)
+      pretrained_model = pretrained_model[0]
+    pretrained_models.append(pretrained_model)
+  return pretrained_models
+
 class AutoEncoder_BDSE_GAN3(nn.Module):
   def __init__(self, args):
     super(AutoEncoder_BDSE_GAN3, self).__init__()
     self.be = Encoder(args.e1, fixed=True).eval()
     self.se = SmallEncoder(args.e2, fixed=False)
     self.defined_trans = Transform8()
-    for di in range(1, args.num_dec+1):
-      pretrained_model = None
-      if args.pretrained_dir:
-        assert(args.pretrained_timeid != None)
-        pretrained_model = [x for x in os.listdir(args.pretrained_dir) if "_d%s_" % di in x and args.pretrained_timeid in x] # the number of pretrained decoder should be like "SERVER218-20190313-1233_d3_E0S0.pth"
-        assert(len(pretrained_model) == 1)
-        pretrained_model = pretrained_model[0]
-      self.__setattr__("d" + str(di), Decoder(pretrained_model, fixed=False))
+    pretrained_models = get_pretrained_decoders(args)
+    if args.ensemble_dec:
+      self.dec_ensemble = DecoderEnsemble(args.num_dec, pretrained_models, fixed=False)
+    else:
+      self.decs = nn.ModuleList([Decoder(pretrained_models[di-1], fixed=False) for di in range(1, args.num_dec+1)]) # decoder di (1-based) is decs[di-1]
 
 class AutoEncoder_BDSE_GAN4(nn.Module):
   def __init__(self, args):
     super(AutoEncoder_BDSE_GAN4, self).__init__()
     self.be = Encoder(args.e1, fixed=True).eval()
     self.defined_trans = Transform8()
-    for di in range(1, args.num_dec+1):
-      pretrained_model = None
-      if args.pretrained_dir:
-        assert(args.pretrained_timeid != None)
-        pretrained_model = [x for x in os.listdir(args.pretrained_dir) if "_d%s_" % di in x and args.pretrained_timeid in x] # the number of pretrained decoder should be like "SERVER218-20190313-1233_d3_E0S0.pth"
-        assert(len(pretrained_model) == 1)
-        pretrained_model = pretrained_model[0]
-      self.__setattr__("d" + str(di), Decoder(pretrained_model, fixed=False))
-    for sei in range(1, args.num_se+1):
-      self.__setattr__("se" + str(sei), SmallEncoder(None, fixed=False))
+    pretrained_models = get_pretrained_decoders(args)
+    if args.ensemble_dec:
+      self.dec_ensemble = DecoderEnsemble(args.num_dec, pretrained_models, fixed=False)
+    else:
+      self.decs = nn.ModuleList([Decoder(pretrained_models[di-1], fixed=False) for di in range(1, args.num_dec+1)]) # decoder di (1-based) is decs[di-1]
+    self.ses = nn.ModuleList([SmallEncoder(None, fixed=False) for _ in range(args.num_se)])
       
 AutoEncoders = {
 "BD": AutoEncoder_BD,
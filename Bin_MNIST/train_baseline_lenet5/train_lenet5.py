@@ -2,7 +2,6 @@ from __future__ import print_function
 import sys
 import os
 pjoin = os.path.join
-os.environ["CUDA_VISIBLE_DEVICES"] = sys.argv[sys.argv.index("--gpu") + 1] # The args MUST has an option "--gpu".
 import shutil
 import time
 import argparse
@@ -21,6 +20,8 @@ import torchvision.utils as vutils
 import torchvision.transforms as transforms
 import torchvision.datasets as datasets
 # my libs
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))) # the repo root, for the shared modules in common/
+from common.device import add_device_args, set_up_device, to_device, loader_kwargs
 from model import LeNet5
 
 
@@ -36,7 +37,6 @@ if __name__ == "__main__":
   # Passed-in params
   parser = argparse.ArgumentParser(description="LeNet5")
   parser.add_argument('--model', type=str, default=None)
-  parser.add_argument('--gpu', type=int)
   parser.add_argument('--batch_size', type=int, default=64)
   parser.add_argument('--test_batch_size', type=int, default=100)
   parser.add_argument('--lr', type=float, help='learning rate', default=2e-3)
@@ -44,7 +44,9 @@ if __name__ == "__main__":
   parser.add_argument('-r', '--resume', action='store_true', help='if resume, default=False')
   parser.add_argument('--epoch', type=int, default=31)
   parser.add_argument('--debug', action="store_true")
+  add_device_args(parser)
   args = parser.parse_args()
+  device = set_up_device(args)
   
   # Get path
   args.model = glob.glob(args.model)[0] if args.model != None else None
@@ -69,7 +71,7 @@ if __name__ == "__main__":
   
   # Set up model
   net = LeNet5(args.model)
-  net.cuda()
+  net = to_device(net, args)
 
   # Prepare data
   data_train = datasets.MNIST('../data',
@@ -88,7 +90,7 @@ if __name__ == "__main__":
                                 transforms.ToTensor(),
                                 transforms.Normalize((0.1307,), (0.3081,))])
                              )
-  kwargs = {'num_workers': 4, 'pin_memory': True}
+  kwargs = loader_kwargs(args)
   train_loader = torch.utils.data.DataLoader(data_train, batch_size=args.batch_size,      shuffle=True,  **kwargs)
   test_loader  = torch.utils.data.DataLoader(data_test,  batch_size=args.test_batch_size, shuffle=False, **kwargs)
 
@@ -104,7 +106,7 @@ if __name__ == "__main__":
   for epoch in range(args.epoch):
     net.train()
     for step, (x, y) in enumerate(train_loader):
-      x, y = x.cuda(), y.cuda()
+      x, y = to_device(x, args), y.to(device)
       y_ = net(x) # logits
       loss = loss_func(y_, y.data)
       optimizer.zero_grad()
@@ -122,7 +124,7 @@ if __name__ == "__main__":
         net.eval()
         num_right = 0; avg_loss = 0
         for _, (x, y) in enumerate(test_loader):
-          x, y = x.cuda(), y.cuda()
+          x, y = to_device(x, args), y.to(device)
           y_ = net(x)
           avg_loss += loss_func(y_, y.data).sum()
           pred = y_.detach().max(1)[1]
@@ -0,0 +1,229 @@
+import torch
+import torch.nn.functional as F
+from common.loss import DistillLoss
+from common.ema import EMA
+from common.device import to_device, autocast, optimizer_kwargs
+from common.dist import allreduce_grads
+from common.replay import ReplayBuffer
+from common.metrics import accuracy
+
+# One GAN3/GAN4 training step of main.py: the decoder update (update_dec, or update_dec_ensemble with --ensemble_dec),
+# then the SE updates on its reconstructions (update_se), with the losses, optimizers, EMAs and the replay buffer they use.
+# main.py runs it on the sampled codes and the benchmarks (benchmarks/cases.py and benchmark_compile.py) on random models,
+# so they time the step main.py runs.
+
+def add_step_args(parser):
+  parser.add_argument('--num_dec', type=int, default=9)
+  parser.add_argument('--num_se', type=int, default=1)
+  parser.add_argument('--ensemble_dec', action="store_true", help="stack all the decoders and update them in one batched forward/backward")
+  parser.add_argument('--lr',  type=float, default=1e-3)
+  parser.add_argument('--b1',  type=float, default=5e-4, help='adam: decay of first order momentum of gradient')
+  parser.add_argument('--b2',  type=float, default=5e-4, help='adam: decay of second order momentum of gradient')
+  # ----------------------------------------------------------------
+  # various losses
+  parser.add_argument('--floss_weight',    type=float, default=1)
+  parser.add_argument('--ploss_weight',    type=float, default=2)
+  parser.add_argument('--softloss_weight', type=float, default=10) # According to the paper KD, the soft target loss weight should be considarably larger than that of hard target loss.
+  parser.add_argument('--hardloss_weight', type=float, default=1)
+  parser.add_argument('--tvloss_weight',   type=float, default=1e-6)
+  parser.add_argument('--normloss_weight', type=float, default=1e-4)
+  parser.add_argument('--daloss_weight',   type=float, default=10)
+  parser.add_argument('--advloss_weight',  type=float, default=20)
+  parser.add_argument('--lw_adv',  type=float, default=0.5)
+  parser.add_argument('--lw_class',  type=float, default=10)
+  parser.add_argument('--floss_lw', type=str, default="1-1-1-1-1-1-1")
+  parser.add_argument('--ploss_lw', type=str, default="1-1-1-1-1-1-1")
+  # ----------------------------------------------------------------
+  parser.add_argument('--Temp',  type=float, default=1, help="the Tempature in KD")
+  parser.add_argument('--ema_factor', type=float, default=0.9, help="Exponential Moving Average")
+  parser.add_argument('--ema_bf16', action="store_true", help="keep the EMA shadow weights in bfloat16")
+  parser.add_argument('--replay_capacity', type=int, default=0, help="the number of generated images kept for SE. 0: no replay, each batch is used by one SE step")
+  parser.add_argument('--replay_steps', type=int, default=1, help="the number of SE steps (on replayed batches) per decoder step")
+  parser.add_argument('--replay_policy', type=str, default="fifo", choices=["fifo", "reservoir"])
+  parser.add_argument('--replay_uniform', action="store_true", help="sample the replay buffer uniformly, not class-balanced")
+
+def make_ema(module, args):
+  ema = EMA(args.ema_factor, torch.bfloat16 if args.ema_bf16 else None)
+  for name, param in module.named_parameters():
+    if param.requires_grad:
+      ema.register(name, param.data)
+  return ema
+
+class GANStep():
+  '''
+    ae: a BDSE_GAN3 or BDSE_GAN4 model on args.device (args.adv_train: 3 or 4). timer: a StepTimer (see common/timing.py).
+    The models it updates, as lists for GAN3 (one SE) and GAN4 alike:
+      decs: the decoders, or [ae.dec_ensemble] with --ensemble_dec. ses: the SEs.
+    with their optimizers (optimizer_dec for all the decoders, optimizer_se one per SE) and EMAs (ema_dec, ema_se).
+  '''
+  def __init__(self, ae, args, timer):
+    self.ae = ae
+    self.args = args
+    self.timer = timer
+    self.decs = [ae.dec_ensemble] if args.ensemble_dec else list(ae.decs)
+    self.ses = [ae.se] if args.adv_train == 3 else list(ae.ses)
+
+    # Exponential moving average
+    self.ema_dec = [make_ema(dec, args) for dec in self.decs]
+    self.ema_se = [make_ema(se, args) for se in self.ses]
+
+    # Losses of the two reconstructions of a decoder and of SE. Terms with weight 0 are not computed.
+    self.ploss_lw = [float(x) for x in args.ploss_lw.split("-")]
+    self.loss_rec1_fn = DistillLoss({"tv": args.tvloss_weight, "norm": args.normloss_weight, "soft": args.softloss_weight, "hard": args.hardloss_weight,
+                                     "DT": args.daloss_weight, "class": args.lw_class * (args.adv_train == 4)}, temp=args.Temp, world_size=args.world_size)
+    self.loss_rec2_fn = DistillLoss({"tv": args.tvloss_weight, "norm": args.normloss_weight, "perc": args.ploss_weight, "soft": args.softloss_weight,
+                                     "hard": args.hardloss_weight}, temp=args.Temp, perc_lw=self.ploss_lw, world_size=args.world_size)
+    self.loss_se_fn = DistillLoss({"hard": args.hardloss_weight, "DT": args.daloss_weight}, world_size=args.world_size)
+    self.loss_rec1_fn.timer = self.loss_rec2_fn.timer = self.loss_se_fn.timer = timer
+
+    # Optimization. All the decoders are stepped by one Adam, with a param group per decoder (or one for the ensemble),
+    # so their hyperparameters can still be set apart.
+    opt_kwargs = optimizer_kwargs(args) # fused or foreach
+    self.optimizer_dec = torch.optim.Adam([{"params": dec.parameters()} for dec in self.decs], lr=args.lr, betas=(args.b1, args.b2), **opt_kwargs)
+    self.optimizer_se = [torch.optim.Adam(se.parameters(), lr=args.lr, betas=(args.b1, args.b2), **opt_kwargs) for se in self.ses]
+
+    # Replay buffer of the generated images and their teacher logits
+    self.replay = None
+    if args.replay_capacity:
+      self.replay = ReplayBuffer(args.replay_capacity, (1, 32, 32), args.num_class, args.device, policy=args.replay_policy, balanced=not args.replay_uniform)
+
+  def __call__(self, x, prob_gt, label, show=False):
+    '''
+      One step on the codes 'x' (logits / Temp) with their softmax 'prob_gt' and their labels. Return, as tensors on
+      the device: the hard loss and the accuracy of every decoder, the show losses (get_show_losses, the means over the
+      decoders) if 'show', and the hard loss and accuracy of SE1 of every SE step.
+    '''
+    update = self.update_dec_ensemble if self.args.ensemble_dec else self.update_dec
+    imgrec, imgrec_DT, logits_dec, hardloss_dec, trainacc_dec, show_losses = update(x, prob_gt, label, show=show)
+    se_stats = []
+    for batch in self.get_se_batches(imgrec, imgrec_DT, logits_dec, label):
+      for sei, se in enumerate(self.ses):
+        with self.timer.phase("se_update"):
+          stats = self.update_se(se, self.optimizer_se[sei], self.ema_se[sei], *batch)
+        if sei == 0: # the log print shows SE1
+          se_stats.append(stats)
+    return hardloss_dec, trainacc_dec, show_losses, se_stats
+
+  def adv_loss(self, imgrec1, label, groups=1):
+    # Adversarial loss, combat with SE. With groups > 1, it is computed per group (decoder) and summed.
+    args = self.args
+    advloss = 0
+    for se in self.ses:
+      hardloss_dse = F.cross_entropy(se(imgrec1).float(), label, reduction="none").view(groups, -1).mean(dim=1)
+      if args.adv_train == 3:
+        advloss += torch.sum(args.lw_adv / (hardloss_dse * args.hardloss_weight))
+      else:
+        advloss += torch.sum(args.lw_adv / hardloss_dse) * args.hardloss_weight
+    return advloss
+
+  def get_show_losses(self, losses1, losses2): # the weighted tv, norm and perceptual losses for the log print, summed over the decoders
+    args = self.args
+    return [losses1["tv"] * args.tvloss_weight, losses1["norm"] * args.normloss_weight] + \
+           [losses2["perc%s" % k] * args.ploss_weight * self.ploss_lw[k-1] for k in range(1, 5)]
+
+  def update_dec(self, x, prob_gt, label, show=False):
+    # The decoders are independent, so their losses are summed and back-propagated once. The adversarial
+    # loss runs SE once on the reconstructions of all the decoders.
+    ae, args, timer = self.ae, self.args, self.timer
+    imgrec = []; imgrec_DT = []; logits_dec = []; hardloss_dec = []; trainacc_dec = []; show_losses = []; loss = 0
+    with autocast(args): # the forwards and losses in bfloat16 with --amp. The backward runs outside.
+      for dec in self.decs:
+        dec.zero_grad()
+        with timer.phase("dec_forward"):     imgrec1 = dec(x)
+        with timer.phase("teacher_forward"): feats1 = ae.be.forward_branch(imgrec1); logits1 = feats1[-1]
+        with timer.phase("dec_forward"):     imgrec2 = dec(logits1)
+        with timer.phase("teacher_forward"): feats2 = ae.be.forward_branch(imgrec2); logits2 = feats2[-1]
+        with timer.phase("DT"):              imgrec1_DT = ae.defined_trans(imgrec1); logits1_DT = ae.be(imgrec1_DT) # DT: defined transform
+        imgrec.append(imgrec1); imgrec_DT.append(imgrec1_DT); logits_dec.append(logits1.detach()) # for SE
+
+        losses1 = self.loss_rec1_fn(img=imgrec1, logits=logits1, label=label, prob_target=prob_gt, logits_DT=logits1_DT,
+                                    extra_terms=["hard"] + ["tv", "norm"] * show)
+        losses2 = self.loss_rec2_fn(img=imgrec2, logits=logits2, label=label, prob_target=prob_gt, feats_rec=feats2, feats_ref=feats1,
+                                    extra_terms=["perc"] * show)
+        hardloss_dec.append((losses1["hard"] * args.hardloss_weight).detach()); trainacc_dec.append(accuracy(logits1, label))
+        if show:
+          show_losses.append(self.get_show_losses(losses1, losses2))
+
+        loss += losses1["total"] + losses2["total"]
+
+      # total loss
+      with timer.phase("adv_forward"):
+        loss += self.adv_loss(torch.cat(imgrec), label.repeat(args.num_dec), groups=args.num_dec)
+    with timer.phase("dec_backward"):
+      loss.backward()
+      allreduce_grads([p for dec in self.decs for p in dec.parameters()], args)
+    with timer.phase("optimizer"): self.optimizer_dec.step() # all the decoders at once
+    with timer.phase("ema"):
+      for ema in self.ema_dec:
+        ema.update()
+    show_losses = [sum(l).detach() / args.num_dec for l in zip(*show_losses)] if show else None # averaged over the decoders
+    return imgrec, imgrec_DT, logits_dec, torch.stack(hardloss_dec), torch.stack(trainacc_dec), show_losses
+
+  def update_dec_ensemble(self, x, prob_gt, label, show=False):
+    # Update all the decoders in ae.dec_ensemble with one batched forward/backward.
+    # The losses are computed per decoder (group) and summed, so each decoder has the same loss as in update_dec.
+    ae, args, timer = self.ae, self.args, self.timer
+    N = args.num_dec; B = x.size(0)
+    dec = ae.dec_ensemble; optimizer = self.optimizer_dec; ema = self.ema_dec[0]
+    label_all = label.repeat(N); prob_gt_all = prob_gt.repeat(N, 1)
+    dec.zero_grad()
+    with autocast(args):
+      with timer.phase("dec_forward"):     imgrec1 = dec(x)
+      with timer.phase("teacher_forward"): feats1 = ae.be.forward_branch(imgrec1.view(N*B, 1, 32, 32)); logits1 = feats1[-1]
+      with timer.phase("dec_forward"):     imgrec2 = dec(logits1.view(N, B, -1))
+      with timer.phase("teacher_forward"): feats2 = ae.be.forward_branch(imgrec2.view(N*B, 1, 32, 32)); logits2 = feats2[-1]
+      with timer.phase("DT"):              imgrec1_DT = ae.defined_trans(imgrec1.view(N*B, 1, 32, 32)); logits1_DT = ae.be(imgrec1_DT) # DT: defined transform
+
+      losses1 = self.loss_rec1_fn(groups=N, img=imgrec1, logits=logits1, label=label_all, prob_target=prob_gt_all, logits_DT=logits1_DT,
+                                  extra_terms=["hard"] + ["tv", "norm"] * show)
+      losses2 = self.loss_rec2_fn(groups=N, img=imgrec2, logits=logits2, label=label_all, prob_target=prob_gt_all, feats_rec=feats2, feats_ref=feats1,
+                                  extra_terms=["perc"] * show)
+      trainacc_dec = accuracy(logits1, label_all, groups=N)
+
+      # total loss
+      with timer.phase("adv_forward"):
+        loss = losses1["total"] + losses2["total"] + self.adv_loss(imgrec1.view(N*B, 1, 32, 32), label_all, groups=N)
+    with timer.phase("dec_backward"):
+      loss.backward()
+      allreduce_grads(dec.parameters(), args)
+    with timer.phase("optimizer"): optimizer.step()
+    with timer.phase("ema"):       ema.update()
+
+    imgrec = list(imgrec1.unbind(0)); imgrec_DT = list(imgrec1_DT.view(N, B, 1, 32, 32).unbind(0)) # for SE
+    logits_dec = list(logits1.detach().view(N, B, -1).unbind(0))
+    hardloss_dec = (losses1["hard_groups"] * args.hardloss_weight).detach()
+    show_losses = [l.detach() / N for l in self.get_show_losses(losses1, losses2)] if show else None # averaged over the decoders
+    return imgrec, imgrec_DT, logits_dec, hardloss_dec, trainacc_dec, show_losses
+
+  def update_se(self, se, optimizer, ema, imgrec, imgrec_DT, label_all):
+    # Update SE with the reconstructions of all the decoders and their DT images in one batch.
+    # label_all: the labels of torch.cat(imgrec). The per-decoder losses and accuracies are got by slicing the batch,
+    # and returned as tensors on the device.
+    args = self.args
+    N = len(imgrec); B = label_all.size(0) // N
+    se.zero_grad()
+    with autocast(args):
+      logits_all = se(torch.cat(imgrec + imgrec_DT).detach())
+      logits = logits_all[:N*B]; logits_DT = logits_all[N*B:]
+      losses_se = self.loss_se_fn(groups=N, logits=logits, label=label_all, logits_DT=logits_DT, extra_terms=["hard"])
+    losses_se["total"].backward()
+    allreduce_grads(se.parameters(), args)
+    optimizer.step()
+    ema.update()
+    return (losses_se["hard_groups"] * args.hardloss_weight).detach(), accuracy(logits, label_all, groups=N)
+
+  def get_se_batches(self, imgrec, imgrec_DT, logits_dec, label):
+    # The batches for the SE steps of this step: the new reconstructions, or with --replay_capacity,
+    # --replay_steps batches of the same size drawn from the replay buffer (with new DT images).
+    args = self.args
+    N = len(imgrec); B = label.size(0)
+    if not args.replay_capacity:
+      return [(imgrec, imgrec_DT, label.repeat(N))]
+    with self.timer.phase("replay"):
+      self.replay.add(torch.cat(imgrec), torch.cat(logits_dec), label.repeat(N))
+      batches = []
+      for _ in range(args.replay_steps):
+        imgs, _, labels = self.replay.sample(N * B)
+        imgs = list(to_device(imgs, args).split(B))
+        batches.append((imgs, [self.ae.defined_trans(x) for x in imgs], labels))
+    return batches
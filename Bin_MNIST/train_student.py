@@ -0,0 +1,83 @@
+from __future__ import print_function
+import sys
+import os
+import time
+import argparse
+# torch
+import torch
+import torch.nn.functional as F
+import torchvision.transforms as transforms
+import torchvision.datasets as datasets
+# my libs
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # the repo root, for the shared modules in common/
+from model import SmallEncoder
+from common.loss import DistillLoss
+from common.device import add_device_args, set_up_device, to_device, loader_kwargs, autocast
+from common.shards import ShardDataset
+pjoin = os.path.join
+
+# Train a student (SE) on a synthetic dataset written by export_data.py, with a standard DataLoader, and test it on
+# the MNIST test set after every epoch. e.g.,
+#   python train_student.py --data_dir ../Experiments/<TIME_ID>_<project_name>/synthetic_data_E10S0 --num_epoch 20
+
+# Passed-in params
+parser = argparse.ArgumentParser(description="Train a student on a synthetic dataset")
+parser.add_argument('--data_dir', type=str, required=True, help="the directory written by export_data.py")
+parser.add_argument('--out_dir', type=str, default=None, help="the directory to save the student. Default: data_dir")
+parser.add_argument('--e2', type=str, default=None, help="the initial weights of the student")
+parser.add_argument('--num_epoch', type=int, default=20)
+parser.add_argument('-b', '--batch_size', type=int, default=100)
+parser.add_argument('--lr', type=float, default=1e-3)
+parser.add_argument('--hardloss_weight', type=float, default=1)
+parser.add_argument('--softloss_weight', type=float, default=10)
+parser.add_argument('--Temp', type=float, default=1, help="the Tempature in KD")
+parser.add_argument('--num_workers', type=int, default=4)
+parser.add_argument('--show_interval', type=int, default=100, help="the interval to print logs")
+add_device_args(parser)
+args = parser.parse_args()
+args.out_dir = args.out_dir if args.out_dir else args.data_dir
+device = set_up_device(args)
+
+if __name__ == "__main__":
+  # Set up data and model
+  data_train = ShardDataset(args.data_dir)
+  data_test = datasets.MNIST('./MNIST_data', train=False, download=True,
+                              transform=transforms.Compose([
+                                transforms.Resize((32, 32)),
+                                transforms.ToTensor(),
+                                transforms.Normalize((0.1307,), (0.3081,))]))
+  kwargs = loader_kwargs(args, args.num_workers)
+  train_loader = torch.utils.data.DataLoader(data_train, batch_size=args.batch_size, shuffle=True, drop_last=True, **kwargs)
+  test_loader  = torch.utils.data.DataLoader(data_test,  batch_size=100, shuffle=False, **kwargs)
+  se = to_device(SmallEncoder(args.e2, fixed=False), args)
+  optimizer = torch.optim.Adam(se.parameters(), lr=args.lr)
+  loss_fn = DistillLoss({"hard": args.hardloss_weight, "soft": args.softloss_weight}, temp=args.Temp)
+  print("%s synthetic samples from %s" % (len(data_train), args.data_dir))
+
+  # Optimization
+  for epoch in range(args.num_epoch):
+    se.train()
+    t1 = time.time()
+    for step, (img, logits_t, label) in enumerate(train_loader):
+      img = to_device(img, args, non_blocking=True); logits_t = logits_t.to(device); label = label.to(device)
+      with autocast(args):
+        logits = se(img)
+        losses = loss_fn(logits=logits, label=label, prob_target=F.softmax(logits_t / args.Temp, dim=1), extra_terms=["hard", "soft"])
+      optimizer.zero_grad()
+      losses["total"].backward()
+      optimizer.step()
+      if step % args.show_interval == 0:
+        trainacc = logits.detach().argmax(dim=1).eq(label).float().mean().item()
+        print("E{}S{} | hard: {:.3f}({:.3f}) soft: {:.3f} ({:.3f}s/step)".format(epoch, step,
+            losses["hard"].item(), trainacc, losses["soft"].item(), (time.time() - t1) / (step + 1)))
+
+    # Test and save the student
+    se.eval()
+    test_acc = 0
+    with torch.no_grad():
+      for img, label in test_loader:
+        pred = se(to_device(img, args)).argmax(dim=1)
+        test_acc += pred.eq(label.to(device)).sum().item()
+    test_acc /= float(len(data_test))
+    print("E{} | =======> Test accuracy on SE: {:.4f}".format(epoch, test_acc))
+    torch.save(se.state_dict(), pjoin(args.out_dir, "se_E%s_testacc=%.4f.pth" % (epoch, test_acc)))
@@ -16,7 +16,6 @@ import math
 # torch
 import torch
 import torch.nn as nn
-from torch.utils.serialization import load_lua
 import torch.utils.data as Data
 from torch.utils.data import DataLoader
 import torchvision
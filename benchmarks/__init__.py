@@ -0,0 +1,5 @@
+# CPU microbenchmarks: forward and forward+backward of the models, the DT transforms, EMA and the full GAN4 training
+# steps of Bin_MNIST and Bin_CIFAR10, over batch sizes x numbers of threads, with the time and the peak memory of each,
+# written as JSON. Run from the repository root:
+#   python -m benchmarks --out bench.json
+# The cases are in cases.py.
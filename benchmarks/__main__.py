@@ -0,0 +1,59 @@
+from __future__ import print_function
+import os
+import json
+import argparse
+import numpy as np
+import torch
+from .cases import CASES
+from .util import measure, summarize, environment
+
+# Run the cases over batch sizes x numbers of threads on CPU and write the results as JSON, e.g.,
+#   python -m benchmarks --batch_sizes 1,64,256 --threads 1,4 --out bench.json
+#   python -m benchmarks --cases VGG19,CIFAR_GAN4_step --modes forward_backward,step --out bench.json
+#   python -m benchmarks.compare before.json after.json
+
+def int_list(x):
+  return [int(v) for v in x.split(",")]
+
+parser = argparse.ArgumentParser(description="CPU microbenchmarks")
+parser.add_argument('--cases', type=str, default=",".join(CASES.keys()), help="comma-separated case names")
+parser.add_argument('--modes', type=str, default=None, help="comma-separated modes to run. Default: all the modes of each case")
+parser.add_argument('--batch_sizes', type=int_list, default=[1, 16, 64])
+parser.add_argument('--threads', type=int_list, default=sorted({1, os.cpu_count()}), help="the numbers of intra-op threads")
+parser.add_argument('--num_warmup', type=int, default=3)
+parser.add_argument('--num_repeat', type=int, default=10)
+parser.add_argument('--out', type=str, default="benchmark.json")
+parser.add_argument('--list', action="store_true", help="list the cases and exit")
+args = parser.parse_args()
+
+if __name__ == "__main__":
+  if args.list:
+    print("\n".join(CASES.keys()))
+    exit(0)
+  names = args.cases.split(",")
+  modes = args.modes.split(",") if args.modes else None
+  for name in names:
+    assert(name in CASES), "unknown case: %s" % name
+
+  results = []
+  for name in names:
+    make, batched = CASES[name]
+    for batch_size in (args.batch_sizes if batched else [None]):
+      torch.manual_seed(0)
+      fns = make(batch_size)
+      for mode, fn in fns.items():
+        if modes and mode not in modes: continue
+        for num_threads in args.threads:
+          torch.set_num_threads(num_threads)
+          torch.manual_seed(0); np.random.seed(0) # the random transforms pick the same sequence in every run
+          times, peak = measure(fn, args.num_warmup, args.num_repeat)
+          r = dict(case=name, mode=mode, batch_size=batch_size, threads=num_threads, peak_rss_mb=peak, **summarize(times))
+          if batch_size:
+            r["samples_per_s"] = batch_size / r["time_ms"] * 1000
+          results.append(r)
+          print("%-16s %-16s bs %-5s threads %-3s %10.3f ms  peak %s MB" % (name, mode, batch_size, num_threads, r["time_ms"],
+                "%.1f" % peak if peak is not None else "n/a"), flush=True)
+
+  with open(args.out, "w") as f:
+    json.dump({"environment": environment(), "args": {k: v for k, v in vars(args).items() if k != "list"}, "results": results}, f, indent=2)
+  print("results written to %s" % args.out)
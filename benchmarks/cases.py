@@ -0,0 +1,116 @@
+import argparse
+from collections import OrderedDict
+import torch
+import torch.nn.functional as F
+from common.ema import EMA
+from common.device import add_device_args
+from common.timing import add_timing_args, StepTimer
+from common.sampler import CodeSampler
+from .util import load_module
+
+# The benchmark cases. A case is make(batch_size) -> {mode: fn}, where fn() runs the timed work once:
+#   forward:          the model in eval mode under no_grad
+#   forward_backward: the model in train mode, backward of the sum of the output
+#   update:           EMA.update() (no batch)
+#   step:             one training step of main.py (decoders + SE), by the GANStep of its train_step.py
+# The models have random weights, so no pretrained file is needed.
+
+def model_case(bin_dir, cls, input_shape, *args):
+  def make(batch_size):
+    model = getattr(load_module(bin_dir, "model"), cls)(*args)
+    x = torch.randn(batch_size, *input_shape)
+    def forward():
+      model.eval()
+      with torch.no_grad():
+        model(x)
+    def forward_backward():
+      model.train()
+      for p in model.parameters():
+        p.grad = None
+      model(x).float().sum().backward()
+    return {"forward": forward, "forward_backward": forward_backward}
+  return make
+
+def transform_case(bin_dir, cls, input_shape):
+  # The DT transforms are applied to the decoder outputs in training, so the backward goes through them to the input.
+  def make(batch_size):
+    trans = getattr(load_module(bin_dir, "model"), cls)()
+    x = torch.randn(batch_size, *input_shape)
+    x_grad = x.clone().requires_grad_()
+    def forward():
+      with torch.no_grad():
+        trans(x)
+    def forward_backward():
+      x_grad.grad = None
+      trans(x_grad).sum().backward()
+    return {"forward": forward, "forward_backward": forward_backward}
+  return make
+
+def ema_case(shadow_dtype=None):
+  # EMA over the params of the CIFAR10 decoder (DVGG19_deconv)
+  def make(batch_size):
+    dec = load_module("Bin_CIFAR10", "model").DVGG19_deconv(100)
+    ema = EMA(0.9, shadow_dtype)
+    for name, param in dec.named_parameters():
+      ema.register(name, param.data)
+    ema.update() # builds the flat shadow
+    return {"update": ema.update}
+  return make
+
+def step_args(bin_dir, **kwargs):
+  # The default args of the training step of <bin_dir>/main.py (add_step_args), on CPU and one process,
+  # with 'kwargs' for the args of main.py the step and the model read
+  parser = argparse.ArgumentParser()
+  load_module(bin_dir, "train_step").add_step_args(parser)
+  add_device_args(parser)
+  add_timing_args(parser)
+  args = parser.parse_args([])
+  args.device = torch.device("cpu"); args.world_size = 1; args.rank = 0
+  vars(args).update(kwargs)
+  return args
+
+def mnist_gan4_step():
+  # The GANStep of Bin_MNIST/train_step.py (update_dec + update_se of main.py) with the default GAN4 args, on random logit codes
+  def make(batch_size):
+    args = step_args("Bin_MNIST", mode="BDSE_GAN4", adv_train=4, num_class=10, e1=None, pretrained_dir=None, pretrained_timeid=None)
+    ae = load_module("Bin_MNIST", "model").AutoEncoders[args.mode](args).train()
+    gan_step = load_module("Bin_MNIST", "train_step").GANStep(ae, args, StepTimer(args, args.device))
+    x, label = CodeSampler(batch_size, args.num_class, args.device, noise_range=(2., 7.), peak_range=(20, 25)).next()
+    prob_gt = F.softmax(x, dim=1)
+    return {"step": lambda: gan_step(x, prob_gt, label)}
+  return make
+
+def cifar_gan4_step(dataset="CIFAR10", act_checkpoint="none"):
+  # The GANStep of Bin_CIFAR10/train_step.py (the codemap + decoder update and the SE update of main.py) with the
+  # default GAN4 args, on random z codes, and the decoder checkpointing of --act_checkpoint.
+  # The MSGAN loss pairs the two halves of a batch, so an odd batch size is skipped.
+  def make(batch_size):
+    if batch_size % 2: return {}
+    args = step_args("Bin_CIFAR10", dataset=dataset, mode="GAN4", num_divbranch=1, num_z=100, num_class=10, e1=None, e2=None,
+                     pretrained_dir=None, use_condition=False, gray=False, deep_lenet5="00", act_checkpoint=act_checkpoint)
+    ae = load_module("Bin_CIFAR10", "model").AutoEncoders[args.mode](args).train()
+    gan_step = load_module("Bin_CIFAR10", "train_step").GANStep(ae, args, StepTimer(args, args.device))
+    x, _ = CodeSampler(batch_size, args.num_class, args.device, num_z=args.num_z, paired=bool(args.lw_msgan)).next()
+    return {"step": lambda: gan_step(x)}
+  return make
+
+# name -> (make, whether it runs over the batch sizes)
+CASES = OrderedDict([
+  ("LeNet5",           (model_case("Bin_MNIST",   "LeNet5",         (1, 32, 32)), True)),
+  ("LeNet5_deep",      (model_case("Bin_CIFAR10", "LeNet5_deep",    (1, 32, 32)), True)),
+  ("SmallLeNet5",      (model_case("Bin_MNIST",   "SmallLeNet5",    (1, 32, 32)), True)),
+  ("DLeNet5",          (model_case("Bin_MNIST",   "DLeNet5",        (10,)), True)),
+  ("DLeNet5_deconv",   (model_case("Bin_CIFAR10", "DLeNet5_deconv", (100,), 100), True)),
+  ("VGG19",            (model_case("Bin_CIFAR10", "VGG19",          (3, 32, 32)), True)),
+  ("SmallVGG19",       (model_case("Bin_CIFAR10", "SmallVGG19",     (3, 32, 32)), True)),
+  ("DVGG19_deconv",    (model_case("Bin_CIFAR10", "DVGG19_deconv",  (100,), 100), True)),
+  ("AlexNet_Encoder",  (model_case("Bin_AlexNet", "AlexNet_Encoder", (3, 227, 227)), True)),
+  ("AlexNet_Decoder",  (model_case("Bin_AlexNet", "AlexNet_Decoder", (1000,)), True)),
+  ("Transform8",       (transform_case("Bin_MNIST",   "Transform8", (1, 32, 32)), True)),
+  ("Transform",        (transform_case("Bin_CIFAR10", "Transform",  (3, 32, 32)), True)),
+  ("EMA",              (ema_case(), False)),
+  ("EMA_bf16",         (ema_case(torch.bfloat16), False)),
+  ("MNIST_GAN4_step",  (mnist_gan4_step(), True)),
+  ("CIFAR_GAN4_step",  (cifar_gan4_step(), True)),
+  ("CIFAR_GAN4_step_ckpt", (cifar_gan4_step(act_checkpoint="all"), True)),
+])
@@ -0,0 +1,21 @@
+from __future__ import print_function
+import sys
+import json
+
+# Compare two result files of "python -m benchmarks": the time of every (case, mode, batch size, threads) in both,
+# and the speedup of the second over the first.
+#   python -m benchmarks.compare before.json after.json
+
+def load(path):
+  with open(path) as f:
+    results = json.load(f)["results"]
+  return {(r["case"], r["mode"], r["batch_size"], r["threads"]): r for r in results}
+
+if __name__ == "__main__":
+  assert(len(sys.argv) == 3), "usage: python -m benchmarks.compare before.json after.json"
+  before, after = load(sys.argv[1]), load(sys.argv[2])
+  print("%-16s %-16s %-5s %-7s %12s %12s %8s" % ("case", "mode", "bs", "threads", "before (ms)", "after (ms)", "speedup"))
+  for key in before:
+    if key not in after: continue
+    t0, t1 = before[key]["time_ms"], after[key]["time_ms"]
+    print("%-16s %-16s %-5s %-7s %12.3f %12.3f %7.2fx" % (key + (t0, t1, t0 / t1)))
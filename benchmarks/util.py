@@ -0,0 +1,74 @@
+import os
+import sys
+import time
+import ctypes
+import ctypes.util
+import importlib.util
+import numpy as np
+import torch
+pjoin = os.path.join
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def load_module(bin_dir, name):
+  '''
+    Import <ROOT>/<bin_dir>/<name>.py as the module "<bin_dir>_<name>". Every Bin dir has its own model.py,
+    so they cannot be imported by their plain names side by side.
+  '''
+  key = "%s_%s" % (bin_dir, name)
+  if key not in sys.modules:
+    spec = importlib.util.spec_from_file_location(key, pjoin(ROOT, bin_dir, name + ".py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[key] = module
+    spec.loader.exec_module(module)
+  return sys.modules[key]
+
+# Memory: the peak resident set size (VmHWM) of this process, which Linux resets on writing "5" to /proc/self/clear_refs.
+# The memory freed by the previous runs is first given back to the OS (glibc malloc_trim), so that the peak counts
+# the memory a run takes, not the free memory it reuses. Where that is not available, no peak memory is reported.
+def malloc_trim():
+  try:
+    ctypes.CDLL(ctypes.util.find_library("c")).malloc_trim(0)
+  except (OSError, AttributeError):
+    pass
+
+def read_status(field): # in MB
+  with open("/proc/self/status") as f:
+    for line in f:
+      if line.startswith(field + ":"):
+        return int(line.split()[1]) / 1024.
+  return None
+
+def reset_peak_rss():
+  malloc_trim()
+  try:
+    with open("/proc/self/clear_refs", "w") as f:
+      f.write("5")
+    return read_status("VmRSS")
+  except (IOError, OSError):
+    return None
+
+def measure(fn, num_warmup, num_repeat):
+  '''
+    Run fn() 'num_warmup' times, then time it 'num_repeat' times. Return the times in seconds and the peak memory
+    (MB) over the RSS before the first run, or None.
+  '''
+  base = reset_peak_rss()
+  for _ in range(num_warmup):
+    fn()
+  times = []
+  for _ in range(num_repeat):
+    t0 = time.perf_counter()
+    fn()
+    times.append(time.perf_counter() - t0)
+  peak = read_status("VmHWM") - base if base is not None else None
+  return times, peak
+
+def summarize(times):
+  times = np.array(times) * 1000
+  return {"time_ms": float(np.median(times)), "time_ms_min": float(times.min()), "time_ms_std": float(times.std())}
+
+def environment():
+  return {"torch": torch.__version__, "python": sys.version.split()[0], "platform": sys.platform,
+          "cpu_count": os.cpu_count(), "mkldnn": torch.backends.mkldnn.is_available(),
+          "time": time.strftime("%Y/%m/%d-%H:%M:%S")}
@@ -0,0 +1,6 @@
+# The modules shared by the training scripts of Bin_MNIST, Bin_CIFAR10 and Bin_AlexNet: the distillation losses (loss),
+# the device set-up (device), compiling (jit), activation checkpointing (act_checkpoint), multi-process training (dist),
+# the EMA of the weights (ema), checkpoints (checkpoint), the code sampler (sampler), sample images (samples), the replay
+# buffer (replay), dataset shards (shards), step timing (timing) and the training metrics (metrics). A script in a Bin dir
+# puts the repository root on sys.path and imports them as
+#   from common.loss import DistillLoss
@@ -0,0 +1,58 @@
+import torch
+import torch.nn as nn
+import torch.utils.checkpoint as cp
+
+# Activation checkpointing of the decoders (and the encoder passes over their outputs), to fit larger batches in the same memory:
+#   "none":  keep all the activations for the backward.
+#   "stage": keep only the output of each stage (e.g., an upsample-conv block of a decoder); the activations
+#            inside a stage are recomputed in the backward.
+#   "all":   keep only the input; the whole forward is recomputed in the backward.
+# Without grad (e.g., test), nothing is checkpointed.
+CHECKPOINT_MODES = ["none", "stage", "all"]
+
+class FrozenBNStats():
+  '''
+    The context of the recompute, which must not update the BN running stats of 'module' a second time.
+    It can be entered any number of times (e.g., a graph backpropagated more than once recomputes in every pass):
+    the stats are saved at every entry and restored at the exit.
+  '''
+  def __init__(self, module):
+    self.bns = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+
+  def __enter__(self):
+    self.states = [(m.momentum, m.num_batches_tracked.clone()) for m in self.bns]
+    for m in self.bns:
+      m.momentum = 0.
+    return self
+
+  def __exit__(self, *exc):
+    for m, (momentum, num_batches_tracked) in zip(self.bns, self.states):
+      m.momentum = momentum
+      m.num_batches_tracked.copy_(num_batches_tracked)
+    return False
+
+class NoContext(): # a re-entrant no-op context, for the forward
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    return False
+
+def run_stages(stages, y, mode="none", module=None):
+  '''
+    Run y through 'stages' (callables) with activation checkpointing 'mode'. 'module' holds the BN layers of the stages, if any.
+  '''
+  assert(mode in CHECKPOINT_MODES)
+  def run(y, stages=stages):
+    for stage in stages:
+      y = stage(y)
+    return y
+  if mode == "none" or not torch.is_grad_enabled():
+    return run(y)
+  recompute = FrozenBNStats(module) if module is not None else NoContext()
+  context_fn = lambda: (NoContext(), recompute)
+  if mode == "all":
+    return cp.checkpoint(run, y, use_reentrant=False, context_fn=context_fn)
+  for stage in stages:
+    y = cp.checkpoint(stage, y, use_reentrant=False, context_fn=context_fn)
+  return y
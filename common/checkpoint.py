@@ -0,0 +1,159 @@
+import os
+import json
+import mmap
+import struct
+import threading
+import queue
+import numpy as np
+import torch
+
+# Save checkpoints without stalling training: save() copies the tensors to host memory right away and
+# a background thread writes them to disk. A file is written to "<path>.tmp" and then renamed, so a
+# checkpoint on disk is always complete.
+#
+# The full training state of a step (the models, optimizers, EMA shadows, code sampler, RNG and the step) is written
+# by save_state as one file that load_state memory-maps:
+#   magic (8 bytes) | index length (8 bytes, little-endian) | index (JSON) | tensor data
+# Every tensor starts at a multiple of ALIGN bytes. The index has the dtype, shape and offset of each tensor and the
+# nested dicts/lists of the state, with {"__tensor__": i} in place of tensor i. load_state maps the file copy-on-write
+# and returns tensors that are views into the map, so nothing is read until it is used (e.g., by load_state_dict).
+
+def snapshot(obj): # copy the tensors in a (nested) state_dict to CPU
+  if torch.is_tensor(obj):
+    return obj.detach().to("cpu", copy=True)
+  if isinstance(obj, dict):
+    return obj.__class__((k, snapshot(v)) for k, v in obj.items())
+  if isinstance(obj, (list, tuple)):
+    return obj.__class__(snapshot(v) for v in obj)
+  return obj
+
+def atomic_save(obj, path):
+  tmp_path = path + ".tmp"
+  torch.save(obj, tmp_path)
+  os.replace(tmp_path, path)
+
+MAGIC = b"KTSTATE1"
+ALIGN = 64
+
+def encode(obj, tensors): # the JSON tree of 'obj', with its tensors appended to 'tensors'
+  if torch.is_tensor(obj):
+    tensors.append(obj)
+    return {"__tensor__": len(tensors) - 1}
+  if isinstance(obj, dict): # keep the keys as they are, e.g., the int param ids of an optimizer state_dict
+    return {"__dict__": [[k, encode(v, tensors)] for k, v in obj.items()]}
+  if isinstance(obj, tuple):
+    return {"__tuple__": [encode(v, tensors) for v in obj]}
+  if isinstance(obj, list):
+    return [encode(v, tensors) for v in obj]
+  assert(obj is None or isinstance(obj, (bool, int, float, str))), "cannot save %s" % type(obj)
+  return obj
+
+def decode(tree, tensors):
+  if isinstance(tree, list):
+    return [decode(v, tensors) for v in tree]
+  if isinstance(tree, dict):
+    if "__tensor__" in tree:
+      return tensors[tree["__tensor__"]]
+    if "__tuple__" in tree:
+      return tuple(decode(v, tensors) for v in tree["__tuple__"])
+    return {k if not isinstance(k, list) else tuple(k): decode(v, tensors) for k, v in tree["__dict__"]}
+  return tree
+
+def save_state(state, path):
+  '''
+    Write 'state' (nested dicts/lists/tuples of tensors and plain values) as one memory-mappable file, atomically.
+  '''
+  tensors = []
+  tree = encode(state, tensors)
+  tensors = [t.detach().to("cpu").contiguous() for t in tensors]
+  entries = []; offset = 0
+  for t in tensors:
+    nbytes = t.numel() * t.element_size()
+    entries.append({"dtype": str(t.dtype).split(".")[-1], "shape": list(t.shape), "offset": offset, "nbytes": nbytes})
+    offset += (nbytes + ALIGN - 1) // ALIGN * ALIGN
+  index = json.dumps({"tensors": entries, "state": tree}).encode()
+  data_start = (len(MAGIC) + 8 + len(index) + ALIGN - 1) // ALIGN * ALIGN
+  tmp_path = path + ".tmp"
+  with open(tmp_path, "wb") as f:
+    f.write(MAGIC); f.write(struct.pack("<Q", len(index))); f.write(index)
+    for t, e in zip(tensors, entries):
+      f.seek(data_start + e["offset"])
+      if e["nbytes"]:
+        f.write(memoryview(t.reshape(-1).view(torch.uint8).numpy()))
+    f.truncate(data_start + offset)
+  os.replace(tmp_path, path)
+
+def load_state(path):
+  '''
+    Map a file of save_state and return its state. The tensors are on CPU, backed by the (copy-on-write) map.
+  '''
+  with open(path, "rb") as f:
+    assert(f.read(len(MAGIC)) == MAGIC), "%s is not a state file" % path
+    index_len = struct.unpack("<Q", f.read(8))[0]
+    index = json.loads(f.read(index_len).decode())
+    data_start = (len(MAGIC) + 8 + index_len + ALIGN - 1) // ALIGN * ALIGN
+    buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY) # writable for torch, but never written back
+  data = torch.frombuffer(buf, dtype=torch.uint8) if len(buf) else torch.empty(0, dtype=torch.uint8)
+  tensors = []
+  for e in index["tensors"]:
+    start = data_start + e["offset"]
+    t = data[start: start + e["nbytes"]].view(getattr(torch, e["dtype"]))
+    tensors.append(t.view(e["shape"]))
+  return decode(index["state"], tensors)
+
+def rng_state():
+  state = {"torch": torch.get_rng_state(), "numpy": list(np.random.get_state())}
+  state["numpy"][1] = torch.from_numpy(state["numpy"][1].astype(np.int64)) # the MT19937 keys
+  if torch.cuda.is_available():
+    state["cuda"] = torch.cuda.get_rng_state_all()
+  return state
+
+def set_rng_state(state):
+  torch.set_rng_state(state["torch"].clone())
+  numpy_state = list(state["numpy"])
+  numpy_state[1] = numpy_state[1].numpy().astype(np.uint32)
+  np.random.set_state(tuple(numpy_state))
+  if "cuda" in state and torch.cuda.is_available():
+    torch.cuda.set_rng_state_all([s.clone() for s in state["cuda"]])
+
+class CheckpointWriter():
+  '''
+    max_queue: the max number of snapshots waiting to be written. save() blocks when the queue is full,
+      which bounds the host memory taken by the snapshots.
+  '''
+  def __init__(self, max_queue=2):
+    self.queue = queue.Queue(maxsize=max_queue)
+    self.error = None
+    self.thread = threading.Thread(target=self.run, daemon=True)
+    self.thread.start()
+
+  def save(self, obj, path, save_fn=atomic_save): # save_fn=save_state for a state file
+    self.check()
+    self.queue.put((snapshot(obj), path, save_fn))
+
+  def run(self):
+    while True:
+      item = self.queue.get()
+      if item is None:
+        self.queue.task_done()
+        break
+      obj, path, save_fn = item
+      try:
+        save_fn(obj, path)
+      except Exception as e: # raise it in the training thread at the next save() or close()
+        self.error = e
+      self.queue.task_done()
+
+  def check(self):
+    if self.error is not None:
+      error, self.error = self.error, None
+      raise error
+
+  def flush(self): # wait until all the queued checkpoints are on disk
+    self.queue.join()
+    self.check()
+
+  def close(self):
+    self.queue.put(None)
+    self.thread.join()
+    self.check()
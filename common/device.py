@@ -0,0 +1,67 @@
+import os
+import torch
+
+# Device set-up shared by the scripts. Without a GPU (or with "--device cpu") everything runs on CPU.
+
+def add_device_args(parser):
+  parser.add_argument('--gpu', type=str, default=None, help="which gpu(s) to run on, e.g., '0' or '0,1'. It sets CUDA_VISIBLE_DEVICES")
+  parser.add_argument('--device', type=str, default=None, help="'cpu', 'cuda' or 'cuda:k'. default: cuda if available, else cpu")
+  parser.add_argument('--num_threads', type=int, default=0, help="the number of intra-op threads on CPU. 0: the torch default")
+  parser.add_argument('--num_interop_threads', type=int, default=0, help="the number of inter-op threads on CPU. 0: the torch default")
+  parser.add_argument('--channels_last', action="store_true", help="use the channels_last memory format for the conv models and images")
+  parser.add_argument('--amp', action="store_true", help="run the forwards under bfloat16 autocast, on CPU or GPU")
+
+def set_up_device(args):
+  '''
+    Set the threads and return the torch.device to run on. It also sets 'args.device' to it.
+    It must be called before anything runs on CUDA.
+  '''
+  if args.gpu is not None:
+    os.environ["CUDA_VISIBLE_DEVICES"] = str(args.gpu)
+  if args.num_threads > 0:
+    torch.set_num_threads(args.num_threads)
+  if args.num_interop_threads > 0:
+    torch.set_num_interop_threads(args.num_interop_threads) # only allowed once, before any inter-op parallel work
+  if args.device is None:
+    args.device = "cuda" if torch.cuda.is_available() else "cpu"
+  args.device = torch.device(args.device)
+  return args.device
+
+def memory_format(args):
+  return torch.channels_last if args.channels_last else torch.contiguous_format
+
+def to_device(x, args, non_blocking=False):
+  '''
+    Move a model or a tensor to args.device. The 4-d tensors (conv weights and images) are put into
+    the channels_last memory format if args.channels_last.
+  '''
+  if isinstance(x, torch.nn.Module):
+    x = x.to(args.device)
+    for p in list(x.parameters()) + list(x.buffers()):
+      if p.dim() == 4: # Module.to(memory_format) would also try the 5-d stacked weights of the decoder ensemble
+        p.data = p.data.contiguous(memory_format=memory_format(args))
+    return x
+  if x.dim() == 4:
+    return x.to(args.device, memory_format=memory_format(args), non_blocking=non_blocking)
+  return x.to(args.device, non_blocking=non_blocking)
+
+def loader_kwargs(args, num_workers=4):
+  return {'num_workers': num_workers, 'pin_memory': args.device.type == "cuda"} # pinned memory only helps the copy to GPU
+
+def optimizer_kwargs(args):
+  '''
+    The multi-tensor implementation of Adam for args.device: fused, if this torch has it for the device, else foreach.
+    One step then updates all the params of all the param groups in a few kernels, not a few per param.
+  '''
+  try: # an older torch has no fused Adam, or only on GPU
+    torch.optim.Adam([torch.zeros(1, device=args.device, requires_grad=True)], fused=True)
+    return {"fused": True}
+  except (RuntimeError, TypeError):
+    return {"foreach": True}
+
+def autocast(args):
+  '''
+    The context to run the forwards and losses in: bfloat16 autocast if args.amp, else a no-op.
+    Keep the backward out of it. The numerically sensitive losses are computed in float32 (see loss.py).
+  '''
+  return torch.autocast(device_type=args.device.type, dtype=torch.bfloat16, enabled=args.amp)
@@ -0,0 +1,70 @@
+import os
+import numpy as np
+import torch
+import torch.distributed as td
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+# Data-parallel training over several processes, e.g., on the CPU cores of one node with the gloo backend:
+#   torchrun --standalone --nproc_per_node 8 main.py --num_threads 8 ...
+# Every process (rank) starts from the weights of rank 0 and trains on its own shard of each batch, i.e., its own
+# random codes (or real images). The gradients are averaged over the ranks before every optimizer step, so all the
+# ranks take the same steps and keep the same weights. Logs, sample images, tests and checkpoints are on rank 0.
+# Averaging the grads gives the grad of the full batch for the terms that are means over the batch. The terms that are
+# sums over it, or that take the batch as a whole (L_ie of DFL), are made to match by DistillLoss(world_size=...):
+# see loss.py and mean_over_ranks.
+# Without torchrun (no WORLD_SIZE in the environment), it is the usual single-process training.
+
+def add_dist_args(parser):
+  parser.add_argument('--dist_backend', type=str, default="gloo", help="the backend of multi-process training under torchrun")
+
+def set_up_dist(args):
+  '''
+    Join the process group if launched by torchrun. It sets 'args.rank' and 'args.world_size' and gives each
+    rank its own random seeds (torch and numpy), so the ranks draw different codes and transforms.
+  '''
+  args.world_size = int(os.environ.get("WORLD_SIZE", 1))
+  args.rank = int(os.environ.get("RANK", 0))
+  if args.world_size > 1:
+    td.init_process_group(args.dist_backend)
+    torch.manual_seed(torch.initial_seed() + args.rank)
+    np.random.seed(torch.initial_seed() % 2 ** 32)
+  return args.world_size > 1
+
+def is_main(args):
+  return args.rank == 0
+
+def local_batch_size(args): # the shard of the batch of one rank
+  assert(args.batch_size % args.world_size == 0)
+  return args.batch_size // args.world_size
+
+def broadcast_module(module, args): # copy the params and buffers of rank 0 to all the ranks
+  if args.world_size == 1: return
+  for x in list(module.parameters()) + list(module.buffers()):
+    td.broadcast(x.data, 0)
+
+def allreduce_grads(params, args):
+  '''
+    Average the grads of 'params' over the ranks, with one all_reduce on a flat buffer. Every rank must have
+    grads for the same params, which holds since they run the same graph.
+  '''
+  if args.world_size == 1: return
+  grads = [p.grad for p in params if p.grad is not None]
+  if not grads: return
+  flat = _flatten_dense_tensors(grads)
+  td.all_reduce(flat)
+  flat /= args.world_size
+  for g, x in zip(grads, _unflatten_dense_tensors(flat, grads)):
+    g.copy_(x)
+
+def mean_over_ranks(x):
+  '''
+    The mean of 'x' over the ranks. The grad flows to the local 'x' as if it was the mean itself (i.e., not divided by
+    the number of ranks), so that once allreduce_grads has averaged the grads, every rank has the full-batch grad.
+  '''
+  total = x.detach().clone()
+  td.all_reduce(total)
+  return x + (total / td.get_world_size() - x).detach()
+
+def clean_up_dist(args):
+  if args.world_size > 1:
+    td.destroy_process_group()
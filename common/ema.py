@@ -0,0 +1,66 @@
+import torch
+
+# Exponential Moving Average
+# The shadow weights of all the registered params (usually one module) are kept in one flat buffer
+# and updated in place with multi-tensor ops, so an update allocates no new tensors:
+#   shadow = mu * shadow + (1 - mu) * param; param = shadow
+# shadow_dtype=torch.bfloat16 halves the memory of the shadow, while the params stay in their own precision.
+# The average is then taken in the precision of the params, in a work buffer of that precision preallocated by build():
+# the params are split into groups that fit in it, and each group is updated with the same multi-tensor ops, with the
+# shadow widened into the buffer. The buffer has the size of the largest param, not of the whole shadow.
+class EMA():
+  def __init__(self, mu, shadow_dtype=None):
+    self.mu = mu
+    self.shadow_dtype = shadow_dtype
+    self.names = []; self.params = []; self.init_vals = []
+    self.shadow = {} # name -> view into self.flat
+    self.flat = None
+  def register(self, name, val): # 'val' must share storage with the param, e.g., param.data
+    assert name not in self.names
+    self.names.append(name); self.params.append(val); self.init_vals.append(val.clone())
+    self.flat = None
+  def build(self):
+    dtype = self.shadow_dtype if self.shadow_dtype else self.params[0].dtype
+    self.flat = torch.empty(sum(p.numel() for p in self.params), dtype=dtype, device=self.params[0].device)
+    self.shadows = []; offset = 0
+    for name, val in zip(self.names, self.init_vals):
+      s = self.flat[offset: offset + val.numel()].view_as(val)
+      s.copy_(val); offset += val.numel()
+      self.shadows.append(s); self.shadow[name] = s
+    self.init_vals = []
+    self.groups = [] # (shadows, params, views into the work buffer), for a low-precision shadow
+    if dtype != self.params[0].dtype:
+      size = max(p.numel() for p in self.params)
+      work = torch.empty(size, dtype=self.params[0].dtype, device=self.params[0].device)
+      offset = size
+      for s, p in zip(self.shadows, self.params):
+        if offset + p.numel() > size: # a new group
+          self.groups.append(([], [], [])); offset = 0
+        shadows, params, works = self.groups[-1]
+        shadows.append(s); params.append(p); works.append(work[offset: offset + p.numel()].view_as(p))
+        offset += p.numel()
+  def update(self):
+    if not self.params: return
+    if self.flat is None: self.build()
+    with torch.no_grad():
+      if not hasattr(torch, "_foreach_copy_"): # old torch, no multi-tensor ops
+        for s, p in zip(self.shadows, self.params):
+          p.mul_(1.0 - self.mu).add_(s.to(p.dtype), alpha=self.mu)
+          s.copy_(p)
+      elif self.flat.dtype == self.params[0].dtype:
+        torch._foreach_lerp_(self.shadows, self.params, 1.0 - self.mu)
+        torch._foreach_copy_(self.params, self.shadows)
+      else: # low-precision shadow: average in the work buffer, in the precision of the params, then round into the shadow
+        for shadows, params, works in self.groups:
+          torch._foreach_copy_(works, shadows)
+          torch._foreach_lerp_(works, params, 1.0 - self.mu)
+          torch._foreach_copy_(params, works)
+          torch._foreach_copy_(shadows, works)
+  def state_dict(self): # name -> shadow
+    if self.flat is None and self.params: self.build()
+    return dict(self.shadow)
+  def load_state_dict(self, state): # copy the shadows of state_dict() in, e.g., on resume
+    if self.flat is None and self.params: self.build()
+    with torch.no_grad():
+      for name in self.names:
+        self.shadow[name].copy_(state[name])
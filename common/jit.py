@@ -0,0 +1,57 @@
+import os
+import torch
+
+# Opt-in compiled training steps ("--compile"). The models run in the decoder and SE updates are compiled in place:
+#   inductor: torch.compile. The forward and backward graphs are cached on disk in --compile_cache_dir, so a later
+#             run with the same models, shapes and torch version loads them instead of compiling again.
+#   script:   TorchScript, the fallback for a torch without torch.compile. It is compiled at every start (no disk cache).
+# A model that TorchScript fails to compile runs eagerly, with a warning. torch.compile compiles at the first call.
+
+def add_compile_args(parser):
+  parser.add_argument('--compile', type=str, default="none", choices=["none", "inductor", "script"], help="compile the models of the training steps")
+  parser.add_argument('--compile_cache_dir', type=str, default="../Experiments/compile_cache", help="the on-disk cache of the compiled graphs")
+
+def set_up_compile(args):
+  '''
+    Check args.compile and set up the on-disk cache. Call it once, before compile_model.
+  '''
+  if args.compile == "inductor" and not hasattr(torch, "compile"):
+    print("==> torch.compile is not available in torch %s. Fall back to TorchScript." % torch.__version__)
+    args.compile = "script"
+  if args.compile == "inductor":
+    cache_dir = os.path.abspath(args.compile_cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_dir # read when inductor is first imported
+    os.environ["TORCHINDUCTOR_FX_GRAPH_CACHE"] = "1"
+    os.environ["TORCHINDUCTOR_AUTOGRAD_CACHE"] = "1"
+    import torch._inductor.config as inductor_config
+    inductor_config.fx_graph_cache = True
+    if hasattr(inductor_config, "autograd_cache"): # newer torch also caches the backward graphs
+      inductor_config.autograd_cache = True
+
+def compile_model(model, args, methods=("forward", "forward_branch")):
+  '''
+    Replace the given methods of 'model' with compiled ones. The model keeps its class, parameters and
+    state_dict keys, so the optimizers, EMA and checkpoints work on it as before.
+  '''
+  if args.compile == "none":
+    return model
+  try:
+    if args.compile == "inductor":
+      for name in methods:
+        if hasattr(model, name):
+          setattr(model, name, torch.compile(getattr(model, name)))
+    else:
+      scripted = torch.jit.script(model) # shares the parameters with 'model', but not the train/eval flag
+      def run(name):
+        def f(*inputs):
+          if scripted.training != model.training:
+            scripted.train(model.training)
+          return getattr(scripted, name)(*inputs)
+        return f
+      for name in methods:
+        if hasattr(scripted, name): # TorchScript only compiles forward and the methods it calls
+          setattr(model, name, run(name))
+  except Exception as e:
+    print("==> Failed to compile %s with '%s', run it eagerly: %s" % (model.__class__.__name__, args.compile, e))
+  return model
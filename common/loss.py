@@ -0,0 +1,161 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from .dist import mean_over_ranks
+
+# Loss terms shared by the training scripts. Each term takes some of these inputs:
+#   tv, norm:              img
+#   perc:                  feats_rec, feats_ref (per-tap MSE on all but the last tap, weighted by perc_lw)
+#   feat:                  feats_se,  feats_ref (per-tap MSE on all but the last tap, weighted by feat_lw)
+#   soft:                  logits, prob_target  (KL at temperature temp, times temp^2)
+#   hard, actimax, class:  logits, label
+#   DT:                    logits_DT, label
+#   alpha:                 last_feature (L_alpha of DFL)
+#   ie:                    logits       (L_ie of DFL)
+# Under bfloat16 autocast, the p=6 norm, the KL/softmax and cross-entropy losses and L_ie are computed in float32.
+# If the batch is made of 'groups' equal parts (e.g., the outputs of several decoders stacked together),
+# every term is the sum of the terms of the parts, i.e., each part keeps the loss it would have on its own.
+# With 'world_size' ranks, each on its shard of the batch (see dist.py): the terms summed over the batch (tv, norm, class)
+# are multiplied by world_size and L_ie is computed on the mean probability over all the ranks, so that with the grads
+# averaged over the ranks every term has its full-batch grad.
+
+def tv_loss(img):
+  return torch.sum(torch.abs(img[..., :, :-1] - img[..., :, 1:])) + \
+         torch.sum(torch.abs(img[..., :-1, :] - img[..., 1:, :]))
+
+def img_norm(img, p=6):
+  return torch.pow(torch.norm(img.float(), p=p), p)
+
+def kl_loss(logprob, prob): # the same as nn.KLDivLoss() with the default elementwise mean
+  return F.kl_div(logprob, prob, reduction="sum") / logprob.numel()
+
+class DistillLoss():
+  '''
+    weights: dict, term name -> loss weight. Terms with weight 0 are not computed.
+  '''
+  def __init__(self, weights, temp=1., num_class=10, perc_lw=None, feat_lw=None, noise_magnitude=0., world_size=1):
+    self.weights = dict(weights)
+    self.timer = None # a StepTimer (see timing.py): each term is timed as the phase "loss_<term>"
+    self.temp = temp
+    self.num_class = num_class
+    self.perc_lw = perc_lw
+    self.feat_lw = feat_lw
+    self.noise_magnitude = noise_magnitude
+    self.world_size = world_size
+
+  def __call__(self, groups=1, extra_terms=(), **inputs):
+    '''
+      Return a dict of on-device scalars: the (unweighted) value of every enabled term whose inputs are given,
+      and "total", the weighted sum of them. 'extra_terms' are computed for logging even if their weight is 0,
+      but are not added to the total.
+    '''
+    losses = {}; total = 0
+    for name, w in self.weights.items():
+      if w:
+        term = self.compute(name, inputs, groups, losses)
+        if term is not None:
+          losses[name] = term
+          total = total + term * w
+    for name in extra_terms:
+      if name not in losses:
+        term = self.compute(name, inputs, groups, losses)
+        if term is not None:
+          losses[name] = term
+    losses["total"] = total
+    return losses
+
+  def compute(self, name, inputs, groups, losses):
+    if self.timer is None:
+      return getattr(self, "loss_" + name)(inputs, groups, losses)
+    with self.timer.phase("loss_" + name):
+      return getattr(self, "loss_" + name)(inputs, groups, losses)
+
+  def loss_tv(self, inputs, groups, losses):
+    if inputs.get("img") is None: return None
+    return tv_loss(inputs["img"]) * self.world_size
+
+  def loss_norm(self, inputs, groups, losses):
+    if inputs.get("img") is None: return None
+    return img_norm(inputs["img"]) * self.world_size
+
+  def mse_taps(self, name, feats, feats_ref, lw, groups, losses):
+    loss = 0
+    for k in range(len(feats_ref) - 1): # the last one is the logits
+      losses[name + str(k + 1)] = nn.MSELoss()(feats[k], feats_ref[k].detach()) * groups
+      loss = loss + losses[name + str(k + 1)] * (lw[k] if lw else 1)
+    return loss
+
+  def loss_perc(self, inputs, groups, losses):
+    if inputs.get("feats_rec") is None or inputs.get("feats_ref") is None: return None
+    return self.mse_taps("perc", inputs["feats_rec"], inputs["feats_ref"], self.perc_lw, groups, losses)
+
+  def loss_feat(self, inputs, groups, losses):
+    if inputs.get("feats_se") is None or inputs.get("feats_ref") is None: return None
+    return self.mse_taps("feat", inputs["feats_se"], inputs["feats_ref"], self.feat_lw, groups, losses)
+
+  def loss_soft(self, inputs, groups, losses):
+    if inputs.get("logits") is None or inputs.get("prob_target") is None: return None
+    logprob = F.log_softmax(inputs["logits"].float() / self.temp, dim=1)
+    return kl_loss(logprob, inputs["prob_target"].detach().float()) * (self.temp * self.temp) * groups
+
+  def cross_entropy(self, logits, label, groups):
+    logits = logits.float()
+    if groups == 1:
+      loss = F.cross_entropy(logits, label)
+      return loss, loss.view(1)
+    loss_groups = F.cross_entropy(logits, label, reduction="none").view(groups, -1).mean(dim=1)
+    return loss_groups.sum(), loss_groups
+
+  def loss_hard(self, inputs, groups, losses):
+    if inputs.get("logits") is None or inputs.get("label") is None: return None
+    loss, losses["hard_groups"] = self.cross_entropy(inputs["logits"], inputs["label"], groups) # per group, for the print
+    return loss
+
+  def loss_DT(self, inputs, groups, losses):
+    if inputs.get("logits_DT") is None or inputs.get("label") is None: return None
+    return self.cross_entropy(inputs["logits_DT"], inputs["label"], groups)[0]
+
+  def loss_class(self, inputs, groups, losses):
+    if inputs.get("logits") is None or inputs.get("label") is None: return None
+    return -inputs["logits"].gather(1, inputs["label"].view(-1, 1)).sum() * self.world_size
+
+  # ref: 2016 IJCV Visualizing Deep Convolutional Neural Networks Using Natural Pre-images
+  def loss_actimax(self, inputs, groups, losses):
+    if inputs.get("logits") is None or inputs.get("label") is None: return None
+    logits = inputs["logits"]
+    rand_loss_weight = torch.rand_like(logits) * self.noise_magnitude
+    rand_loss_weight.scatter_(1, inputs["label"].view(-1, 1), 1)
+    return -torch.sum(logits * rand_loss_weight) / logits.size(0) * groups
+
+  # ref: 2019.04 arxiv Data-Free Learning of Student Networks (https://arxiv.org/abs/1904.01186)
+  def loss_alpha(self, inputs, groups, losses):
+    if inputs.get("last_feature") is None: return None
+    last_feature = inputs["last_feature"]
+    return -torch.norm(last_feature, p=1) / last_feature.size(0) * groups
+
+  def loss_ie(self, inputs, groups, losses):
+    if inputs.get("logits") is None: return None
+    prob = inputs["logits"].float().softmax(dim=1)
+    ave_prob = prob.view(groups, -1, prob.size(1)).mean(dim=1)
+    if self.world_size > 1:
+      ave_prob = mean_over_ranks(ave_prob)
+    return torch.sum(ave_prob * torch.log(ave_prob)) / self.num_class
+
+def backward_split(loss, params, split_loss, split):
+  '''
+    One backward pass for a model cut at 'split' (a leaf: the detached output of the front model, e.g. the codemap),
+    where the back model is updated by 'loss' and the front model by 'split_loss' only.
+    Both losses are backpropagated together, as a batch of 2 cotangents (is_grads_batched), so the graph after 'split'
+    (e.g. the decoder and the teacher) is traversed once and not retained. 'params' (of the back model) get the grad of
+    'loss' (accumulated to .grad). Return the cotangent of 'split_loss' at 'split', to backpropagate through the front
+    model, e.g. code.backward(grad).
+  '''
+  params = [p for p in params if p.requires_grad]
+  grad_outputs = [torch.tensor([1., 0.], device=loss.device, dtype=loss.dtype),
+                  torch.tensor([0., 1.], device=split_loss.device, dtype=split_loss.dtype)]
+  grads = torch.autograd.grad([loss, split_loss], params + [split], grad_outputs=grad_outputs,
+                              is_grads_batched=True, allow_unused=True)
+  for p, g in zip(params, grads[:-1]):
+    if g is not None:
+      p.grad = g[0] if p.grad is None else p.grad + g[0]
+  return grads[-1][1]
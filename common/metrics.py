@@ -0,0 +1,63 @@
+import json
+from collections import OrderedDict
+import torch
+
+# Running means of the training metrics (losses, accuracies) between two log prints.
+# add() takes the values as tensors and sums them up in place on their device, so it never waits for the device.
+# Only summarize() copies the sums to the host, all in one transfer, at show_interval. write() appends a record
+# (e.g., the epoch, the step and the means) as one JSON line to --metrics_file, next to the human-readable log line.
+
+def add_metrics_args(parser):
+  parser.add_argument('--metrics_file', type=str, default=None, help="the JSONL file of the metrics. Default: metrics_<ExpID>.jsonl in the weights directory. 'none': no file")
+
+def accuracy(logits, label, groups=1):
+  '''
+    The accuracy of 'logits' on 'label' as a tensor on their device: a scalar, or with groups > 1, one per group
+    (the batch is 'groups' equal slices, e.g., one per decoder).
+  '''
+  correct = logits.detach().argmax(dim=1).eq(label).float()
+  return correct.mean() if groups == 1 else correct.view(groups, -1).mean(dim=1)
+
+class Metrics():
+  '''
+    device: where the sums are kept. path: the JSONL file, or None.
+  '''
+  def __init__(self, device, path=None):
+    self.device = device
+    self.sums = OrderedDict() # name -> [sum, number of adds]
+    self.file = open(path, "a") if path else None
+
+  def add(self, name, value):
+    '''
+      value: a scalar tensor, a 1-D tensor (e.g., one entry per decoder) or a number.
+    '''
+    if torch.is_tensor(value):
+      value = value.detach().to(self.device, torch.float32)
+    else:
+      value = torch.tensor(float(value), device=self.device)
+    if name not in self.sums:
+      self.sums[name] = [torch.zeros_like(value), 0]
+    s = self.sums[name]
+    s[0].add_(value); s[1] += 1
+
+  def summarize(self):
+    '''
+      The means since the last summarize(), {name: float, or a list for 1-D metrics}. The sums are then cleared.
+    '''
+    if not self.sums: return OrderedDict()
+    values = torch.cat([(s / n).flatten() for s, n in self.sums.values()]).tolist() # the only sync
+    means = OrderedDict(); i = 0
+    for name, (s, _) in self.sums.items():
+      means[name] = values[i] if s.dim() == 0 else values[i: i + s.numel()]
+      i += s.numel()
+    self.sums = OrderedDict()
+    return means
+
+  def write(self, record):
+    if self.file:
+      self.file.write(json.dumps(record) + "\n")
+      self.file.flush()
+
+  def close(self):
+    if self.file:
+      self.file.close()
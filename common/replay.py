@@ -0,0 +1,75 @@
+import torch
+
+# A bounded buffer of generated samples, so that SE can take several steps per decoder step.
+# Images are kept as uint8, quantized per sample between its min and max, with the teacher logits and the labels.
+# Eviction when full:
+#   fifo:      the oldest samples are replaced.
+#   reservoir: every sample seen so far has the same chance to be in the buffer.
+# All the storage is on 'device', so adding and sampling need no copy to or from the host.
+
+class ReplayBuffer():
+  '''
+    img_shape: the shape of one image, e.g., (3, 32, 32).
+    balanced: sample each class (the argmax of the teacher logits) equally often, among the classes in the buffer.
+  '''
+  def __init__(self, capacity, img_shape, num_class, device, policy="fifo", balanced=True):
+    assert(policy in ["fifo", "reservoir"])
+    self.capacity = capacity
+    self.policy = policy
+    self.balanced = balanced
+    self.num_class = num_class
+    self.imgs   = torch.zeros((capacity,) + tuple(img_shape), dtype=torch.uint8, device=device)
+    self.ranges = torch.zeros(capacity, 2, device=device) # min and max of each image
+    self.logits = torch.zeros(capacity, num_class, device=device)
+    self.labels = torch.zeros(capacity, dtype=torch.long, device=device)
+    self.classes = torch.zeros(capacity, dtype=torch.long, device=device) # teacher argmax
+    self.num_seen = 0 # the number of samples ever added
+    self.size = 0
+
+  def add(self, imgs, logits, labels=None):
+    '''
+      imgs: batch x channel x height x width. labels: the targets for SE. Default: the argmax of logits.
+    '''
+    imgs = imgs.detach().float(); logits = logits.detach().float()
+    B = imgs.size(0)
+    labels = logits.argmax(dim=1) if labels is None else labels
+    t = torch.arange(self.num_seen, self.num_seen + B, device=imgs.device)
+    if self.policy == "fifo":
+      index = t % self.capacity
+    else:
+      # Algorithm R: the t-th sample replaces a random slot with probability capacity / (t + 1)
+      j = (torch.rand(B, device=imgs.device) * (t + 1).float()).long()
+      index = torch.where(t < self.capacity, t, j)
+      keep = index < self.capacity
+      index = index[keep]; imgs = imgs[keep]; logits = logits[keep]; labels = labels[keep]
+    # A slot can be drawn more than once in a batch (reservoir, or fifo with a batch larger than the buffer) and
+    # the assignments below are undefined for repeated indices: keep only the last write to each slot, as if the
+    # samples were added one by one.
+    order = torch.arange(index.numel(), device=index.device)
+    last = torch.full((self.capacity,), -1, dtype=torch.long, device=index.device).scatter_reduce_(0, index, order, reduce="amax")
+    keep = last[index] == order
+    index = index[keep]; imgs = imgs[keep]; logits = logits[keep]; labels = labels[keep]
+    lo = imgs.flatten(1).min(dim=1)[0]; hi = imgs.flatten(1).max(dim=1)[0]
+    scale = (hi - lo).clamp(min=1e-8).view(-1, *[1] * (imgs.dim() - 1))
+    self.imgs[index]   = ((imgs - lo.view_as(scale)) / scale * 255).round().to(torch.uint8)
+    self.ranges[index] = torch.stack([lo, hi], dim=1)
+    self.logits[index] = logits
+    self.labels[index] = labels
+    self.classes[index] = logits.argmax(dim=1)
+    self.num_seen += B
+    self.size = min(self.num_seen, self.capacity)
+
+  def sample(self, batch_size):
+    '''
+      Return a random batch (with replacement) of images (float32), teacher logits and labels.
+    '''
+    assert(self.size > 0)
+    if self.balanced:
+      count = torch.bincount(self.classes[:self.size], minlength=self.num_class).float()
+      index = torch.multinomial((1. / count)[self.classes[:self.size]], batch_size, replacement=True)
+    else:
+      index = torch.randint(self.size, (batch_size,), device=self.imgs.device)
+    lo, hi = self.ranges[index].unbind(dim=1)
+    shape = (-1,) + (1,) * (self.imgs.dim() - 1)
+    imgs = self.imgs[index].float() / 255 * (hi - lo).view(shape) + lo.view(shape)
+    return imgs, self.logits[index], self.labels[index]
@@ -0,0 +1,67 @@
+import torch
+import torch.nn.functional as F
+
+# Random codes for the decoders. The codes of 'buffer_steps' steps are drawn in one vectorized call on the
+# device, then handed out one step at a time by next(), which returns (codes, labels) of one batch.
+
+class CodeSampler():
+  '''
+    Two kinds of codes:
+      logit codes (num_z=0): "logits" of a random class, i.e., randn * noise + onehot * peak, divided by temp.
+        'noise' is drawn uniformly from noise_range and 'peak' as an integer from [peak_range[0], peak_range[1]),
+        once per step (not per sample), as the original MNIST and AlexNet code.
+      z codes (num_z>0): randn z, concatenated with the onehot label if 'condition'.
+        With 'paired' (MSGAN), the two halves of a batch have independent z but the same labels.
+    The labels of the samples are uniformly random.
+  '''
+  def __init__(self, batch_size, num_class, device, num_z=0, condition=False, paired=False,
+               noise_range=(1., 1.), peak_range=(1, 2), temp=1., buffer_steps=100):
+    assert(not paired or batch_size % 2 == 0)
+    self.batch_size = batch_size
+    self.num_class = num_class
+    self.device = device
+    self.num_z = num_z
+    self.condition = condition
+    self.paired = paired
+    self.noise_range = noise_range
+    self.peak_range = peak_range
+    self.temp = temp
+    self.buffer_steps = buffer_steps
+    self.index = buffer_steps # empty
+
+  def fill(self):
+    K, B, C = self.buffer_steps, self.batch_size, self.num_class
+    num_label = B // 2 if self.paired else B
+    label = torch.randint(C, (K, num_label), device=self.device)
+    if self.paired:
+      label = torch.cat([label, label], dim=1)
+    onehot = F.one_hot(label, C).float()
+    if self.num_z:
+      x = torch.randn(K, B, self.num_z, device=self.device)
+      if self.condition:
+        x = torch.cat([x, onehot], dim=2)
+    else:
+      low, high = self.noise_range
+      noise = torch.rand(K, 1, 1, device=self.device) * (high - low) + low
+      peak = torch.randint(int(self.peak_range[0]), int(self.peak_range[1]), (K, 1, 1), device=self.device).float()
+      x = (torch.randn(K, B, C, device=self.device) * noise + onehot * peak) / self.temp
+    self.codes = x; self.labels = label
+    self.index = 0
+
+  def state_dict(self): # the buffer and the position in it, so that a resumed run hands out the same codes
+    state = {"index": self.index}
+    if self.index < self.buffer_steps:
+      state["codes"] = self.codes; state["labels"] = self.labels
+    return state
+
+  def load_state_dict(self, state):
+    self.index = int(state["index"])
+    if self.index < self.buffer_steps:
+      self.codes = state["codes"].to(self.device); self.labels = state["labels"].to(self.device)
+
+  def next(self):
+    if self.index == self.buffer_steps:
+      self.fill()
+    x = self.codes[self.index]; label = self.labels[self.index]
+    self.index += 1
+    return x, label
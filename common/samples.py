@@ -0,0 +1,59 @@
+import os
+import threading
+import zipfile
+import numpy as np
+import torch
+import torchvision.utils as vutils
+from concurrent.futures import ThreadPoolExecutor
+
+# Dump sample images without stalling training. Each save() copies a batch of images to host memory and
+# a background worker pool writes it as one grid image. The images (and their labels) are also appended
+# to a compressed archive, one entry per save(), which can be read with np.load.
+
+def append_npz(path, arrays): # add arrays to a (new or existing) .npz file
+  with zipfile.ZipFile(path, mode="a", compression=zipfile.ZIP_DEFLATED) as f:
+    for key, val in arrays.items():
+      with f.open(key + ".npy", mode="w", force_zip64=True) as out:
+        np.lib.format.write_array(out, np.asanyarray(val), allow_pickle=False)
+
+class SampleWriter():
+  '''
+    npz_path: the archive to append the images to. None: only write the grids.
+    max_pending: the max number of batches being written. save() blocks when reaching it.
+  '''
+  def __init__(self, npz_path=None, num_workers=2, max_pending=4):
+    self.npz_path = npz_path
+    self.pool = ThreadPoolExecutor(max_workers=num_workers)
+    self.npz_lock = threading.Lock()
+    self.max_pending = max_pending
+    self.pending = []
+
+  def save(self, imgs, path, nrow=8, key=None, **arrays):
+    '''
+      imgs: batch x channel x height x width, on any device. It is written as a grid of 'nrow' images per row.
+      key: the name of the entry in the archive, e.g., "E0S1000". Default: the file name of 'path'.
+      arrays: other arrays to keep with the images in the archive, e.g., labels.
+    '''
+    imgs = imgs.detach().to("cpu", copy=True).float()
+    arrays = {k: v.detach().cpu().numpy() if torch.is_tensor(v) else np.asarray(v) for k, v in arrays.items()}
+    key = key if key else os.path.splitext(os.path.basename(path))[0]
+    while len(self.pending) >= self.max_pending:
+      self.pending.pop(0).result()
+    self.pending.append(self.pool.submit(self.write, imgs, path, nrow, key, arrays))
+
+  def write(self, imgs, path, nrow, key, arrays):
+    vutils.save_image(imgs, path, nrow=nrow)
+    if self.npz_path:
+      arrays = {key + "_" + k: v for k, v in arrays.items()}
+      arrays[key + "_imgs"] = imgs.numpy()
+      with self.npz_lock:
+        append_npz(self.npz_path, arrays)
+
+  def flush(self): # wait until all the pending batches are written; raise the errors of the workers, if any
+    pending, self.pending = self.pending, []
+    for future in pending:
+      future.result()
+
+  def close(self):
+    self.flush()
+    self.pool.shutdown()
@@ -0,0 +1,98 @@
+import os
+import json
+import numpy as np
+import torch
+pjoin = os.path.join
+
+# A synthetic dataset on disk: the images, the teacher logits and the labels, in .npy shards of 'shard_size' samples,
+#   <dir>/meta.json
+#   <dir>/imgs_00000.npy, logits_00000.npy, labels_00000.npy, ...
+# The shards are written through memory maps (np.lib.format.open_memmap), so no shard is held in memory, and read
+# back with mmap_mode="r", so a DataLoader worker only pages in the samples it indexes.
+
+class ShardWriter():
+  '''
+    num_sample: the total number of samples to write, which sets the number and the sizes of the shards.
+    img_dtype: the dtype of the stored images. float16 halves the disk size; the logits are kept in float32.
+  '''
+  def __init__(self, out_dir, num_sample, img_shape, num_class, shard_size=50000, img_dtype="float16"):
+    if not os.path.exists(out_dir):
+      os.makedirs(out_dir)
+    self.out_dir = out_dir
+    self.num_sample = num_sample
+    self.img_shape = tuple(img_shape)
+    self.num_class = num_class
+    self.shard_size = shard_size
+    self.img_dtype = img_dtype
+    self.num_written = 0
+    self.shard = None # the memory maps of the current shard
+
+  def open_shard(self, si):
+    n = min(self.shard_size, self.num_sample - si * self.shard_size)
+    open_npy = lambda name, shape, dtype: np.lib.format.open_memmap(pjoin(self.out_dir, "%s_%05d.npy" % (name, si)), mode="w+", dtype=dtype, shape=shape)
+    self.shard = {"imgs":   open_npy("imgs",   (n,) + self.img_shape,   self.img_dtype),
+                  "logits": open_npy("logits", (n, self.num_class), "float32"),
+                  "labels": open_npy("labels", (n,),                "int64")}
+
+  def flush(self):
+    if self.shard is not None:
+      for x in self.shard.values():
+        x.flush()
+      self.shard = None
+
+  def write(self, imgs, logits, labels):
+    '''
+      Append a batch (tensors on any device), splitting it over the shards. The samples beyond 'num_sample' are dropped.
+    '''
+    batch = {"imgs": imgs, "logits": logits, "labels": labels}
+    batch = {k: v.detach().float().cpu().numpy() if k != "labels" else v.cpu().numpy() for k, v in batch.items()}
+    i = 0; B = min(len(imgs), self.num_sample - self.num_written)
+    while i < B:
+      si, offset = divmod(self.num_written, self.shard_size)
+      if offset == 0:
+        self.flush()
+        self.open_shard(si)
+      n = min(B - i, len(self.shard["imgs"]) - offset)
+      for k, x in self.shard.items():
+        x[offset: offset + n] = batch[k][i: i + n]
+      i += n; self.num_written += n
+
+  def close(self, **info):
+    '''
+      Flush the last shard and write meta.json. 'info' (e.g., the weights used) is kept in it for the record.
+    '''
+    self.flush()
+    meta = {"num_sample": self.num_written, "shard_size": self.shard_size, "img_shape": list(self.img_shape),
+            "num_class": self.num_class, "img_dtype": self.img_dtype, "info": info}
+    with open(pjoin(self.out_dir, "meta.json"), "w") as f:
+      json.dump(meta, f, indent=2)
+
+class ShardDataset(torch.utils.data.Dataset):
+  '''
+    The samples written by ShardWriter. Each item is (img, logits, label), with img and logits in float32.
+    The shards are memory-mapped lazily, so each DataLoader worker maps them in its own process.
+  '''
+  def __init__(self, data_dir):
+    with open(pjoin(data_dir, "meta.json")) as f:
+      self.meta = json.load(f)
+    self.data_dir = data_dir
+    self.shard_size = self.meta["shard_size"]
+    self.shards = {}
+
+  def __getstate__(self): # the memory maps are not sent to the DataLoader workers, which map the shards themselves
+    state = self.__dict__.copy()
+    state["shards"] = {}
+    return state
+
+  def __len__(self):
+    return self.meta["num_sample"]
+
+  def get_shard(self, si):
+    if si not in self.shards:
+      self.shards[si] = [np.load(pjoin(self.data_dir, "%s_%05d.npy" % (name, si)), mmap_mode="r") for name in ["imgs", "logits", "labels"]]
+    return self.shards[si]
+
+  def __getitem__(self, index):
+    imgs, logits, labels = self.get_shard(index // self.shard_size)
+    i = index % self.shard_size
+    return torch.from_numpy(imgs[i].astype(np.float32)), torch.from_numpy(np.array(logits[i])), int(labels[i])
@@ -0,0 +1,108 @@
+import os
+import time
+import contextlib
+from collections import OrderedDict
+import torch
+pjoin = os.path.join
+
+# Per-phase timing of the training steps (--time_phases) and a torch.profiler trace of a window of steps (--profile_steps).
+# The training script marks the phases of a step by
+#   with timer.phase("dec_forward"):
+#     ...
+# and calls timer.step() at the end of every step. The wall time, the number of calls and the peak memory of each phase
+# are summed up until report(), which the script logs at show_interval. With --sync_phases, the device is synchronized
+# at the phase boundaries, so the asynchronous CUDA work is counted in the phase that launched it.
+# The memory of a phase is its peak CUDA memory allocated minus the memory allocated at its entry, i.e., what the phase
+# itself takes on top of the tensors alive before it. It is on GPU only: on CPU, the peak RSS is of the whole process
+# and has no cheap per-phase reset, so only the time is reported.
+# A phase can be nested in another one (e.g., a loss term in the SE update); the time of the outer one includes it.
+# Under the profiler, every phase is also a labeled range in the trace.
+
+def add_timing_args(parser):
+  parser.add_argument('--time_phases', action="store_true", help="log the time (and on GPU, the peak memory) of each phase of the steps at show_interval")
+  parser.add_argument('--sync_phases', action="store_true", help="with --time_phases, synchronize the device at the phase boundaries")
+  parser.add_argument('--profile_steps', type=str, default=None, help="A:B, capture a torch.profiler trace of the steps A to B-1 (counted over the epochs)")
+  parser.add_argument('--profile_dir', type=str, default=None, help="the directory of the trace. Default: the weights directory")
+
+class StepTimer():
+  '''
+    log: the function to log the profiler table with. name: the prefix of the trace file.
+  '''
+  def __init__(self, args, device, log=print, name="trace"):
+    self.enabled = args.time_phases
+    self.sync = args.sync_phases and device.type == "cuda"
+    self.device = device
+    self.log = log
+    self.cuda = device.type == "cuda"
+    self.stats = OrderedDict() # phase -> [time, number of calls, peak memory]
+    self.stack = [] # [memory allocated at the entry, peak memory allocated so far] of the open phases, on GPU
+    self.num_step = 0; self.num_step_report = 0
+    self.prof = None
+    self.profile = [int(x) for x in args.profile_steps.split(":")] if args.profile_steps else None
+    if self.profile:
+      assert(len(self.profile) == 2 and self.profile[0] < self.profile[1])
+      self.trace_path = pjoin(args.profile_dir, "%s_steps%s-%s.json" % (name, self.profile[0], self.profile[1]))
+    self.update_profiler()
+
+  @contextlib.contextmanager
+  def timed_phase(self, name):
+    if self.sync: torch.cuda.synchronize(self.device)
+    if self.cuda:
+      if self.stack: # keep the peak of the enclosing phase before resetting it
+        self.stack[-1][1] = max(self.stack[-1][1], torch.cuda.max_memory_allocated(self.device))
+      torch.cuda.reset_peak_memory_stats(self.device)
+      self.stack.append([torch.cuda.memory_allocated(self.device), 0])
+    t0 = time.perf_counter()
+    try:
+      with torch.profiler.record_function(name):
+        yield
+    finally:
+      if self.sync: torch.cuda.synchronize(self.device)
+      t = time.perf_counter() - t0
+      peak = 0.
+      if self.cuda:
+        base, top = self.stack.pop()
+        top = max(top, torch.cuda.max_memory_allocated(self.device))
+        if self.stack:
+          self.stack[-1][1] = max(self.stack[-1][1], top)
+        peak = (top - base) / 1024. ** 2
+      s = self.stats.setdefault(name, [0., 0, 0.])
+      s[0] += t; s[1] += 1; s[2] = max(s[2], peak)
+
+  def phase(self, name):
+    if self.enabled:
+      return self.timed_phase(name)
+    if self.prof is not None:
+      return torch.profiler.record_function(name)
+    return contextlib.nullcontext()
+
+  def step(self): # the end of a training step
+    self.num_step += 1; self.num_step_report += 1
+    if self.prof is not None:
+      self.prof.step()
+    self.update_profiler()
+
+  def update_profiler(self): # start or stop the profiler at the ends of the window
+    if not self.profile: return
+    if self.num_step == self.profile[0]:
+      activities = [torch.profiler.ProfilerActivity.CPU] + [torch.profiler.ProfilerActivity.CUDA] * self.cuda
+      self.prof = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+      self.prof.start()
+    elif self.num_step == self.profile[1] and self.prof is not None:
+      self.prof.stop()
+      self.prof.export_chrome_trace(self.trace_path)
+      sort_by = "self_cuda_time_total" if self.cuda else "self_cpu_time_total"
+      self.log("Profile of steps %s-%s, trace written to %s\n%s" % (self.profile[0], self.profile[1] - 1, self.trace_path,
+               self.prof.key_averages().table(sort_by=sort_by, row_limit=25)))
+      self.prof = None
+
+  def report(self):
+    '''
+      Return the stats since the last report as one log line (the ms per step and, on GPU, the peak memory of every
+      phase, in the order they first ran), or None if timing is off. The stats are then cleared.
+    '''
+    if not self.enabled or not self.num_step_report: return None
+    n = self.num_step_report
+    line = " | ".join("%s: %.2fms" % (name, t * 1000 / n) + (" (%.0fMB)" % peak if self.cuda else "") for name, (t, _, peak) in self.stats.items())
+    self.stats = OrderedDict(); self.num_step_report = 0
+    return "phases per step over %s steps: %s" % (n, line)